@@ -1,8 +1,13 @@
+from typing import Callable, Optional
 import argparse
 import yaml
 import re
 
 
+def _str_to_bool(value) -> bool:
+    return str(value).lower() in ["true", "1", "yes"]
+
+
 def _parse_args(parser, config_parser):
     # Do we have a config file to parse?
     args_config, remaining = config_parser.parse_known_args()
@@ -29,7 +34,7 @@ def _parse_args(parser, config_parser):
     return args
 
 
-def get_args():
+def get_args(add_arguments: Optional[Callable[[argparse.ArgumentParser], None]] = None):
     # The first arg parser parses out only the --config argument, this argument is used to
     # load a yaml file containing key-values that override the defaults for the main parser below
     config_parser = argparse.ArgumentParser(
@@ -64,7 +69,7 @@ def get_args():
         "--batches_per_epoch",
         type=int,
         default=128,
-        help="Number of batches per epoch",
+        help="Number of batches (optimizer steps) per epoch",
     )
 
     parser.add_argument(
@@ -88,6 +93,20 @@ def get_args():
         Represents the latent space size""",
     )
 
+    parser.add_argument(
+        "--head",
+        type=str,
+        default="flatten",
+        help="Projection head on top of the ViT: flatten, cls, mean, attention or low_rank",
+    )
+
+    parser.add_argument(
+        "--head_rank",
+        type=int,
+        default=64,
+        help="Rank of the factorised first layer of the low_rank head",
+    )
+
     parser.add_argument(
         "--contrastive_margin",
         type=float,
@@ -100,6 +119,29 @@ def get_args():
         help="Value to add to the euclidean distance to improve numerical stability",
     )
 
+    parser.add_argument(
+        "--loss_mining",
+        type=str,
+        default="pairs",
+        help="""Pairs the contrastive loss is computed on: pairs (only the sampled pairs),
+        all_pairs, batch_hard or semi_hard (mined from all images of a batch)""",
+    )
+
+    parser.add_argument(
+        "--pk_pets",
+        type=int,
+        default=0,
+        help="""Number of pets of a training batch, with pk_images images each.
+        0 samples batches of batch_size pairs instead""",
+    )
+
+    parser.add_argument(
+        "--pk_images",
+        type=int,
+        default=4,
+        help="Number of images per pet of a training batch, see pk_pets",
+    )
+
     # Training parameters
     parser.add_argument(
         "--epochs",
@@ -138,6 +180,173 @@ def get_args():
         help="How many epochs without improving accuracy before we stop.",
     )
 
+    # Backbone freezing
+    parser.add_argument(
+        "--freeze_backbone",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Whether to freeze the ViT backbone and only train the head.",
+    )
+
+    parser.add_argument(
+        "--unfreeze_last_n_blocks",
+        type=int,
+        default=0,
+        help="Number of ViT encoder blocks that are still trained when the backbone is frozen.",
+    )
+
+    parser.add_argument(
+        "--backbone_lr",
+        type=float,
+        default=None,
+        help="Learning rate of the trainable backbone weights, defaults to the optimizer lr.",
+    )
+
+    # Feature cache
+    parser.add_argument(
+        "--feature_cache_path",
+        type=str,
+        default=None,
+        help="""Folder in which the outputs of the frozen ViT are cached.
+        When given, training only runs the projection head.""",
+    )
+
+    parser.add_argument(
+        "--feature_cache_dtype",
+        type=str,
+        default="float32",
+        help="Data type of the cached ViT outputs: float32 or float16",
+    )
+
+    # Data loading
+    parser.add_argument(
+        "--shard_path",
+        type=str,
+        default=None,
+        help="Folder with the images packed by scripts/pack_shards.py, read instead of the image files.",
+    )
+
+    parser.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=0,
+        help="Size of the cache of decoded images that the loader processes share, 0 disables it.",
+    )
+
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="Number of processes that load and decode the images, 0 loads them in the main process.",
+    )
+
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches each loader process prepares ahead of time.",
+    )
+
+    parser.add_argument(
+        "--pin_memory",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Whether to load the batches into pinned memory (only used with CUDA).",
+    )
+
+    # Precision
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        help="Compute precision of the model: fp32, bf16 or fp16 (autocast, the weights stay fp32)",
+    )
+
+    parser.add_argument(
+        "--channels_last",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Whether to run the ViT patch embedding on channels-last images.",
+    )
+
+    parser.add_argument(
+        "--precision_drift_tolerance",
+        type=float,
+        default=0.02,
+        help="""Largest drop in test accuracy of the reduced precision compared to fp32.
+        Training falls back to fp32 when it is exceeded""",
+    )
+
+    # Checkpoints
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        default="safetensors",
+        help="Format of the saved model: safetensors or torch (the whole state_dict as .pt)",
+    )
+
+    parser.add_argument(
+        "--checkpoint_trainable_only",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=True,
+        help="""Whether safetensors checkpoints only store the trained weights and refer
+        to the pretrained ViT for the rest.""",
+    )
+
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=0,
+        help="Number of per-epoch copies of the saved model to keep, 0 only keeps the latest.",
+    )
+
+    parser.add_argument(
+        "--keep_checkpoints_by",
+        type=str,
+        default="recent",
+        help="Which per-epoch copies are kept: the most recent or the best (by test accuracy)",
+    )
+
+    parser.add_argument(
+        "--distributed_backend",
+        type=str,
+        default="gloo",
+        help="Backend of runs started with torchrun: gloo (CPU and GPU) or nccl (GPU only)",
+    )
+
+    parser.add_argument(
+        "--gather_embeddings",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Whether to mine pairs from the embeddings of all ranks instead of only the own batch.",
+    )
+
+    parser.add_argument(
+        "--accumulation_steps",
+        type=int,
+        default=1,
+        help="Number of batches of batch_size whose gradients are added up for one optimizer step.",
+    )
+
+    parser.add_argument(
+        "--activation_checkpointing",
+        type=_str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Whether to recompute the activations of the trainable ViT blocks in the backward pass.",
+    )
+
     # Otpimizer parameters
     parser.add_argument(
         "--optimizer",
@@ -179,6 +388,10 @@ def get_args():
         help="Whether to use tqdm for progress bar.",
     )
 
+    # Arguments of the script itself, besides those of the TrainConfig
+    if add_arguments is not None:
+        add_arguments(parser)
+
     args = _parse_args(parser, config_parser)
 
     if args.run_name is None:
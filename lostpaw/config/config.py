@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Optional, Tuple
 from dataclasses import dataclass
 
 
@@ -46,6 +46,32 @@ class TrainConfig:
     early_stopping_epochs: int = 15
     contrastive_margin: float = 1.25
     contrastive_epsilon: float = 1e-8
+    loss_mining: str = "pairs"
+    pk_pets: int = 0
+    pk_images: int = 4
     use_wandb: bool = False
     use_tqdm: bool = False
     latent_space_size: int = 1024
+    head: str = "flatten"
+    head_rank: int = 64
+    freeze_backbone: bool = False
+    unfreeze_last_n_blocks: int = 0
+    backbone_lr: Optional[float] = None
+    feature_cache_path: Optional[str] = None
+    feature_cache_dtype: str = "float32"
+    shard_path: Optional[str] = None
+    image_cache_mb: int = 0
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    pin_memory: bool = False
+    precision: str = "fp32"
+    channels_last: bool = False
+    precision_drift_tolerance: float = 0.02
+    checkpoint_format: str = "safetensors"
+    checkpoint_trainable_only: bool = True
+    keep_checkpoints: int = 0
+    keep_checkpoints_by: str = "recent"
+    distributed_backend: str = "gloo"
+    gather_embeddings: bool = False
+    accumulation_steps: int = 1
+    activation_checkpointing: bool = False
@@ -1,5 +1,34 @@
-from .extract_pets import DetrPetExtractor
-from .dataset import RandomPairDataset
-from .dataset import PetImageDataset
+from importlib import import_module
+from typing import TYPE_CHECKING, Any, List
 
-__all__ = ["DetrPetExtractor", "RandomPairDataset", "PetImageDataset"]
\ No newline at end of file
+# The submodules are only imported when one of their names is first used,
+# so that e.g. reading shards does not pull in transformers or pandas
+_EXPORTS = {
+    "DetrPetExtractor": ".extract_pets",
+    "RandomPairDataset": ".dataset",
+    "PetImageDataset": ".dataset",
+    "Pipeline": ".pipeline",
+    "Stage": ".pipeline",
+    "ShardReader": ".shards",
+    "ShardWriter": ".shards",
+}
+
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from .extract_pets import DetrPetExtractor
+    from .dataset import RandomPairDataset, PetImageDataset
+    from .pipeline import Pipeline, Stage
+    from .shards import ShardReader, ShardWriter
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
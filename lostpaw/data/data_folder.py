@@ -14,6 +14,8 @@ class PetImagesFolder:
     sources: Optional[List[str]] = []
     paths: List[List[str]] = []
     pet_ids: List[int] = []
+    # Per record the photo every image was cropped or augmented from, by path
+    photos: Optional[List[Dict[str, str]]] = None
     folder: Path
     info_file: Path
 
@@ -33,6 +35,8 @@ class PetImagesFolder:
 
             self.paths = df["paths"].tolist()
             self.pet_ids = df["pet_id"].tolist()
+            if "photos" in df.columns:
+                self.photos = [p if isinstance(p, dict) else {} for p in df["photos"]]
 
     def __len__(self) -> int:
         id_len = len(self.pet_ids)
@@ -54,6 +58,8 @@ class PetImagesFolder:
         data = dict(paths=self.paths, pet_id=self.pet_ids)
         if self.sources:
             data["source"] = self.sources
+        if self.photos:
+            data["photos"] = self.photos
         return pd.DataFrame(data)
 
     def save_info(self):
@@ -1,5 +1,5 @@
 from math import ceil
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import Image as ImageT
@@ -8,14 +8,21 @@ from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 from sys import maxsize
 import random
 import numpy as np
+import torch
 
 from lostpaw.data.data_folder import PetImagesFolder
+from lostpaw.data.image_cache import SharedImageCache
+from lostpaw.data.sampling import counter_uniforms
+from lostpaw.data.shards import ShardReader
 
 
 class PetImageDataset(Dataset):
     @classmethod
     def load_from_file(
-        cls, info_file: Path, ignore: Set[str] = set()
+        cls,
+        info_file: Path,
+        ignore: Set[str] = set(),
+        shards: Optional[ShardReader] = None,
     ) -> "PetImageDataset":
         image_root = info_file.parent
         try:
@@ -24,9 +31,10 @@ class PetImageDataset(Dataset):
                 lambda p: p not in ignore
             )
             imgs_and_labels_filtered = imgs_and_labels[imgs_and_labels["isProcessed"]]
-            img_paths = imgs_and_labels_filtered["savedPath"]
-            img_labels = imgs_and_labels_filtered["petId"]
-            return PetImageDataset(image_root, img_paths, img_labels)
+            # Positional, the dataset is indexed by 0..len - 1
+            img_paths = imgs_and_labels_filtered["savedPath"].reset_index(drop=True)
+            img_labels = imgs_and_labels_filtered["petId"].reset_index(drop=True)
+            return PetImageDataset(image_root, img_paths, img_labels, shards)
 
         except ValueError:
             print(
@@ -35,11 +43,16 @@ class PetImageDataset(Dataset):
             exit()
 
     def __init__(
-        self, image_root: Path, image_paths: pd.Series, image_labels: pd.Series
+        self,
+        image_root: Path,
+        image_paths: pd.Series,
+        image_labels: pd.Series,
+        shards: Optional[ShardReader] = None,
     ):
         self.image_root = image_root
         self.image_paths = image_paths
         self.image_labels = image_labels
+        self.shards = shards
 
     def __len__(self) -> int:
         return len(self.image_paths)
@@ -54,8 +67,11 @@ class PetImageDataset(Dataset):
             yield i, l, self.image_paths[idx]
 
     def __getitem__(self, idx) -> Tuple[Image.Image, str]:
-        img_path = self.image_root / self.image_paths[idx]
-        image = Image.open(img_path).convert("RGB")
+        if self.shards is not None and self.image_paths[idx] in self.shards:
+            image = self.shards.get_image(self.image_paths[idx])
+        else:
+            img_path = self.image_root / self.image_paths[idx]
+            image = Image.open(img_path).convert("RGB")
         label = self.image_labels[idx]
 
         return image, label
@@ -80,7 +96,7 @@ class PetImageDataset(Dataset):
             end = end if end < len(self) else len(self)
             paths = self.image_paths[start:end].reset_index(drop=True)
             labels = self.image_labels[start:end].reset_index(drop=True)
-            yield PetImageDataset(self.image_root, paths, labels)
+            yield PetImageDataset(self.image_root, paths, labels, self.shards)
 
 
 class RandomPairDataset(Dataset):
@@ -90,9 +106,13 @@ class RandomPairDataset(Dataset):
         same_probability=0.5,
         fold_count: Optional[int] = None,
         seed: Optional[int] = None,
+        shards: Optional[ShardReader] = None,
+        image_cache: Optional[SharedImageCache] = None,
     ):
         self.seed = seed or random.randint(0, maxsize)
         self.folder = folder
+        self.shards = shards
+        self.image_cache = image_cache
         self.same_probability = same_probability
         df = folder.data_frame()
         print(f"[DEBUG] DataFrame from PetImagesFolder:\n{df.head()}")
@@ -104,6 +124,8 @@ class RandomPairDataset(Dataset):
         print(f"[DEBUG] pets in dataframe: {len(df)}")
         print(f"[DEBUG] grouped pets: {len(self.pets)}")
 
+        self._build_index()
+
         self.fold_count = fold_count
         self.current_fold = 0 if fold_count is not None else None
 
@@ -111,71 +133,217 @@ class RandomPairDataset(Dataset):
         return maxsize
 
     def __iter__(self) -> Iterator[Tuple[ImageT, ImageT, int]]:
-        for idx in range(len(self)):
-            yield self.__getitem__(idx)
+        for path1, path2, is_same in self.iter_paths():
+            yield self.load_image(path1), self.load_image(path2), is_same
 
     def iter_test_items(self) -> Iterator[Tuple[ImageT, ImageT, int]]:
-        for idx in range(len(self)):
-            yield self.get_test_item(idx)
+        for path1, path2, is_same in self.iter_paths(test=True):
+            yield self.load_image(path1), self.load_image(path2), is_same
 
     def _get_item(self, idx: int) -> Tuple[ImageT, ImageT, int]:
-        rand_state = random.getstate()
-        random.seed(idx ^ self.seed)
-        data_length = len(self.pets)
-        idx = random.randint(0, data_length - 1)
-        is_same = random.random() < self.same_probability
-
-        img_path1 = None
-        img_path2 = None
-        img_list1: List[str]
-        img_list2: List[str]
-        image_paths_of_pet: List[List[str]] = self.pets.iloc[idx]["paths"]
-        if is_same:
-            if len(image_paths_of_pet) == 1:
-                raise RuntimeError("There is only one image for this pet. Please ensure there are at least 2 images per pet.")
-                # idx_1, idx_2 = random.sample(range(len(image_paths_of_pet[0])), 2)
-                # img_path1 = image_paths_of_pet[0][idx_1]
-                # img_path2 = image_paths_of_pet[0][idx_2]
-            else:
-                img_list1, img_list2 = random.sample(image_paths_of_pet, 2)
-
-                img_path1 = random.choice(img_list1)
-                img_path2 = random.choice(img_list2)
-
-        else:
-            img_list1 = random.choice(image_paths_of_pet)
-
-            idx2 = random.randint(0, data_length - 1)
-            while idx2 == idx:
-                idx2 = random.randint(0, data_length - 1)
-
-            img_list2 = random.choice(self.pets.iloc[idx2]["paths"])
-
-            img_path1 = random.choice(img_list1)
-            img_path2 = random.choice(img_list2)
-
-        img1 = Image.open(img_path1).convert("RGB")
-        img2 = Image.open(img_path2).convert("RGB")
-
-        random.setstate(rand_state)
+        img_path1, img_path2, is_same = self._get_paths(idx)
+        return self.load_image(img_path1), self.load_image(img_path2), is_same
+
+    def _get_paths(self, idx: int) -> Tuple[str, str, bool]:
+        first, second, is_same = self.sample_pairs(np.array([idx]))
+        return self.image_paths[first[0]], self.image_paths[second[0]], bool(is_same[0])
+
+    def sample_pairs(self, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Draws the pairs of a batch of indices in one vectorised call. The
+        random numbers of an index come from a Philox stream keyed by the
+        seed with the index as counter, so a pair only depends on its index.
+
+        Returns:
+            The indices into image_paths of the first and second images, and
+            whether the two images show the same pet.
+        """
+        u = counter_uniforms(indices, self.seed, 8)
+        pet_count = len(self.pet_group_offsets)
+
+        pet1 = (u[:, 0] * pet_count).astype(np.int64)
+        is_same = u[:, 1] < self.same_probability
+
+        # The first image comes from a random group of images of the pet
+        groups1 = self.pet_group_counts[pet1]
+        group1 = (u[:, 2] * groups1).astype(np.int64)
+
+        # Same pet: another group of the same pet
+        same_group2 = (group1 + 1 + (u[:, 3] * (groups1 - 1)).astype(np.int64)) % groups1
+
+        # Different pet: a random group of any other pet
+        pet2 = (pet1 + 1 + (u[:, 4] * (pet_count - 1)).astype(np.int64)) % pet_count
+        diff_group2 = (u[:, 5] * self.pet_group_counts[pet2]).astype(np.int64)
+
+        pet2 = np.where(is_same, pet1, pet2)
+        group2 = np.where(is_same, same_group2, diff_group2)
+
+        group1 += self.pet_group_offsets[pet1]
+        group2 += self.pet_group_offsets[pet2]
+
+        first = self.group_path_offsets[group1] + (
+            u[:, 6] * self.group_path_counts[group1]
+        ).astype(np.int64)
+        second = self.group_path_offsets[group2] + (
+            u[:, 7] * self.group_path_counts[group2]
+        ).astype(np.int64)
+
+        return first, second, is_same
+
+    def sample_pets(self, batch_idx: int, pet_count: int, image_count: int) -> np.ndarray:
+        """
+        Draws a batch of pet_count distinct pets with image_count images
+        each, for losses that mine pairs from all images of a batch. The
+        random numbers come from a Philox generator whose key is derived
+        from both the seed and the batch index, so a batch only depends on
+        its index and consecutive batches draw independent streams.
+        Pets with fewer images than image_count contribute all of them.
+
+        Returns:
+            The indices into image_paths of the images of the batch.
+        """
+        # Not the batch index as counter: the streams of counters b and b + 1
+        # only differ by one block, so neighbouring batches would share pets
+        rng = np.random.Generator(np.random.Philox(np.random.SeedSequence([self.seed, batch_idx])))
+        pets = rng.choice(
+            len(self.pet_path_counts),
+            min(pet_count, len(self.pet_path_counts)),
+            replace=False,
+        )
 
-        return img1, img2, is_same
+        images = []
+        for pet in pets:
+            count = self.pet_path_counts[pet]
+            chosen = rng.choice(count, min(image_count, count), replace=False)
+            images.append(self.pet_path_offsets[pet] + chosen)
+        return np.concatenate(images)
+
+    def _build_index(self):
+        """
+        Flattens the nested paths of the pets into arrays, so pairs can be
+        drawn without any pandas lookups.
+        """
+        image_paths: List[str] = []
+        group_path_counts: List[int] = []
+        pet_group_counts: List[int] = []
+        pet_path_counts: List[int] = []
+        for groups in self.pets["paths"]:
+            group_count = 0
+            path_count = 0
+            for group in groups:
+                # A group may be a single path instead of a list of paths
+                group = [group] if isinstance(group, (str, Path)) else group
+                if len(group) == 0:
+                    continue
+                image_paths.extend(str(path) for path in group)
+                group_path_counts.append(len(group))
+                group_count += 1
+                path_count += len(group)
+            pet_group_counts.append(group_count)
+            pet_path_counts.append(path_count)
+
+        if min(pet_group_counts, default=0) < 2:
+            raise RuntimeError("There is only one image for this pet. Please ensure there are at least 2 images per pet.")
+
+        self.image_paths = np.array(image_paths, dtype=object)
+        self.group_path_counts = np.array(group_path_counts, dtype=np.int64)
+        self.group_path_offsets = np.cumsum(self.group_path_counts) - self.group_path_counts
+        self.pet_group_counts = np.array(pet_group_counts, dtype=np.int64)
+        self.pet_group_offsets = np.cumsum(self.pet_group_counts) - self.pet_group_counts
+        # The images of a pet are stored one after the other
+        self.pet_path_counts = np.array(pet_path_counts, dtype=np.int64)
+        self.pet_path_offsets = np.cumsum(self.pet_path_counts) - self.pet_path_counts
+        # Pet id of every image, as an integer code of the pet_id column
+        pet_codes, _ = pd.factorize(self.pets.index)
+        self.image_pets = np.repeat(pet_codes.astype(np.int64), self.pet_path_counts)
+        # Photo of every image, from the photos column of extract_pets_merge.py:
+        # the augmentations of a crop share its photo. Without it every
+        # image path is its own photo.
+        photo_paths = np.array(self.image_paths, dtype=object)
+        if "photos" in self.pets.columns:
+            photos = np.repeat(self.pets["photos"].to_numpy(), self.pet_path_counts)
+            photo_paths = np.array(
+                [
+                    p.get(path, path) if isinstance(p, dict) else path
+                    for p, path in zip(photos, self.image_paths)
+                ],
+                dtype=object,
+            )
+        photo_codes, _ = pd.factorize(photo_paths.astype(str))
+        self.image_photos = photo_codes.astype(np.int64)
+
+    def distinct_images(self, test=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every image path once, e.g. to embed them all for an evaluation.
+        With test only the images of the pets of the current test fold,
+        every fold_count-th pet like test_index, which needs K-fold.
+
+        Returns:
+            The paths, and the pet and the photo of every path.
+        """
+        _, first = np.unique(self.image_paths.astype(str), return_index=True)
+        first = np.sort(first)
+        if test:
+            if self.fold_count is None or self.fold_count <= 1:
+                raise RuntimeError("no test items in dataset, specify k-fold")
+            first = first[self.image_pets[first] % self.fold_count == self.current_fold]
+        return self.image_paths[first], self.image_pets[first], self.image_photos[first]
+
+    def load_image(self, path: str) -> ImageT:
+        if self.shards is not None and path in self.shards:
+            return self.shards.get_image(path)
+        return Image.open(path).convert("RGB")
+
+    def load_pixels(self, path: str, size: Tuple[int, int]) -> np.ndarray:
+        """Loads an image resized to size (height, width) as a uint8 (H, W, 3) array."""
+        if (
+            self.shards is not None
+            and self.shards.encoding == "raw"
+            and self.shards.image_size == tuple(size)
+            and path in self.shards
+        ):
+            # Already resized, a view into the memory-mapped shard
+            return self.shards.get_array(path)
+
+        if self.image_cache is not None:
+            pixels = self.image_cache.get(path)
+            if pixels is not None and pixels.shape[:2] == tuple(size):
+                return pixels
+
+        image = self.load_image(path)
+        if image.size != (size[1], size[0]):
+            image = image.resize((size[1], size[0]), Image.BILINEAR)
+        pixels = np.asarray(image)
+
+        if self.image_cache is not None:
+            self.image_cache.put(path, pixels)
+        return pixels
+
+    def content_hash(self, path: str) -> Optional[str]:
+        """Hash of the stored image when it is read from shards."""
+        if self.shards is not None and path in self.shards:
+            return self.shards.digest(path)
+        return None
 
     def __getitem__(self, idx: int) -> Tuple[ImageT, ImageT, int]:
+        return self._get_item(self.train_index(idx))
+
+    def train_index(self, idx: int) -> int:
         # To implement K-fold validation, we simply skip every Kth index.
         if self.fold_count is not None and self.fold_count > 1:
             fold_number = self.fold_count - 1
-            idx = idx + int(idx % fold_number >= self.current_fold) + idx // fold_number
+            idx = idx + (idx % fold_number >= self.current_fold) * 1 + idx // fold_number
 
-        return self._get_item(idx)
+        return idx
 
     def get_test_item(self, idx: int) -> Tuple[ImageT, ImageT, int]:
+        return self._get_item(self.test_index(idx))
+
+    def test_index(self, idx: int) -> int:
         if self.fold_count is None or self.fold_count <= 1:
             raise RuntimeError("no test items in dataset, specify k-fold")
 
-        idx = self.current_fold + idx * self.fold_count
-
-        return self._get_item(idx)
+        return self.current_fold + idx * self.fold_count
 
     def next_fold(self):
         self.current_fold = (self.current_fold + 1) % self.fold_count
@@ -215,14 +383,31 @@ class RandomPairDataset(Dataset):
 
         result.save(file_name)
 
+    def iter_paths(self, test=False, chunk_size=1024) -> Iterator[Tuple[str, str, bool]]:
+        index = self.test_index if test else self.train_index
+        for start in range(0, len(self), chunk_size):
+            indices = index(np.arange(start, start + chunk_size, dtype=np.int64))
+            for first, second, is_same in zip(*self.sample_pairs(indices)):
+                yield self.image_paths[first], self.image_paths[second], bool(is_same)
+
     def get_batches(
         self,
         batch_size=8,
         test=False,
-    ) -> Iterator[Tuple[List[ImageT], List[ImageT], List[int]]]:
+        load_images=True,
+    ) -> Iterator[Tuple[List[Any], List[Any], List[int]]]:
+        """
+        Yields batches of pairs, as images or, if load_images is False,
+        as the paths of the images. Pair i is drawn by sample_pairs for the
+        K-fold mapped index i, so the batches are the same as those of
+        get_loader for the same seed.
+        """
         img0s, img1s, labels = [], [], []
 
-        source = self.iter_test_items() if test else self
+        if load_images:
+            source = self.iter_test_items() if test else self
+        else:
+            source = self.iter_paths(test)
 
         for img0, img1, label in source:
             img0s.append(img0)
@@ -232,3 +417,274 @@ class RandomPairDataset(Dataset):
             if len(img0s) == batch_size:
                 yield img0s, img1s, labels
                 img0s, img1s, labels = [], [], []
+
+    def get_image_loader(
+        self,
+        paths: List[str],
+        batch_size=32,
+        load_images=True,
+        image_size: Tuple[int, int] = (384, 384),
+        num_workers=0,
+        prefetch_factor=2,
+        pin_memory=False,
+    ) -> DataLoader:
+        """
+        Returns a DataLoader over the given image paths in batches of
+        batch_size, in order, see ImageBatchDataset.
+        """
+        worker_kwargs: Dict[str, Any] = dict()
+        if num_workers > 0:
+            worker_kwargs = dict(prefetch_factor=prefetch_factor, worker_init_fn=_seed_worker)
+
+        return DataLoader(
+            ImageBatchDataset(self, paths, batch_size, load_images, image_size),
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            **worker_kwargs,
+        )
+
+    def get_loader(
+        self,
+        batch_size=8,
+        test=False,
+        start=0,
+        load_images=True,
+        image_size: Tuple[int, int] = (384, 384),
+        num_workers=0,
+        prefetch_factor=2,
+        pin_memory=False,
+        pet_count=0,
+        images_per_pet=4,
+        rank=0,
+        world_size=1,
+    ) -> DataLoader:
+        """
+        Returns a DataLoader that yields the same batches as get_batches,
+        starting at batch number start, but loads and decodes the images in
+        num_workers background processes. See PairBatchDataset for the
+        contents of a batch.
+
+        With a pet_count the batches hold pet_count pets with images_per_pet
+        images each instead of pairs, see PetBatchDataset.
+
+        In distributed training every one of the world_size ranks gets its
+        own loader, which only yields every world_size-th batch, starting
+        at batch rank, so no two ranks see the same batch.
+        """
+        if pet_count > 0:
+            batches: PairBatchDataset = PetBatchDataset(
+                self, pet_count, images_per_pet, test, start, load_images, image_size,
+                rank, world_size,
+            )
+        else:
+            batches = PairBatchDataset(
+                self, batch_size, test, start, load_images, image_size, rank, world_size
+            )
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+
+        worker_kwargs: Dict[str, Any] = dict()
+        if num_workers > 0:
+            worker_kwargs = dict(prefetch_factor=prefetch_factor, worker_init_fn=_seed_worker)
+
+        return DataLoader(
+            batches,
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            generator=generator,
+            **worker_kwargs,
+        )
+
+
+class PairBatchDataset(Dataset):
+    """
+    The batches of a RandomPairDataset as items of a map-style dataset, so
+    they can be produced by DataLoader workers. Batch idx holds the same
+    pairs as batch start + idx of RandomPairDataset.get_batches: its pair
+    indices go through the K-fold index mapping and are drawn with
+    sample_pairs, whose Philox counter stream makes every pair depend on
+    its index only, not on the worker or the batches before it. With a
+    world_size above 1 it holds batch (start + idx) * world_size + rank,
+    the share of one rank of distributed training.
+
+    Every batch is a dict with:
+        paths: The distinct image paths of the batch.
+        inverse: For each of the 2N images (first sides, then second sides)
+                 the index of its path in paths.
+        labels: A float tensor of shape (N,), 1 for pairs of the same pet.
+        pet_ids: The pet of every path as a long tensor (U,).
+        pixels: The images of paths as a uint8 tensor (U, 3, H, W) in
+                channels-last memory layout, only when load_images is set.
+    """
+
+    def __init__(
+        self,
+        pairs: RandomPairDataset,
+        batch_size: int,
+        test=False,
+        start=0,
+        load_images=True,
+        image_size: Tuple[int, int] = (384, 384),
+        rank=0,
+        world_size=1,
+    ):
+        if not 0 <= rank < world_size:
+            raise ValueError(f"Rank {rank} is not part of a world of size {world_size}")
+
+        self.pairs = pairs
+        self.batch_size = batch_size
+        self.test = test
+        self.start = start
+        self.load_images = load_images
+        self.image_size = tuple(image_size)
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self) -> int:
+        return maxsize // (self.batch_size * self.world_size) - self.start
+
+    def batch_number(self, idx: int) -> int:
+        """The number of item idx in the sequence of batches of all ranks."""
+        return (self.start + idx) * self.world_size + self.rank
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        index = self.pairs.test_index if self.test else self.pairs.train_index
+        first = self.batch_number(idx) * self.batch_size
+        indices = index(np.arange(first, first + self.batch_size, dtype=np.int64))
+        paths1, paths2, is_same = self.pairs.sample_pairs(indices)
+
+        image_paths = self.pairs.image_paths
+        images = np.concatenate([paths1, paths2])
+        paths, inverse = deduplicate(list(image_paths[images]))
+        batch = dict(
+            paths=paths,
+            inverse=inverse,
+            labels=torch.from_numpy(is_same.astype(np.float32)),
+            pet_ids=self._pet_ids(images, inverse, len(paths)),
+        )
+        return self._add_pixels(batch)
+
+    def _pet_ids(self, images: np.ndarray, inverse: torch.Tensor, count: int) -> torch.Tensor:
+        # All images with the same path belong to the same pet
+        pet_ids = np.zeros(count, dtype=np.int64)
+        pet_ids[inverse.numpy()] = self.pairs.image_pets[images]
+        return torch.from_numpy(pet_ids)
+
+    def _add_pixels(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        if self.load_images:
+            # One copy from the (possibly memory-mapped) images into the batch
+            pixels = np.stack(
+                [self.pairs.load_pixels(path, self.image_size) for path in batch["paths"]]
+            )
+            batch["pixels"] = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+        return batch
+
+
+class PetBatchDataset(PairBatchDataset):
+    """
+    Batches of pet_count pets with images_per_pet images each (P x K
+    batches), so that every pet of a batch has positive pairs for losses
+    that mine pairs from all images of the batch. Batch idx is drawn by
+    RandomPairDataset.sample_pets with the K-fold index mapping applied to
+    the batch index.
+
+    Every batch is a dict with:
+        paths: The distinct image paths of the batch.
+        pet_ids: The pet of every path as a long tensor (U,).
+        pixels: The images of paths as a uint8 tensor (U, 3, H, W) in
+                channels-last memory layout, only when load_images is set.
+    """
+
+    def __init__(
+        self,
+        pairs: RandomPairDataset,
+        pet_count: int,
+        images_per_pet: int,
+        test=False,
+        start=0,
+        load_images=True,
+        image_size: Tuple[int, int] = (384, 384),
+        rank=0,
+        world_size=1,
+    ):
+        super().__init__(
+            pairs, pet_count * images_per_pet, test, start, load_images, image_size,
+            rank, world_size,
+        )
+        self.pet_count = pet_count
+        self.images_per_pet = images_per_pet
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        index = self.pairs.test_index if self.test else self.pairs.train_index
+        batch_idx = int(index(self.batch_number(idx)))
+        images = self.pairs.sample_pets(batch_idx, self.pet_count, self.images_per_pet)
+
+        # A path can be listed in more than one group of a pet
+        paths, inverse = deduplicate(list(self.pairs.image_paths[images]))
+        batch = dict(paths=paths, pet_ids=self._pet_ids(images, inverse, len(paths)))
+        return self._add_pixels(batch)
+
+
+class ImageBatchDataset(Dataset):
+    """
+    A list of image paths in batches, to embed every image once. Every
+    batch is a dict with:
+        paths: The image paths of the batch.
+        pixels: The images of paths as a uint8 tensor (B, 3, H, W) in
+                channels-last memory layout, only when load_images is set.
+    """
+
+    def __init__(
+        self,
+        pairs: RandomPairDataset,
+        paths: List[str],
+        batch_size: int,
+        load_images=True,
+        image_size: Tuple[int, int] = (384, 384),
+    ):
+        self.pairs = pairs
+        self.paths = [str(path) for path in paths]
+        self.batch_size = batch_size
+        self.load_images = load_images
+        self.image_size = tuple(image_size)
+
+    def __len__(self) -> int:
+        return ceil(len(self.paths) / self.batch_size)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        paths = self.paths[idx * self.batch_size : (idx + 1) * self.batch_size]
+        batch: Dict[str, Any] = dict(paths=paths)
+        if self.load_images:
+            pixels = np.stack([self.pairs.load_pixels(path, self.image_size) for path in paths])
+            batch["pixels"] = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+        return batch
+
+
+def deduplicate(items: List[Any]) -> Tuple[List[Any], torch.Tensor]:
+    """
+    Returns the distinct items, by path or by object identity for images,
+    and for every item the index of its distinct item.
+    """
+    positions: Dict[Any, int] = {}
+    unique: List[Any] = []
+    inverse: List[int] = []
+    for item in items:
+        key = item if isinstance(item, (str, Path)) else id(item)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(item)
+        inverse.append(positions[key])
+
+    return unique, torch.tensor(inverse, dtype=torch.long)
+
+
+def _seed_worker(worker_id: int):
+    # torch already gives every worker its own seed, derived from the seed
+    # of the loader, use it for the other random generators as well
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
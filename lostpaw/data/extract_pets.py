@@ -1,17 +1,21 @@
-from transformers import DetrFeatureExtractor, DetrForObjectDetection
-from typing import Iterable, List, Optional, Sequence, Tuple, TypeVar
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple, TypeVar
 from pathlib import Path
 from PIL.Image import Image, new as newImage
 import logging
 import torch
 
+if TYPE_CHECKING:
+    from transformers import DetrFeatureExtractor, DetrForObjectDetection
+
 L = TypeVar('L')
+# (x0, y0, x1, y1) in pixels
+Box = Tuple[int, int, int, int]
 
 class DetrPetExtractor:
     def __init__(self, path: Path, device: str = "cpu"):
         self.device = torch.device(device)
-        self.feature_extractor: DetrFeatureExtractor = None
-        self.model: DetrForObjectDetection = None
+        self.feature_extractor: "DetrFeatureExtractor" = None
+        self.model: "DetrForObjectDetection" = None
         self.load_extractor(path)
 
     def extract(
@@ -33,7 +37,36 @@ class DetrPetExtractor:
         Returns:
             List of (cropped_image, label) tuples.
         """
+        return [
+            (img, pet_label)
+            for img, pet_label, _ in self.extract_with_boxes(images, labels, threshold, output_size)
+        ]
+
+    def extract_with_boxes(
+        self,
+        images: Sequence[Image],
+        labels: Iterable[L],
+        threshold: float = 0.9,
+        output_size: Optional[tuple] = None,
+    ) -> List[Tuple[Image, L, Box]]:
+        """
+        Like extract, but also returns the box (x0, y0, x1, y1) in the
+        original image that every pet was cropped from.
+        """
+        cropped_images = []
+
+        for boxes, image, pet_label in zip(self.detect(images, threshold), images, labels):
+            for box in boxes:
+                img_crop = image.crop(box)
+                if output_size:
+                    img_crop = self.resize(img_crop, output_size)
+                cropped_images.append((img_crop, pet_label, box))
+
+        logging.info(f"Found {len(cropped_images)} pets in {len(images)} images.")
+        return cropped_images
 
+    def detect(self, images: Sequence[Image], threshold: float = 0.9) -> List[List[Box]]:
+        """The boxes of the cats and dogs found in every image."""
         inputs = self.feature_extractor(images=images, return_tensors="pt")
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
         self.model.to(self.device)
@@ -46,16 +79,7 @@ class DetrPetExtractor:
         results = self.feature_extractor.post_process_object_detection(
             outputs, target_sizes=target_sizes
         )
-
-        cropped_images = []
-
-        for result, image, pet_label in zip(results, images, labels):
-            imgs = self.parse_result(result, image, threshold, output_size)
-            imgs_with_labels = [(img, pet_label) for img in imgs]
-            cropped_images.extend(imgs_with_labels)
-
-        logging.info(f"Found {len(cropped_images)} pets in {len(images)} images.")
-        return cropped_images
+        return [self.parse_boxes(result, threshold) for result in results]
 
     def parse_result(
         self,
@@ -65,18 +89,23 @@ class DetrPetExtractor:
         output_size: Optional[tuple] = None,
     ):
         imgs = []
+        for box in self.parse_boxes(result, threshold):
+            img_crop = image.crop(box)
+            if output_size:
+                img_crop = self.resize(img_crop, output_size)
+            imgs.append(img_crop)
+
+        return imgs
+
+    def parse_boxes(self, result, threshold: float = 0.9) -> List[Box]:
+        boxes = []
         for score, label, box in zip(
             result["scores"], result["labels"], result["boxes"]
         ):
-            box = [int(x) for x in box]
-
             if score > threshold and (label == 17 or label == 18):
-                img_crop = image.crop(box)
-                if output_size:
-                    img_crop = self.resize(img_crop, output_size)
-                imgs.append(img_crop)
+                boxes.append(tuple(int(x) for x in box))
 
-        return imgs
+        return boxes
 
     def resize(self, image: Image, size):
         width, height = image.size
@@ -96,6 +125,9 @@ class DetrPetExtractor:
         return new_image
 
     def load_extractor(self, path: Path):
+        # transformers takes seconds to import, only do so when needed
+        from transformers import DetrFeatureExtractor, DetrForObjectDetection
+
         model_path = Path(path) / "extractor_model"
         feature_path = Path(path) / "extractor_feature"
         if model_path.exists():
@@ -0,0 +1,134 @@
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Optional, Tuple
+import hashlib
+import logging
+import weakref
+import numpy as np
+
+# Layout of the counters at the start of the metadata block
+_CLOCK, _HITS, _MISSES, _EVICTIONS = range(4)
+
+
+class SharedImageCache:
+    """
+    Byte-budgeted LRU cache of decoded and resized images. All images have
+    the same shape, so the budget is split into fixed slots. The slots and
+    the bookkeeping live in shared memory, so the DataLoader workers of a
+    dataset share one cache (and its hit/miss counters).
+    """
+
+    def __init__(self, max_bytes: int, image_shape: Tuple[int, int, int] = (384, 384, 3)):
+        self.image_shape = tuple(image_shape)
+        self.slot_bytes = int(np.prod(self.image_shape))
+        self.slot_count = max(1, max_bytes // self.slot_bytes)
+
+        self._data = SharedMemory(create=True, size=self.slot_count * self.slot_bytes)
+        # Counters, then the key and the last-used time of every slot
+        self._meta = SharedMemory(create=True, size=8 * (4 + 2 * self.slot_count))
+        self._lock = Lock()
+        # Only the creating process removes the shared memory again
+        self._finalizer = weakref.finalize(self, _unlink, self._data, self._meta)
+        self._attach()
+        self._meta_array[:] = 0
+
+    def _attach(self):
+        self._images = np.ndarray(
+            (self.slot_count, *self.image_shape), dtype=np.uint8, buffer=self._data.buf
+        )
+        self._meta_array = np.ndarray(
+            (4 + 2 * self.slot_count,), dtype=np.int64, buffer=self._meta.buf
+        )
+        self._counters = self._meta_array[:4]
+        self._keys = self._meta_array[4 : 4 + self.slot_count]
+        self._stamps = self._meta_array[4 + self.slot_count :]
+
+    def __getstate__(self):
+        # The shared memory blocks are attached again by name in the workers
+        state = self.__dict__.copy()
+        for name in ["_images", "_meta_array", "_counters", "_keys", "_stamps"]:
+            del state[name]
+        state["_finalizer"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def get(self, path: str) -> Optional[np.ndarray]:
+        """Returns a copy of the cached image, or None on a miss."""
+        key = _key(path)
+        with self._lock:
+            slots = np.flatnonzero(self._keys == key)
+            if len(slots) == 0:
+                self._counters[_MISSES] += 1
+                return None
+
+            self._counters[_CLOCK] += 1
+            self._counters[_HITS] += 1
+            self._stamps[slots[0]] = self._counters[_CLOCK]
+            return self._images[slots[0]].copy()
+
+    def put(self, path: str, image: np.ndarray):
+        """Stores an image, evicting the least recently used one if full."""
+        if tuple(image.shape) != self.image_shape:
+            return
+
+        key = _key(path)
+        with self._lock:
+            if np.any(self._keys == key):
+                return
+
+            # Empty slots have the oldest time stamp (0)
+            slot = int(np.argmin(self._stamps))
+            if self._keys[slot] != 0:
+                self._counters[_EVICTIONS] += 1
+
+            self._counters[_CLOCK] += 1
+            self._keys[slot] = key
+            self._stamps[slot] = self._counters[_CLOCK]
+            self._images[slot] = image
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                hits=int(self._counters[_HITS]),
+                misses=int(self._counters[_MISSES]),
+                evictions=int(self._counters[_EVICTIONS]),
+                size=int(np.count_nonzero(self._keys)),
+                slots=self.slot_count,
+            )
+
+    def log_stats(self):
+        stats = self.stats()
+        total = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / total if total else 0.0
+        logging.info(
+            f"Image cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%} hit rate), "
+            f"{stats['size']}/{stats['slots']} images, {stats['evictions']} evictions"
+        )
+
+    def close(self):
+        """Releases the shared memory, the creating process also removes it."""
+        for name in ["_images", "_meta_array", "_counters", "_keys", "_stamps"]:
+            self.__dict__.pop(name, None)
+        self._data.close()
+        self._meta.close()
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+def _unlink(*blocks: SharedMemory):
+    for block in blocks:
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _key(path: str) -> int:
+    key = int.from_bytes(
+        hashlib.blake2b(str(path).encode(), digest_size=8).digest(), "little", signed=True
+    )
+    # 0 marks an empty slot
+    return key or 1
@@ -0,0 +1,167 @@
+from dataclasses import dataclass
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Iterable, List, Optional, Sequence
+import logging
+
+# Put into the input queue of the first stage after the last item
+DONE = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    outputs: int = 0
+    failures: int = 0
+    # Summed over the workers, seconds spent in the stage function
+    busy: float = 0.0
+
+
+class Stage:
+    """
+    One step of a pipeline: workers threads take items from a bounded
+    input queue, call fn on them and put everything it returns into the
+    queue of the next stage. Bounded queues make a fast stage wait for a
+    slow one instead of piling up items in memory.
+
+    With batch_size > 1 fn gets a list of up to batch_size items, which
+    waits at most max_wait_ms to fill up. After DONE the workers finish
+    and the last one passes DONE on to the next stage.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Iterable[Any]],
+        workers: int = 1,
+        queue_size: int = 64,
+        batch_size: int = 1,
+        max_wait_ms: float = 50.0,
+    ):
+        if workers < 1:
+            raise ValueError("A stage needs at least one worker")
+        self.fn = fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.input: "Queue[Any]" = Queue(queue_size)
+        self.output: "Optional[Queue[Any]]" = None
+        self.stats = StageStats(name, workers)
+        self._lock = Lock()
+        self._running = workers
+        self._threads = [
+            Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self, output: "Optional[Queue[Any]]"):
+        self.output = output
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _next(self) -> Optional[List[Any]]:
+        first = self.input.get()
+        if first is DONE:
+            # Also for the other workers of the stage
+            self.input.put(DONE)
+            return None
+        if self.batch_size == 1:
+            return [first]
+
+        batch = [first]
+        deadline = monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                item = self.input.get(timeout=max(0.0, deadline - monotonic()))
+            except Empty:
+                break
+            if item is DONE:
+                self.input.put(DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            if batch is None:
+                break
+
+            start = monotonic()
+            try:
+                results = list(self.fn(batch if self.batch_size > 1 else batch[0]))
+            except Exception:
+                logging.exception(f"Stage {self.stats.name} failed on {len(batch)} items")
+                results = []
+                with self._lock:
+                    self.stats.failures += len(batch)
+            with self._lock:
+                self.stats.busy += monotonic() - start
+                self.stats.items += len(batch)
+                self.stats.outputs += len(results)
+            if self.output is not None:
+                for result in results:
+                    self.output.put(result)
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            # The DONE put back for the other workers, which are gone now
+            self.input.get_nowait()
+            if self.output is not None:
+                self.output.put(DONE)
+
+
+class Pipeline:
+    """
+    Chains stages, feeds them items and logs the throughput, utilisation
+    and queue depth of every stage every report_seconds. The stage with
+    the highest utilisation is the one holding up the others.
+    """
+
+    def __init__(self, stages: Sequence[Stage], report_seconds: float = 10.0):
+        self.stages = list(stages)
+        self.report_seconds = report_seconds
+        self._started = 0.0
+        self._stop = Event()
+
+    def run(self, items: Iterable[Any]):
+        self._started = monotonic()
+        for stage, next_stage in zip(self.stages, self.stages[1:] + [None]):
+            stage.start(next_stage.input if next_stage is not None else None)
+        reporter = Thread(target=self._report, name="pipeline-report", daemon=True)
+        reporter.start()
+
+        for item in items:
+            self.stages[0].input.put(item)
+        self.stages[0].input.put(DONE)
+        for stage in self.stages:
+            stage.join()
+
+        self._stop.set()
+        reporter.join()
+        self.log_stats()
+
+    def _report(self):
+        while not self._stop.wait(self.report_seconds):
+            self.log_stats()
+
+    def log_stats(self):
+        elapsed = max(monotonic() - self._started, 1e-9)
+        utilisation = {}
+        for stage in self.stages:
+            stats = stage.stats
+            utilisation[stats.name] = stats.busy / (elapsed * stats.workers)
+            logging.info(
+                f"{stats.name:<10} {stats.items:>8} items {stats.items / elapsed:>8.1f}/s "
+                f"{utilisation[stats.name]:>5.0%} busy ({stats.workers} workers), "
+                f"queue {stage.input.qsize()}/{stage.input.maxsize}"
+                + (f", {stats.failures} failed" if stats.failures else "")
+            )
+        logging.info(f"Slowest stage: {max(utilisation, key=utilisation.get)}")
@@ -0,0 +1,66 @@
+import numpy as np
+
+# Constants of Philox4x32-10, see J. K. Salmon, M. A. Moraes, R. O. Dror and
+# D. E. Shaw. Parallel random numbers: as easy as 1, 2, 3. In SC, 2011.
+_MULTIPLIERS = (np.uint64(0xD2511F53), np.uint64(0xCD9E8D57))
+_WEYL = (np.uint32(0x9E3779B9), np.uint32(0xBB67AE85))
+_MASK = np.uint64(0xFFFFFFFF)
+_ROUNDS = 10
+
+
+def philox4x32(counters: np.ndarray, key: np.ndarray) -> np.ndarray:
+    """
+    Vectorised Philox4x32-10 block function.
+
+    Args:
+        counters: A uint32 array of shape (N, 4), one counter per row.
+        key: A uint32 array of shape (2,).
+
+    Returns:
+        A uint32 array of shape (N, 4) with the random bits of every counter.
+    """
+    c0, c1, c2, c3 = (counters[:, i].astype(np.uint32) for i in range(4))
+    k0, k1 = np.uint32(key[0]), np.uint32(key[1])
+
+    with np.errstate(over="ignore"):
+        for round in range(_ROUNDS):
+            product0 = c0.astype(np.uint64) * _MULTIPLIERS[0]
+            product1 = c2.astype(np.uint64) * _MULTIPLIERS[1]
+            hi0 = (product0 >> np.uint64(32)).astype(np.uint32)
+            lo0 = (product0 & _MASK).astype(np.uint32)
+            hi1 = (product1 >> np.uint64(32)).astype(np.uint32)
+            lo1 = (product1 & _MASK).astype(np.uint32)
+
+            c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+
+            if round < _ROUNDS - 1:
+                k0 = k0 + _WEYL[0]
+                k1 = k1 + _WEYL[1]
+
+    return np.stack([c0, c1, c2, c3], axis=1)
+
+
+def counter_uniforms(indices: np.ndarray, seed: int, count: int = 8) -> np.ndarray:
+    """
+    Draws count uniform numbers in [0, 1) for every index, from a Philox
+    stream keyed by seed with the index as counter. The numbers of an index
+    do not depend on the other indices, so any batch of indices can be
+    drawn in one call and still give the same result per index.
+
+    Returns:
+        A float64 array of shape (N, count).
+    """
+    indices = np.asarray(indices, dtype=np.uint64).reshape(-1)
+    seed = int(seed) & 0xFFFFFFFFFFFFFFFF
+    key = np.array([seed & 0xFFFFFFFF, seed >> 32], dtype=np.uint32)
+
+    blocks = []
+    for block in range((count + 3) // 4):
+        counters = np.zeros((len(indices), 4), dtype=np.uint32)
+        counters[:, 0] = (indices & _MASK).astype(np.uint32)
+        counters[:, 1] = (indices >> np.uint64(32)).astype(np.uint32)
+        counters[:, 2] = block
+        blocks.append(philox4x32(counters, key))
+
+    bits = np.concatenate(blocks, axis=1)[:, :count]
+    return bits * 2.0**-32
@@ -0,0 +1,179 @@
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, IO, Iterator, List, Optional, Tuple, Union
+import hashlib
+import json
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageT
+
+ENCODINGS = ["raw", "jpeg"]
+
+
+class ShardWriter:
+    """
+    Packs many images into a few large shard files plus one offset index,
+    so reading a dataset does not have to open a file per image.
+
+    With the raw encoding the images are resized to image_size and stored
+    as uint8 (H, W, 3) arrays, which the reader returns without copying or
+    decoding. With the jpeg encoding the (optionally resized) images are
+    stored as JPEG bytes.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        image_size: Optional[Tuple[int, int]] = (384, 384),
+        encoding: str = "raw",
+        shard_size: int = 1 << 30,
+        quality: int = 95,
+    ):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Encoding {encoding} not supported")
+        if encoding == "raw" and image_size is None:
+            raise ValueError("The raw encoding needs an image size")
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.image_size = tuple(image_size) if image_size else None
+        self.encoding = encoding
+        self.shard_size = shard_size
+        self.quality = quality
+
+        self.keys: List[str] = []
+        self.records: List[Tuple[int, int, int, int, int]] = []
+        self.digests: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._shard: Optional[IO[bytes]] = None
+        self._shard_number = -1
+        self._offset = 0
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, key: str, image: Union[ImageT, Path, str]):
+        """Adds an image (or the image at a path) under the given key."""
+        if key in self._positions:
+            return
+        if not isinstance(image, ImageT):
+            image = Image.open(image).convert("RGB")
+        if self.image_size and image.size != (self.image_size[1], self.image_size[0]):
+            image = image.resize((self.image_size[1], self.image_size[0]), Image.BILINEAR)
+
+        if self.encoding == "raw":
+            data = np.asarray(image, dtype=np.uint8).tobytes()
+        else:
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=self.quality)
+            data = buffer.getvalue()
+
+        if self._shard is None or self._offset + len(data) > self.shard_size:
+            self._next_shard()
+
+        self._shard.write(data)
+        self._positions[key] = len(self.keys)
+        self.keys.append(key)
+        self.records.append(
+            (self._shard_number, self._offset, len(data), image.height, image.width)
+        )
+        self.digests.append(hashlib.sha1(data).hexdigest())
+        self._offset += len(data)
+
+    def _next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_number += 1
+        self._offset = 0
+        self._shard = open(self.folder / shard_name(self._shard_number), "wb")
+
+    def close(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+        records = np.array(self.records, dtype=np.int64).reshape(-1, 5)
+        np.savez(
+            self.folder / "index.npz",
+            keys=np.array(self.keys, dtype=str),
+            digests=np.array(self.digests, dtype=str),
+            records=records,
+        )
+        with open(self.folder / "shards.json", "w") as f:
+            json.dump(
+                dict(
+                    encoding=self.encoding,
+                    image_size=self.image_size,
+                    shard_count=self._shard_number + 1,
+                    image_count=len(self.keys),
+                ),
+                f,
+            )
+
+
+class ShardReader:
+    """
+    Reads images from the shards of a ShardWriter. The shard files are
+    memory-mapped, raw images are returned as read-only views into them.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        with open(self.folder / "shards.json", "r") as f:
+            info = json.load(f)
+        self.encoding: str = info["encoding"]
+        self.image_size = tuple(info["image_size"]) if info["image_size"] else None
+
+        index = np.load(self.folder / "index.npz")
+        self.records: np.ndarray = index["records"]
+        self.digests: np.ndarray = index["digests"]
+        self._positions = {str(key): i for i, key in enumerate(index["keys"])}
+        self._maps: Dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def __getstate__(self):
+        # Every (worker) process maps the shard files itself
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def digest(self, key: str) -> str:
+        """SHA-1 of the stored bytes of the image."""
+        return str(self.digests[self._positions[str(key)]])
+
+    def get_bytes(self, key: str) -> np.ndarray:
+        shard, offset, length, _, _ = self.records[self._positions[str(key)]]
+        shard_map = self._maps.get(shard)
+        if shard_map is None:
+            shard_map = np.memmap(
+                self.folder / shard_name(shard), dtype=np.uint8, mode="r"
+            )
+            self._maps[shard] = shard_map
+        return shard_map[offset : offset + length]
+
+    def get_array(self, key: str) -> np.ndarray:
+        """Returns the image as a uint8 (H, W, 3) array, a view for raw shards."""
+        if self.encoding == "raw":
+            _, _, _, height, width = self.records[self._positions[str(key)]]
+            return self.get_bytes(key).reshape(height, width, 3)
+        return np.asarray(self.get_image(key))
+
+    def get_image(self, key: str) -> ImageT:
+        if self.encoding == "raw":
+            return Image.fromarray(self.get_array(key))
+        return Image.open(BytesIO(self.get_bytes(key))).convert("RGB")
+
+
+def shard_name(number: int) -> str:
+    return f"shard_{number:05d}.bin"
@@ -1,4 +1,37 @@
-from .model import PetViTContrastiveModel
-from .loss import PetContrastiveLoss
+from importlib import import_module
+from typing import TYPE_CHECKING, Any, List
 
-__all__ = ["PetViTContrastiveModel", "PetContrastiveLoss"]
+# The submodules are only imported when one of their names is first used,
+# so that e.g. importing the heads does not pull in transformers
+_EXPORTS = {
+    "PetViTContrastiveModel": ".model",
+    "PetContrastiveLoss": ".loss",
+    "ViTFeatureCache": ".feature_cache",
+    "ImagePreprocessor": ".preprocess",
+    "ProjectionHead": ".heads",
+    "build_head": ".heads",
+    "EvaluationReport": ".evaluation",
+    "evaluate_embeddings": ".evaluation",
+}
+
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from .model import PetViTContrastiveModel
+    from .loss import PetContrastiveLoss
+    from .feature_cache import ViTFeatureCache
+    from .preprocess import ImagePreprocessor
+    from .heads import ProjectionHead, build_head
+    from .evaluation import EvaluationReport, evaluate_embeddings
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
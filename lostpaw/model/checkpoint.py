@@ -0,0 +1,269 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from time import perf_counter
+import hashlib
+import json
+import logging
+import os
+import torch
+from torch import Tensor
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+CHECKPOINT_FORMATS = ["safetensors", "torch"]
+KEEP_STRATEGIES = ["recent", "best"]
+FORMAT_VERSION = "1"
+
+
+def atomic_write(path: Path, write: Callable[[Path], None]):
+    """
+    Calls write with a temporary path next to path and renames the result
+    to path, so readers never see a partial file and a file that is still
+    memory-mapped is replaced instead of overwritten. The file and the
+    rename are synced to disk before returning.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        write(tmp_path)
+        _fsync(tmp_path)
+        os.replace(tmp_path, path)
+        _fsync(path.parent)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _fsync(path: Path):
+    flags = os.O_RDONLY
+    if path.is_dir():
+        flags |= getattr(os, "O_DIRECTORY", 0)
+    try:
+        fd = os.open(path, flags)
+    except OSError:
+        # Directories cannot be opened on every platform
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def tensors_hash(tensors: Iterable[Tuple[str, Tensor]]) -> str:
+    """Content hash of named tensors, independent of their device."""
+    digest = hashlib.sha256()
+    for name, tensor in tensors:
+        digest.update(name.encode())
+        flat = tensor.detach().to("cpu").contiguous().view(-1)
+        digest.update(flat.view(torch.uint8).numpy())
+    return digest.hexdigest()
+
+
+def save_checkpoint(
+    state: Dict[str, Tensor],
+    path: Path,
+    reference_hash: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+):
+    """
+    Writes tensors as a safetensors file. When the state does not hold all
+    weights of the model, reference_hash is the content hash of the missing
+    ones, so loading can check it got the same weights from elsewhere.
+    """
+    header = {str(k): str(v) for k, v in (metadata or {}).items()}
+    header["format_version"] = FORMAT_VERSION
+    if reference_hash is not None:
+        header["reference_hash"] = reference_hash
+
+    # safetensors needs contiguous CPU tensors
+    tensors = {name: t.detach().to("cpu").contiguous() for name, t in state.items()}
+    atomic_write(path, lambda tmp_path: save_file(tensors, str(tmp_path), header))
+
+
+def load_checkpoint(path: Path, device="cpu") -> Tuple[Dict[str, Tensor], Dict[str, str]]:
+    """
+    Reads a safetensors checkpoint. On the CPU the tensors are backed by the
+    memory-mapped file and not copied.
+    """
+    device = str(device)
+    state: Dict[str, Tensor] = {}
+    with safe_open(str(path), framework="pt", device=device) as f:
+        metadata = f.metadata() or {}
+        for name in f.keys():
+            state[name] = f.get_tensor(name)
+    return state, metadata
+
+
+def shard_path(path: Path, shard: str) -> Path:
+    """A shard (e.g. optimizer) that belongs to the checkpoint at path."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{shard}.pt")
+
+
+def optimizer_path(path: Path) -> Path:
+    return shard_path(path, "optimizer")
+
+
+def training_state_path(path: Path) -> Path:
+    return shard_path(path, "state")
+
+
+def save_state(state: Dict[str, Any], path: Path):
+    atomic_write(path, lambda tmp_path: torch.save(state, tmp_path))
+
+
+def save_optimizer(optimizer: torch.optim.Optimizer, path: Path):
+    save_state(optimizer.state_dict(), path)
+
+
+def load_optimizer(optimizer: torch.optim.Optimizer, path: Path, device="cpu") -> bool:
+    if not Path(path).exists():
+        return False
+    state = torch.load(path, map_location=device, weights_only=True)
+    optimizer.load_state_dict(state)
+    return True
+
+
+def keep_checkpoints(path: Path, epoch: int, score: Optional[float], keep: int, by: str = "recent"):
+    """
+    Keeps a copy of the checkpoint at path for the given epoch, and deletes
+    the copies of other epochs beyond the keep most recent ones (or the
+    keep ones with the best score). The copies are hard links where the
+    file system allows it, so keeping them costs no extra write.
+    """
+    if by not in KEEP_STRATEGIES:
+        raise ValueError(f"Keep strategy {by} not supported")
+
+    path = Path(path)
+    copy_path = path.with_name(f"{path.stem}-epoch{epoch:04d}{path.suffix}")
+    if copy_path.exists():
+        copy_path.unlink()
+    try:
+        os.link(path, copy_path)
+    except OSError:
+        atomic_write(copy_path, lambda tmp_path: tmp_path.write_bytes(path.read_bytes()))
+
+    index_path = path.with_name(f"{path.stem}.checkpoints.json")
+    index: Dict[str, Optional[float]] = {}
+    if index_path.exists():
+        index = json.loads(index_path.read_text())
+    index[copy_path.name] = None if score is None else float(score)
+
+    def rank(item: Tuple[str, Optional[float]]) -> Any:
+        name, score = item
+        if by == "best":
+            # Checkpoints without a score rank last, ties by recency
+            return (score is not None, score or 0.0, name)
+        return name
+
+    kept = dict(sorted(index.items(), key=rank, reverse=True)[:keep])
+    for name in index.keys() - kept.keys():
+        (path.parent / name).unlink(missing_ok=True)
+    atomic_write(index_path, lambda tmp_path: tmp_path.write_text(json.dumps(kept, indent=2)))
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints in a background thread, so saving does not block
+    training. Tensors are first copied (see snapshot) into CPU buffers,
+    pinned when CUDA is used, which are reused by later snapshots once
+    their checkpoint is written. Jobs run one after the other, in order.
+
+    At most one job waits besides the one being written, call flush before
+    taking a snapshot to keep only one copy of the state around. A failed
+    write is raised by the next submit or flush.
+    """
+
+    def __init__(self):
+        self._jobs: "Queue[Optional[Tuple[str, Callable[[], Optional[int]], List[Tensor], float]]]" = Queue(1)
+        self._errors: List[BaseException] = []
+        self._pin = torch.cuda.is_available()
+        self._free: Dict[Tuple[Any, ...], List[Tensor]] = {}
+        self._lock = Lock()
+        self.latencies: List[float] = []
+        self._thread = Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def _buffer(self, tensor: Tensor) -> Tensor:
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+        return torch.empty(key[0], dtype=key[1], pin_memory=self._pin)
+
+    def _release(self, buffers: List[Tensor]):
+        with self._lock:
+            for buffer in buffers:
+                self._free.setdefault((tuple(buffer.shape), buffer.dtype), []).append(buffer)
+
+    def snapshot(self, value: Any, buffers: Optional[List[Tensor]] = None) -> Any:
+        """
+        Copy of a (nested) state dict with every tensor copied into a CPU
+        buffer, so it can be written while training changes the original.
+        The buffers used are appended to buffers, pass them to submit.
+        """
+        if isinstance(value, Tensor):
+            buffer = self._buffer(value)
+            buffer.copy_(value.detach(), non_blocking=self._pin and value.is_cuda)
+            if buffers is not None:
+                buffers.append(buffer)
+            return buffer
+        if isinstance(value, dict):
+            return {k: self.snapshot(v, buffers) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.snapshot(v, buffers) for v in value)
+        return value
+
+    def submit(self, name: str, write: Callable[[], None], buffers: Optional[List[Tensor]] = None):
+        """
+        Runs write in the background, the buffers are reused afterwards.
+        Raises the failure of an earlier write instead of going on without
+        checkpoints.
+        """
+        if self._errors:
+            self._release(buffers or [])
+            self._raise_errors()
+        if self._pin:
+            # The non-blocking copies of the snapshot have to be complete
+            torch.cuda.synchronize()
+        self._jobs.put((name, write, buffers or [], perf_counter()))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                name, write, buffers, submitted = job
+                start = perf_counter()
+                write()
+                done = perf_counter()
+                self.latencies.append(done - submitted)
+                logging.info(
+                    f"Wrote {name} in {done - start:.2f}s ({done - submitted:.2f}s after saving)"
+                )
+            except BaseException as e:
+                logging.error(f"Writing {job[0] if job else 'checkpoint'} failed: {e}")
+                self._errors.append(e)
+            finally:
+                if job is not None:
+                    self._release(job[2])
+                self._jobs.task_done()
+
+    def flush(self):
+        """Waits until everything submitted is on disk, re-raises failures."""
+        self._jobs.join()
+        self._raise_errors()
+
+    def _raise_errors(self):
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def close(self):
+        self.flush()
+        self._jobs.put(None)
+        self._thread.join()
@@ -0,0 +1,156 @@
+from typing import Any, Iterable, List, Tuple
+import logging
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch import Tensor
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+DISTRIBUTED_BACKENDS = ["gloo", "nccl"]
+
+
+def init_distributed(backend: str = "gloo") -> Tuple[int, int]:
+    """
+    Joins the process group of a run started with torchrun, which sets
+    RANK, WORLD_SIZE and the rendezvous address in the environment. Without
+    torchrun (or with a single process) nothing is initialised.
+
+    Returns:
+        The rank of this process and the number of processes.
+    """
+    if backend not in DISTRIBUTED_BACKENDS:
+        raise ValueError(f"Distributed backend {backend} not supported")
+
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend, init_method="env://")
+        logging.info(f"Joined {backend} process group as rank {get_rank()} of {world_size}")
+    return get_rank(), get_world_size()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    # Before the process group is joined, e.g. to configure logging
+    return int(os.environ.get("RANK", 0))
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def local_device() -> torch.device:
+    """The device of this process: its own GPU under torchrun, else the CPU."""
+    if not torch.cuda.is_available():
+        return torch.device("cpu")
+    return torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+
+
+def _collective_device() -> torch.device:
+    # gloo reduces CPU tensors, nccl only GPU tensors
+    return local_device() if dist.get_backend() == "nccl" else torch.device("cpu")
+
+
+def broadcast_object(value: Any, src: int = 0) -> Any:
+    """The value of rank src on every rank."""
+    if not is_distributed():
+        return value
+    values = [value]
+    dist.broadcast_object_list(values, src=src)
+    return values[0]
+
+
+def broadcast_parameters(module: torch.nn.Module, src: int = 0):
+    """Copies the parameters and buffers of rank src to all other ranks."""
+    if not is_distributed():
+        return
+    device = _collective_device()
+    for tensor in module.state_dict().values():
+        if tensor.is_meta:
+            continue
+        buffer = tensor.detach().to(device)
+        dist.broadcast(buffer, src=src)
+        tensor.copy_(buffer)
+
+
+def all_reduce_mean(values: np.ndarray) -> np.ndarray:
+    """The mean of values over all ranks, e.g. of the metrics of a rank."""
+    if not is_distributed():
+        return values
+    tensor = torch.as_tensor(np.asarray(values, dtype=np.float64), device=_collective_device())
+    dist.all_reduce(tensor)
+    return (tensor / get_world_size()).cpu().numpy()
+
+
+def all_reduce_gradients(parameters: Iterable[torch.nn.Parameter]):
+    """
+    Averages the gradients of the parameters over all ranks. All gradients
+    are reduced in a single flat buffer, so there is one collective call
+    per step instead of one per parameter.
+    """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+
+    device = _collective_device()
+    for dtype in {g.dtype for g in grads}:
+        group = [g for g in grads if g.dtype == dtype]
+        flat = _flatten_dense_tensors(group).to(device)
+        dist.all_reduce(flat)
+        flat /= get_world_size()
+        for grad, reduced in zip(group, _unflatten_dense_tensors(flat, group)):
+            grad.copy_(reduced)
+
+
+def gather_embeddings(embeddings: Tensor, pet_ids: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    Concatenates the embeddings and pet ids of the batches of all ranks, so
+    pairs can be mined across the whole global batch. Ranks may have
+    different numbers of images. Gradients only flow into the embeddings of
+    this rank; the gradients of the other ranks reach their own copies of
+    the model and are combined by all_reduce_gradients.
+    """
+    if not is_distributed():
+        return embeddings, pet_ids
+
+    device = _collective_device()
+    world_size = get_world_size()
+    count = torch.tensor([len(embeddings)], device=device)
+    counts = [torch.zeros_like(count) for _ in range(world_size)]
+    dist.all_gather(counts, count)
+    sizes: List[int] = [int(c.item()) for c in counts]
+    longest = max(sizes)
+
+    # all_gather needs tensors of the same shape on every rank
+    def gather(tensor: Tensor) -> List[Tensor]:
+        padded = torch.zeros((longest, *tensor.shape[1:]), dtype=tensor.dtype, device=device)
+        padded[: len(tensor)] = tensor.detach().to(device)
+        parts = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(parts, padded)
+        return [part[:size].to(tensor.device) for part, size in zip(parts, sizes)]
+
+    embedding_parts = gather(embeddings)
+    embedding_parts[get_rank()] = embeddings
+    pet_id_parts = gather(pet_ids)
+    return torch.cat(embedding_parts), torch.cat(pet_id_parts)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,231 @@
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from pathlib import Path
+import numpy as np
+import torch
+from torch import Tensor
+
+
+@dataclass
+class EvaluationReport:
+    """
+    Metrics of all pairs of a set of embeddings, see evaluate_embeddings.
+
+    The curves are sampled at the upper edges of equally wide distance
+    bins: false_match_rate[i] is the fraction of pairs of different pets
+    with a distance of at most thresholds[i], false_non_match_rate[i] the
+    fraction of pairs of the same pet with a larger distance. Plotted
+    against each other they give the DET curve, 1 - false_non_match_rate
+    against false_match_rate the ROC curve.
+    """
+
+    thresholds: np.ndarray
+    false_match_rate: np.ndarray
+    false_non_match_rate: np.ndarray
+    positives: int
+    negatives: int
+    eer: float
+    eer_threshold: float
+    # Fraction of the queries with a same pet image among their k nearest
+    top_k: Dict[int, float]
+    queries: int
+    same_probability: float = 0.5
+    # (false match rate, false non-match rate) counted exactly at a threshold
+    exact: Dict[float, Tuple[float, float]] = field(default_factory=dict)
+
+    def rates(self, threshold: float) -> Tuple[float, float]:
+        """
+        The false match and false non-match rate at a threshold, exact for
+        the thresholds of the evaluation, otherwise interpolated between
+        the bin edges.
+        """
+        if threshold in self.exact:
+            return self.exact[threshold]
+        fmr = np.interp(threshold, self.thresholds, self.false_match_rate, left=0.0, right=1.0)
+        fnmr = np.interp(
+            threshold, self.thresholds, self.false_non_match_rate, left=1.0, right=0.0
+        )
+        return float(fmr), float(fnmr)
+
+    def metrics(self, threshold: float) -> Dict[str, float]:
+        """
+        The metrics of Trainer.compute_metrics at a threshold. They are
+        weighted as if the pairs were sampled with same_probability pairs of
+        the same pet, so they compare to the metrics logged in training.
+        """
+        fmr, fnmr = self.rates(threshold)
+        p = self.same_probability
+        return dict(
+            diff=(1 - p) * (1 - fmr),
+            err1=(1 - p) * fmr,
+            err2=p * fnmr,
+            same=p * (1 - fnmr),
+            accuracy=1 - ((1 - p) * fmr + p * fnmr),
+            false_match_rate=fmr,
+            false_non_match_rate=fnmr,
+        )
+
+    def summary(self, margin: float) -> Dict[str, float]:
+        result = dict(
+            positives=self.positives,
+            negatives=self.negatives,
+            eer=self.eer,
+            eer_threshold=self.eer_threshold,
+            queries=self.queries,
+            **self.metrics(margin),
+        )
+        for k, accuracy in self.top_k.items():
+            result[f"top_{k}"] = accuracy
+        return result
+
+    def save_curve(self, path: Path):
+        """Writes the DET/ROC curve as CSV: threshold, false match and non-match rate."""
+        curve = np.stack([self.thresholds, self.false_match_rate, self.false_non_match_rate], 1)
+        np.savetxt(
+            path,
+            curve,
+            delimiter=",",
+            header="threshold,false_match_rate,false_non_match_rate",
+            comments="",
+        )
+
+
+def evaluate_embeddings(
+    embeddings: Tensor,
+    pet_ids: Tensor,
+    photo_ids: Optional[Tensor] = None,
+    thresholds: Iterable[float] = (),
+    top_k: Sequence[int] = (1, 5, 10),
+    same_probability: float = 0.5,
+    bins: int = 1 << 14,
+    chunk_size: int = 256,
+    eps: float = 1e-8,
+) -> EvaluationReport:
+    """
+    Evaluates all pairs of embeddings in a single pass over the distance
+    matrix, which is computed chunk_size rows at a time, so memory grows
+    with chunk_size x N instead of N x N. Pairs of images of the same photo,
+    e.g. augmentations of one crop, are neither counted as pairs nor
+    retrieved, they would be trivially close.
+
+    Args:
+        embeddings: A tensor of shape (N, D), e.g. of the test pets.
+        pet_ids: The pet of every embedding (N,).
+        photo_ids: The photo of every embedding (N,), defaults to every
+                   embedding being its own photo.
+        thresholds: Distances at which the rates are counted exactly, e.g.
+                    the contrastive margin.
+        top_k: The k of the retrieval accuracies.
+        same_probability: Weight of the pairs of the same pet, see
+                          EvaluationReport.metrics.
+        bins: Number of distance bins of the curves.
+    """
+    device = embeddings.device
+    embeddings = embeddings.float()
+    count = len(embeddings)
+    pet_ids = torch.as_tensor(pet_ids, device=device)
+    if photo_ids is None:
+        photo_ids = torch.arange(count, device=device)
+    photo_ids = torch.as_tensor(photo_ids, device=device)
+
+    squared = embeddings.pow(2).sum(1)
+    # No distance is larger than twice the largest norm
+    max_distance = 2 * float(squared.max().sqrt()) + eps if count else 1.0
+    bin_width = max_distance / bins
+    thresholds = sorted(set(float(t) for t in thresholds))
+    top_k = sorted(set(min(k, max(count - 1, 1)) for k in top_k))
+
+    positive_hist = torch.zeros(bins, dtype=torch.long, device=device)
+    negative_hist = torch.zeros(bins, dtype=torch.long, device=device)
+    positive_below = torch.zeros(len(thresholds), dtype=torch.long, device=device)
+    negative_below = torch.zeros(len(thresholds), dtype=torch.long, device=device)
+    exact_thresholds = torch.tensor(thresholds, device=device)
+    hits = torch.zeros(len(top_k), dtype=torch.long, device=device)
+    queries = 0
+    columns = torch.arange(count, device=device)
+
+    for start in range(0, count, chunk_size):
+        rows = columns[start : start + chunk_size]
+        squared_distance = squared[rows, None] - 2 * embeddings[rows] @ embeddings.T + squared[None, :]
+        distances = torch.sqrt(torch.clamp(squared_distance, min=0.0) + eps)
+
+        # Pairs of other photos, of the same pet or not
+        valid = photo_ids[rows, None] != photo_ids[None, :]
+        same = pet_ids[rows, None] == pet_ids[None, :]
+
+        # Every pair once, for the curves
+        pairs = valid & (columns[None, :] > rows[:, None])
+        positive = distances[pairs & same]
+        negative = distances[pairs & ~same]
+        positive_hist += _histogram(positive, bin_width, bins)
+        negative_hist += _histogram(negative, bin_width, bins)
+        if thresholds:
+            positive_below += (positive[:, None] <= exact_thresholds).sum(0)
+            negative_below += (negative[:, None] <= exact_thresholds).sum(0)
+
+        # Retrieval: the nearest images of other photos of every query
+        if top_k:
+            has_positive = (valid & same).any(1)
+            nearest = distances.masked_fill(~valid, float("inf")).topk(
+                top_k[-1], dim=1, largest=False
+            )
+            found = same.gather(1, nearest.indices) & torch.isfinite(nearest.values)
+            for i, k in enumerate(top_k):
+                hits[i] += (found[:, :k].any(1) & has_positive).sum()
+            queries += int(has_positive.sum())
+
+    positives = int(positive_hist.sum())
+    negatives = int(negative_hist.sum())
+    edges = (np.arange(bins) + 1) * bin_width
+    false_match_rate = _fraction(np.cumsum(negative_hist.cpu().numpy()), negatives)
+    false_non_match_rate = 1 - _fraction(np.cumsum(positive_hist.cpu().numpy()), positives)
+    eer, eer_threshold = _equal_error_rate(edges, false_match_rate, false_non_match_rate)
+
+    exact = {
+        t: (
+            float(_fraction(negative_below[i].item(), negatives)),
+            float(1 - _fraction(positive_below[i].item(), positives)),
+        )
+        for i, t in enumerate(thresholds)
+    }
+    return EvaluationReport(
+        thresholds=edges,
+        false_match_rate=false_match_rate,
+        false_non_match_rate=false_non_match_rate,
+        positives=positives,
+        negatives=negatives,
+        eer=eer,
+        eer_threshold=eer_threshold,
+        top_k={k: float(_fraction(hits[i].item(), queries)) for i, k in enumerate(top_k)},
+        queries=queries,
+        same_probability=same_probability,
+        exact=exact,
+    )
+
+
+def _histogram(distances: Tensor, bin_width: float, bins: int) -> Tensor:
+    index = (distances / bin_width).long().clamp_(0, bins - 1)
+    return torch.bincount(index, minlength=bins)
+
+
+def _fraction(count, total: int) -> np.ndarray:
+    count = np.asarray(count, dtype=np.float64)
+    return count / total if total else np.full_like(count, np.nan)
+
+
+def _equal_error_rate(
+    thresholds: np.ndarray, fmr: np.ndarray, fnmr: np.ndarray
+) -> Tuple[float, float]:
+    """Where the false match rate (rising) crosses the false non-match rate (falling)."""
+    if np.isnan(fmr).any() or np.isnan(fnmr).any():
+        return float("nan"), float("nan")
+    difference = fmr - fnmr
+    i = int(np.argmax(difference >= 0))
+    if i == 0:
+        return float((fmr[0] + fnmr[0]) / 2), float(thresholds[0])
+
+    # Linear interpolation between the bin edges around the crossing
+    weight = -difference[i - 1] / (difference[i] - difference[i - 1])
+    threshold = thresholds[i - 1] + weight * (thresholds[i] - thresholds[i - 1])
+    eer = fmr[i - 1] + weight * (fmr[i] - fmr[i - 1])
+    return float(eer), float(threshold)
@@ -0,0 +1,111 @@
+from typing import Any, Dict
+from pathlib import Path
+import json
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from lostpaw.model.model import PetViTContrastiveModel
+from lostpaw.model.preprocess import ImagePreprocessor
+
+EXPORT_FORMATS = ["torchscript", "onnx"]
+METADATA_KEY = "lostpaw.json"
+# The input contract of every exported model, see EmbeddingModule
+INPUT_LAYOUT = "uint8 RGB (N, 3, H, W), H x W = image_size"
+
+
+class EmbeddingModule(nn.Module):
+    """
+    Preprocessing, ViT backbone and projection head as one module that maps
+    a uint8 image batch (N, 3, H, W) to embeddings (N, output_dim), so it
+    can be traced into a single self-contained graph.
+    """
+
+    def __init__(self, preprocess: ImagePreprocessor, vit_model: nn.Module, head: nn.Module):
+        super(EmbeddingModule, self).__init__()
+        self.preprocess = preprocess
+        self.vit_model = vit_model
+        self.head = head
+
+    @classmethod
+    def from_model(cls, model: PetViTContrastiveModel) -> "EmbeddingModule":
+        return cls(model.preprocess, model.vit_model, model.latent_space).eval()
+
+    def encode(self, pixels: Tensor) -> Tensor:
+        return self.vit_model(pixel_values=self.preprocess(pixels), return_dict=False)[0]
+
+    def forward(self, pixels: Tensor) -> Tensor:
+        return self.head(self.encode(pixels))
+
+
+def export_metadata(model: PetViTContrastiveModel, **extra: Any) -> Dict[str, Any]:
+    """
+    Everything a runtime needs to feed an exported model: the input layout,
+    the image size and (for reference) the normalisation that is baked in.
+    """
+    preprocess = model.preprocess
+    return dict(
+        input_layout=INPUT_LAYOUT,
+        image_size=list(preprocess.size),
+        mean=preprocess.mean.flatten().tolist(),
+        std=preprocess.std.flatten().tolist(),
+        output_dim=model.output_dim,
+        head=model.latent_space.name,
+        backbone_hash=model.backbone_hash(),
+        **extra,
+    )
+
+
+def export_model(
+    module: nn.Module,
+    path: Path,
+    metadata: Dict[str, Any],
+    format: str = "torchscript",
+    batch_size: int = 2,
+):
+    """
+    Traces the module (usually an EmbeddingModule) into TorchScript or ONNX
+    and stores the metadata inside the file, so it can be loaded without
+    the model code or transformers, see lostpaw.serving.runtime.
+
+    The module is traced with images of exactly image_size, so resizing is
+    not part of the graph and has to be done by the caller. The batch
+    dimension stays dynamic.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Export format {format} not supported")
+
+    height, width = metadata["image_size"]
+    example = torch.randint(0, 256, (batch_size, 3, height, width), dtype=torch.uint8)
+    module = module.to("cpu").eval()
+
+    if format == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example, check_trace=False)
+        torch.jit.save(traced, str(path), _extra_files={METADATA_KEY: json.dumps(metadata)})
+    else:
+        _export_onnx(module, path, metadata, example)
+
+
+def _export_onnx(module: nn.Module, path: Path, metadata: Dict[str, Any], example: Tensor):
+    # Only needed for exporting, serving just needs onnxruntime
+    import onnx
+
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            (example,),
+            str(path),
+            input_names=["pixels"],
+            output_names=["embeddings"],
+            dynamic_axes=dict(pixels={0: "batch"}, embeddings={0: "batch"}),
+            opset_version=17,
+            dynamo=False,
+        )
+
+    proto = onnx.load(str(path))
+    entry = proto.metadata_props.add()
+    entry.key = METADATA_KEY
+    entry.value = json.dumps(metadata)
+    onnx.save(proto, str(path))
+
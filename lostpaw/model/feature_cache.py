@@ -0,0 +1,124 @@
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from pathlib import Path
+import hashlib
+import logging
+import os
+import numpy as np
+import torch
+from torch import Tensor
+
+POOLINGS = ["tokens", "cls", "mean"]
+
+
+def pool_tokens(hidden: Tensor, pooling: str) -> Tensor:
+    """
+    Reduces ViT hidden states of shape [N, T, H] to the form that is stored
+    in the cache: all tokens, only the CLS token or the mean over all tokens.
+    """
+    if pooling == "tokens":
+        return hidden
+    elif pooling == "cls":
+        return hidden[:, 0]
+    elif pooling == "mean":
+        return hidden.mean(dim=1)
+    raise ValueError(f"Pooling {pooling} not supported")
+
+
+class ViTFeatureCache:
+    """
+    On-disk cache of frozen ViT outputs. Every image is stored as its own
+    .npy file, keyed by the image path, the hash of the file content and
+    the hash of the ViT weights. Entries are filled lazily the first time
+    an image is requested and are read back as memory-mapped arrays.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        backbone_hash: str,
+        pooling: str = "tokens",
+        dtype: str = "float32",
+        content_hash: Optional[Callable[[str], Optional[str]]] = None,
+    ):
+        if pooling not in POOLINGS:
+            raise ValueError(f"Pooling {pooling} not supported")
+
+        self.pooling = pooling
+        self.dtype = np.dtype(dtype)
+        self.folder = Path(folder) / backbone_hash[:16] / f"{pooling}-{self.dtype.name}"
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Gives the hash of images that are not read from their own file
+        self.content_hash = content_hash
+        self._file_hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.folder.glob("*/*.npy"))
+
+    def file_hash(self, path: str) -> str:
+        if self.content_hash is not None:
+            digest = self.content_hash(path)
+            if digest is not None:
+                return digest
+
+        stat = os.stat(path)
+        known = self._file_hashes.get(path)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self._file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def entry_path(self, path: str) -> Path:
+        key = hashlib.sha1(
+            f"{Path(path).absolute()}\0{self.file_hash(path)}".encode()
+        ).hexdigest()
+        return self.folder / key[:2] / f"{key}.npy"
+
+    def get(
+        self, paths: Sequence[str], encode: Callable[[List[str]], Tensor]
+    ) -> Tensor:
+        """
+        Returns the cached features for the given image paths as one tensor.
+
+        Args:
+            paths: Paths of the images to look up.
+            encode: Called once with the paths that are not cached yet, it
+                    must return their ViT hidden states [M, T, H].
+        """
+        entries = [self.entry_path(str(p)) for p in paths]
+        missing = [i for i, entry in enumerate(entries) if not entry.exists()]
+
+        if missing:
+            with torch.no_grad():
+                hidden = encode([str(paths[i]) for i in missing])
+                features = pool_tokens(hidden, self.pooling)
+            features = features.to("cpu", torch.float32).numpy().astype(self.dtype)
+            for i, feature in zip(missing, features):
+                self._write(entries[i], feature)
+
+        self.misses += len(missing)
+        self.hits += len(entries) - len(missing)
+
+        arrays = [np.load(entry, mmap_mode="r") for entry in entries]
+        return torch.from_numpy(np.stack(arrays).astype(np.float32, copy=False))
+
+    def _write(self, entry: Path, feature: np.ndarray):
+        # Write to a temporary file first so that readers (and other
+        # processes filling the same cache) never see a partial entry
+        entry.parent.mkdir(exist_ok=True)
+        tmp_path = entry.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, feature)
+        os.replace(tmp_path, entry)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        logging.info(
+            f"Feature cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)"
+        )
@@ -0,0 +1,171 @@
+from typing import Any, Dict, List
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from lostpaw.model.feature_cache import pool_tokens
+
+HEADS = ["flatten", "cls", "mean", "attention", "low_rank"]
+
+
+def _mlp(in_features: int, output_dim: int) -> List[nn.Module]:
+    return [
+        nn.Linear(in_features, 2 * output_dim),
+        nn.ELU(),
+        nn.Linear(2 * output_dim, 2 * output_dim),
+        nn.ELU(),
+        nn.Linear(2 * output_dim, output_dim),
+    ]
+
+
+class ProjectionHead(nn.Sequential):
+    """
+    Base class of the heads that map the ViT hidden states [N, T, H] to the
+    latent space. The pooling attribute tells which form of the hidden
+    states the head needs, so the feature cache can store only that.
+    """
+
+    name = ""
+    pooling = "tokens"
+
+    def __init__(self, hidden_size: int, tokens: int, *layers: nn.Module):
+        super(ProjectionHead, self).__init__(*layers)
+        self.hidden_size = hidden_size
+        self.tokens = tokens
+
+    def forward(self, x: Tensor) -> Tensor:
+        if x.dim() == 3:
+            x = pool_tokens(x, self.pooling)
+        return super().forward(x)
+
+    def parameter_count(self) -> int:
+        return sum(p.numel() for p in self.parameters())
+
+    def flops(self) -> int:
+        """Floating point operations needed to project a single image."""
+        total = self.pool_flops()
+        for module in self:
+            if isinstance(module, nn.Linear):
+                total += 2 * module.in_features * module.out_features
+        return total
+
+    def pool_flops(self) -> int:
+        return 0
+
+    def describe(self) -> Dict[str, Any]:
+        return dict(
+            head=self.name,
+            pooling=self.pooling,
+            parameters=self.parameter_count(),
+            flops=self.flops(),
+        )
+
+
+class FlattenHead(ProjectionHead):
+    """The original head: an MLP on all tokens, flattened into one vector."""
+
+    name = "flatten"
+
+    def __init__(self, hidden_size: int, tokens: int, output_dim: int):
+        # Keeps the layer indices of the original nn.Sequential, so existing
+        # checkpoints still load
+        super(FlattenHead, self).__init__(
+            hidden_size, tokens, *_mlp(hidden_size * tokens, output_dim)
+        )
+
+    def forward(self, x: Tensor) -> Tensor:
+        return super().forward(x.flatten(1))
+
+
+class ClsHead(ProjectionHead):
+    """An MLP on the CLS token only."""
+
+    name = "cls"
+    pooling = "cls"
+
+    def __init__(self, hidden_size: int, tokens: int, output_dim: int):
+        super(ClsHead, self).__init__(
+            hidden_size, tokens, *_mlp(hidden_size, output_dim)
+        )
+
+
+class MeanPoolHead(ProjectionHead):
+    """An MLP on the mean of all tokens."""
+
+    name = "mean"
+    pooling = "mean"
+
+    def __init__(self, hidden_size: int, tokens: int, output_dim: int):
+        super(MeanPoolHead, self).__init__(
+            hidden_size, tokens, *_mlp(hidden_size, output_dim)
+        )
+
+    def pool_flops(self) -> int:
+        # Only when the mean is not taken from the feature cache
+        return self.tokens * self.hidden_size
+
+
+class AttentionPool(nn.Module):
+    """Weighted sum of the tokens, with weights from a learned scoring layer."""
+
+    def __init__(self, hidden_size: int):
+        super(AttentionPool, self).__init__()
+        self.score = nn.Linear(hidden_size, 1)
+
+    def forward(self, x: Tensor) -> Tensor:
+        weights = torch.softmax(self.score(x), dim=1)
+        return (weights * x).sum(dim=1)
+
+
+class AttentionPoolHead(ProjectionHead):
+    """An MLP on an attention-weighted average of all tokens."""
+
+    name = "attention"
+
+    def __init__(self, hidden_size: int, tokens: int, output_dim: int):
+        super(AttentionPoolHead, self).__init__(
+            hidden_size,
+            tokens,
+            AttentionPool(hidden_size),
+            *_mlp(hidden_size, output_dim),
+        )
+
+    def pool_flops(self) -> int:
+        # Scoring every token, the softmax and the weighted sum
+        return 4 * self.tokens * self.hidden_size + 3 * self.tokens
+
+
+class LowRankFlattenHead(ProjectionHead):
+    """
+    The flatten head with its first (by far largest) weight matrix factorised
+    into two matrices of the given rank.
+    """
+
+    name = "low_rank"
+
+    def __init__(self, hidden_size: int, tokens: int, output_dim: int, rank: int = 64):
+        super(LowRankFlattenHead, self).__init__(
+            hidden_size,
+            tokens,
+            nn.Linear(hidden_size * tokens, rank, bias=False),
+            *_mlp(rank, output_dim),
+        )
+
+    def forward(self, x: Tensor) -> Tensor:
+        return super().forward(x.flatten(1))
+
+
+def build_head(
+    name: str, hidden_size: int, tokens: int, output_dim: int, rank: int = 64
+) -> ProjectionHead:
+    if name == "flatten":
+        return FlattenHead(hidden_size, tokens, output_dim)
+    elif name == "cls":
+        return ClsHead(hidden_size, tokens, output_dim)
+    elif name == "mean":
+        return MeanPoolHead(hidden_size, tokens, output_dim)
+    elif name == "attention":
+        return AttentionPoolHead(hidden_size, tokens, output_dim)
+    elif name == "low_rank":
+        return LowRankFlattenHead(hidden_size, tokens, output_dim, rank)
+    raise ValueError(f"Head {name} not supported")
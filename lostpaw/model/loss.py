@@ -3,11 +3,20 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 
+MINING_MODES = ["pairs", "all_pairs", "batch_hard", "semi_hard"]
+
+
 class PetContrastiveLoss(nn.Module):
-    def __init__(self, margin=1.25, eps=1e-8):
+    def __init__(self, margin=1.25, eps=1e-8, mining="pairs"):
         super(PetContrastiveLoss, self).__init__()
+        if mining not in MINING_MODES:
+            raise ValueError(f"Mining mode {mining} not supported")
+
         self.margin = margin
         self.eps = eps
+        # pairs: only the sampled pairs, otherwise the pairs are mined from
+        # all images of the batch, see mined_loss
+        self.mining = mining
 
     def forward(self, features: Tensor, labels: Tensor, distance: Optional[Tensor] = None) -> Tensor:
         """
@@ -73,3 +82,92 @@ class PetContrastiveLoss(nn.Module):
         )
 
         return euclidean_distance
+
+    def distance_matrix(self, embeddings: Tensor) -> Tensor:
+        """
+        Computes the euclidean distance between all embeddings of a batch.
+
+        Args:
+            embeddings: A tensor of shape (M, D).
+
+        Returns:
+            A tensor of shape (M, M).
+        """
+        squared = torch.sum(torch.pow(embeddings, 2), 1)
+        dot = embeddings @ embeddings.T
+        squared_distance = squared[:, None] - 2 * dot + squared[None, :]
+        return torch.sqrt(torch.clamp(squared_distance, min=0.0) + self.eps)
+
+    def mined_loss(
+        self, embeddings: Tensor, pet_ids: Tensor, distances: Optional[Tensor] = None
+    ) -> Tensor:
+        """
+        Contrastive loss over the pairs of all embeddings of a batch, where
+        two embeddings are a positive pair if they belong to the same pet.
+        Which pairs are used depends on the mining mode:
+
+            all_pairs: Every pair of the batch, positive and negative pairs
+                       are averaged separately so that the many negative
+                       pairs do not drown out the positive ones.
+            batch_hard: For every anchor only its farthest positive and its
+                        closest negative.
+            semi_hard: For every anchor all of its positives, and the closest
+                       negative that is still farther away than its farthest
+                       positive (or the closest one if there is none).
+
+        Based on the paper:
+         Alexander Hermans, Lucas Beyer, and Bastian Leibe. In defense of
+         the triplet loss for person re-identification. arXiv:1703.07737, 2017
+
+        Args:
+            embeddings: A tensor of shape (M, D) of distinct images.
+            pet_ids: A tensor of shape (M,) with the pet of every image.
+            distances: The distance matrix of the embeddings, if already computed.
+        """
+        if distances is None:
+            distances = self.distance_matrix(embeddings)
+
+        pet_ids = pet_ids.to(distances.device)
+        same = pet_ids[:, None] == pet_ids[None, :]
+        eye = torch.eye(len(pet_ids), dtype=torch.bool, device=distances.device)
+        positive = same & ~eye
+        negative = ~same
+
+        positive_loss = torch.pow(distances, 2)
+        negative_loss = torch.pow(torch.clamp(self.margin - distances, min=0.0), 2)
+
+        if self.mining == "all_pairs":
+            return 0.5 * (
+                _masked_mean(positive_loss, positive) + _masked_mean(negative_loss, negative)
+            )
+
+        # Anchors without a positive or a negative in the batch are skipped
+        anchors = positive.any(1) & negative.any(1)
+        if not anchors.any():
+            return distances.sum() * 0.0
+        distances, positive, negative = distances[anchors], positive[anchors], negative[anchors]
+        positive_loss = positive_loss[anchors]
+
+        inf = torch.tensor(float("inf"), device=distances.device, dtype=distances.dtype)
+        hardest_positive = torch.where(positive, distances, -inf).max(1).values
+        negatives = torch.where(negative, distances, inf)
+
+        if self.mining == "batch_hard":
+            positive_term = torch.pow(hardest_positive, 2)
+        else:
+            positive_term = (positive_loss * positive).sum(1) / positive.sum(1).clamp(min=1)
+            semi_hard = torch.where(negatives > hardest_positive[:, None], negatives, inf)
+            has_semi_hard = torch.isfinite(semi_hard.min(1).values)
+            negatives = torch.where(has_semi_hard[:, None], semi_hard, negatives)
+
+        hardest_negative = negatives.min(1).values
+        negative_term = torch.pow(torch.clamp(self.margin - hardest_negative, min=0.0), 2)
+
+        return torch.mean(0.5 * (positive_term + negative_term))
+
+
+def _masked_mean(values: Tensor, mask: Tensor) -> Tensor:
+    count = mask.sum()
+    if count == 0:
+        return values.sum() * 0.0
+    return (values * mask).sum() / count
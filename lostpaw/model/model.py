@@ -1,9 +1,20 @@
-from transformers import ViTFeatureExtractor, ViTModel
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+import logging
+import types
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from pathlib import Path
 
+from lostpaw.model.checkpoint import atomic_write, load_checkpoint, save_checkpoint, tensors_hash
+from lostpaw.model.heads import ProjectionHead, build_head
+from lostpaw.model.preprocess import ImagePreprocessor
+
+# Compute types of the autocast regions, the weights always stay float32
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 
 class PetViTContrastiveModel(nn.Module):
     def __init__(
@@ -11,37 +22,201 @@ class PetViTContrastiveModel(nn.Module):
         model_path: Path,
         output_dim: int = 1024,  # Output dimension of the model, latent space size
         device="cpu",
+        head: str = "flatten",
+        head_rank: int = 64,
+        precision: str = "fp32",
+        channels_last: bool = False,
+        pretrained: bool = True,
     ):
+        """
+        With pretrained set to False the weights are not initialised at all
+        (they live on the meta device), which only makes sense when
+        load_model is called right after, e.g. for inference.
+        """
         super(PetViTContrastiveModel, self).__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(f"Precision {precision} not supported")
         self.vit_encoder = None
         self.vit_model = None
         self.model_path = Path(model_path)
+        self._backbone_hash: Optional[str] = None
+        self._reference_hashes: Dict[Tuple[str, ...], str] = {}
+        self.backbone_frozen = False
 
         self.device = device
+        self.output_dim = output_dim
+        self.precision = precision
+        self.channels_last = channels_last
 
-        self.fetch_vit()
-
-        self.latent_space = nn.Sequential(
-            # 577 = 384 / 16 * 384 / 16 + 1 (cls token)
-            nn.Linear(self.vit_model.config.hidden_size * 577, 2 * output_dim),
-            nn.ELU(),
-            nn.Linear(2 * output_dim, 2 * output_dim),
-            nn.ELU(),
-            nn.Linear(2 * output_dim, output_dim),
+        self.fetch_vit(pretrained)
+        self.preprocess = ImagePreprocessor.from_feature_extractor(
+            self.vit_encoder
         ).to(self.device)
 
+        config = self.vit_model.config
+        # 577 = 384 / 16 * 384 / 16 + 1 (cls token)
+        tokens = (config.image_size // config.patch_size) ** 2 + 1
+        if pretrained:
+            self.latent_space: ProjectionHead = build_head(
+                head, config.hidden_size, tokens, output_dim, head_rank
+            ).to(self.device)
+        else:
+            with torch.device("meta"):
+                self.latent_space = build_head(
+                    head, config.hidden_size, tokens, output_dim, head_rank
+                )
+
+        if channels_last:
+            # Only the patch embedding is a convolution, it reads the
+            # channels-last batches of the loader without a transpose
+            self.vit_model.to(memory_format=torch.channels_last)
+
     def forward(self, x: Tensor):
-        x = self.vit_encoder(x, return_tensors="pt").to(self.device)
-        x = self.vit_model(**x)[0]
-        x = x.flatten(1)
-        x = self.latent_space(x)
-        return x
+        return self.project(self.encode(x))
+
+    def encode(self, x) -> Tensor:
+        """Runs the ViT backbone and returns its last hidden state [N, 577, H]."""
+        pixel_values = self.preprocess.prepare(x)
+        if self.channels_last:
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+        # A fully frozen backbone does not need an autograd graph at all
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.backbone_frozen):
+            with self.autocast():
+                return self.vit_model(pixel_values=pixel_values)[0]
+
+    def project(self, hidden: Tensor) -> Tensor:
+        """Maps (possibly cached) ViT hidden states to the latent space."""
+        with self.autocast():
+            features = self.latent_space(hidden.to(self.device))
+        # Losses and distances are always computed in float32
+        return features.float()
+
+    def autocast(self) -> torch.autocast:
+        """
+        Autocast region of the configured precision. The parameters are not
+        converted, so the optimizer keeps updating float32 master weights.
+        """
+        return torch.autocast(
+            torch.device(self.device).type,
+            dtype=PRECISIONS[self.precision],
+            enabled=self.precision != "fp32",
+        )
+
+    @contextmanager
+    def full_precision(self) -> Iterator[None]:
+        """Temporarily runs the model in float32, e.g. to measure the drift."""
+        precision = self.precision
+        self.precision = "fp32"
+        try:
+            yield
+        finally:
+            self.precision = precision
+
+    def embed_batch(
+        self,
+        images: Sequence[Any],
+        max_batch_size: Optional[int] = None,
+        memory_budget: int = 1 << 30,
+    ) -> Tensor:
+        """
+        Embeds a list of PIL images, uint8 NumPy arrays or tensors (or a
+        batched tensor) for inference.
+
+        Args:
+            images: The images to embed.
+            max_batch_size: Size of the micro-batches the images are cut into.
+                            Derived from memory_budget when not given.
+            memory_budget: Approximate number of bytes of activations a single
+                           micro-batch may use.
+
+        Returns:
+            A tensor of shape (N, output_dim).
+        """
+        batch_size = max_batch_size or self.micro_batch_size(memory_budget)
+        outputs = []
+        with torch.inference_mode():
+            for start in range(0, len(images), batch_size):
+                outputs.append(self(images[start : start + batch_size]))
+
+        if not outputs:
+            return torch.empty((0, self.output_dim), device=self.device)
+        return torch.cat(outputs)
+
+    def micro_batch_size(self, memory_budget: int) -> int:
+        """Estimates how many images fit in memory_budget bytes of activations."""
+        config = self.vit_model.config
+        tokens = (config.image_size // config.patch_size) ** 2 + 1
+        # Attention scores, MLP activations and a handful of hidden states
+        per_token = (
+            config.num_attention_heads * tokens
+            + config.intermediate_size
+            + 4 * config.hidden_size
+        )
+        return max(1, memory_budget // (4 * tokens * per_token))
+
+    def backbone_hash(self) -> str:
+        """Content hash of the ViT weights, used to key cached features."""
+        if self._backbone_hash is None:
+            self._backbone_hash = tensors_hash(self.vit_model.state_dict().items())
+        return self._backbone_hash
+
+    def freeze_backbone(self, unfreeze_last_n: int = 0):
+        """
+        Stops training the ViT backbone, except for its last unfreeze_last_n
+        encoder blocks (and the final layer norm that follows them).
+        """
+        self.vit_model.requires_grad_(False)
+        if unfreeze_last_n > 0:
+            for block in self.vit_model.encoder.layer[-unfreeze_last_n:]:
+                block.requires_grad_(True)
+            self.vit_model.layernorm.requires_grad_(True)
+        self.backbone_frozen = unfreeze_last_n <= 0
+        self._reference_hashes = {}
+
+    def enable_activation_checkpointing(self) -> int:
+        """
+        Stops keeping the activations of the trainable ViT encoder blocks
+        for the backward pass, they are recomputed instead. This trades
+        one more forward pass of those blocks for memory that grows with
+        the batch size. Call it after freeze_backbone, frozen blocks keep
+        no activations anyway.
+
+        Returns:
+            The number of blocks that are checkpointed.
+        """
+        count = 0
+        for block in self.vit_model.encoder.layer:
+            if any(p.requires_grad for p in block.parameters()):
+                # An instance attribute, so the weight names do not change
+                block.forward = types.MethodType(_checkpointed_forward, block)
+                count += 1
+        return count
+
+    def parameter_groups(self, backbone_lr: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the trainable parameters as optimizer parameter groups: one for
+        the head and, if any backbone weights are trainable, one for those
+        with their own learning rate.
+        """
+        head = [p for p in self.latent_space.parameters() if p.requires_grad]
+        backbone = [p for p in self.vit_model.parameters() if p.requires_grad]
+
+        groups: List[Dict[str, Any]] = [dict(params=head)]
+        if backbone:
+            groups.append(dict(params=backbone))
+            if backbone_lr is not None:
+                groups[-1]["lr"] = backbone_lr
+        return groups
 
     def train(self, train=True):
         super().train(train)
         self.vit_model.train(False)
+        return self
+
+    def fetch_vit(self, pretrained: bool = True):
+        # transformers takes seconds to import, only do so when needed
+        from transformers import ViTConfig, ViTFeatureExtractor, ViTModel
 
-    def fetch_vit(self):
         model_path = self.model_path / "model"
         encoder_path = self.model_path / "encoder"
 
@@ -49,6 +224,12 @@ class PetViTContrastiveModel(nn.Module):
             self.vit_encoder = ViTFeatureExtractor.from_pretrained(
                 encoder_path, local_files_only=True
             )
+            if not pretrained:
+                # Only the architecture, the weights come from load_model
+                config = ViTConfig.from_pretrained(model_path, local_files_only=True)
+                with torch.device("meta"):
+                    self.vit_model = ViTModel(config)
+                return
             self.vit_model = ViTModel.from_pretrained(model_path, local_files_only=True)
         else:
             self.vit_model = ViTModel.from_pretrained("google/vit-base-patch16-384")
@@ -60,10 +241,114 @@ class PetViTContrastiveModel(nn.Module):
 
         self.vit_model.to(self.device)
 
+    def trainable_state(self) -> Dict[str, Tensor]:
+        """
+        The weights that can differ from the pretrained ViT: the head and
+        every backbone parameter that is trained.
+        """
+        trainable = {name for name, p in self.named_parameters() if p.requires_grad}
+        return {
+            name: tensor
+            for name, tensor in self.state_dict().items()
+            if name in trainable or name.startswith("latent_space.")
+        }
+
+    def reference_hash(self, names: Sequence[str]) -> str:
+        """Content hash of the given weights, memoised as they are frozen."""
+        key = tuple(sorted(names))
+        if key not in self._reference_hashes:
+            state = self.state_dict()
+            self._reference_hashes[key] = tensors_hash((name, state[name]) for name in key)
+        return self._reference_hashes[key]
+
     def load_model(self, path: Path):
-        state = torch.load(path)
-        self.load_state_dict(state)
+        """
+        Loads a checkpoint of save_model. The file is memory-mapped and its
+        tensors are used as the parameters directly, instead of reading it
+        into memory first and then copying it into the parameters.
+
+        A safetensors checkpoint may only hold the trained weights, the
+        others then come from the pretrained ViT and have to match the
+        hash stored in the checkpoint.
+        """
+        path = Path(path)
+        if path.suffix == ".safetensors":
+            self._load_safetensors(path)
+        else:
+            try:
+                state = torch.load(path, map_location=self.device, mmap=True, weights_only=True)
+            except RuntimeError:
+                # Checkpoints in the legacy (non-zip) format cannot be mapped
+                logging.info(f"Cannot memory-map {path}, loading it into memory")
+                state = torch.load(path, map_location=self.device, weights_only=True)
+            self.load_state_dict(state, assign=True)
+
+        if self.channels_last:
+            self.vit_model.to(memory_format=torch.channels_last)
+        # The checkpoint may contain fine-tuned backbone weights
+        self._backbone_hash = None
+        self._reference_hashes = {}
+
+    def _load_safetensors(self, path: Path):
+        state, metadata = load_checkpoint(path, self.device)
+        missing = [name for name in self.state_dict() if name not in state]
+
+        if missing and any(self.state_dict()[name].is_meta for name in missing):
+            # Built without weights, but the checkpoint needs the pretrained ViT
+            self.fetch_vit(pretrained=True)
+            missing = [name for name in self.state_dict() if name not in state]
+
+        expected = metadata.get("reference_hash")
+        if missing and expected is not None and self.reference_hash(missing) != expected:
+            raise ValueError(
+                f"{path} was trained on a different backbone than the one in {self.model_path}"
+            )
+        self.load_state_dict(state, strict=not missing, assign=True)
+
+    def checkpoint_state(self, path: Path, trainable_only: bool = True) -> Dict[str, Tensor]:
+        """
+        The weights save_model writes to path: for a .safetensors path only
+        the trainable weights (see trainable_state) unless trainable_only
+        is False, otherwise the whole state_dict.
+        """
+        if Path(path).suffix == ".safetensors" and trainable_only:
+            return self.trainable_state()
+        return self.state_dict()
+
+    def save_model(
+        self,
+        path: Path,
+        trainable_only: bool = True,
+        state: Optional[Dict[str, Tensor]] = None,
+    ):
+        """
+        Saves the weights of checkpoint_state, .safetensors paths as a
+        safetensors file and others with torch.save.
+
+        Args:
+            state: A copy of checkpoint_state to write instead of the
+                   current weights, e.g. when saving in the background.
+        """
+        path = Path(path)
+        if state is None:
+            state = self.checkpoint_state(path, trainable_only)
+
+        if path.suffix == ".safetensors":
+            missing = [name for name in self.state_dict() if name not in state]
+            save_checkpoint(
+                state,
+                path,
+                self.reference_hash(missing) if missing else None,
+                dict(head=self.latent_space.name, output_dim=self.output_dim),
+            )
+        else:
+            # Never overwrite the file in place: the parameters may still be
+            # memory-mapped from it (see load_model)
+            atomic_write(path, lambda tmp_path: torch.save(state, tmp_path))
+
 
-    def save_model(self, path: Path):
-        state = self.state_dict()
-        torch.save(state, path)
+def _checkpointed_forward(block: nn.Module, *args: Any, **kwargs: Any) -> Any:
+    forward = type(block).forward
+    if not torch.is_grad_enabled():
+        return forward(block, *args, **kwargs)
+    return checkpoint(forward, block, *args, use_reentrant=False, **kwargs)
@@ -0,0 +1,100 @@
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from PIL.Image import Image
+
+
+class ImagePreprocessor(nn.Module):
+    """
+    Tensor-native replacement for ViTFeatureExtractor: resizes to the ViT
+    input size and normalises a whole batch with a few vectorised tensor
+    operations instead of per-image PIL work.
+    """
+
+    def __init__(
+        self,
+        size: Tuple[int, int] = (384, 384),
+        mean: Sequence[float] = (0.5, 0.5, 0.5),
+        std: Sequence[float] = (0.5, 0.5, 0.5),
+    ):
+        super(ImagePreprocessor, self).__init__()
+        self.size = tuple(size)
+        # Not persistent, so the buffers do not end up in the checkpoints
+        self.register_buffer(
+            "mean", torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1), False
+        )
+        self.register_buffer(
+            "std", torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1), False
+        )
+
+    @classmethod
+    def from_feature_extractor(cls, extractor) -> "ImagePreprocessor":
+        size = extractor.size
+        if isinstance(size, dict):
+            size = (size["height"], size["width"])
+        elif isinstance(size, int):
+            size = (size, size)
+        return cls(size, extractor.image_mean, extractor.image_std)
+
+    def forward(self, pixels: Tensor) -> Tensor:
+        """
+        Args:
+            pixels: A uint8 tensor of shape (N, 3, H, W) with values in
+                    [0, 255], or a float tensor that is already resized and
+                    normalised, which is returned as is.
+        """
+        pixels = pixels.to(self.mean.device)
+        if pixels.is_floating_point():
+            return pixels
+
+        x = pixels.float()
+        if tuple(x.shape[-2:]) != self.size:
+            x = F.interpolate(
+                x, size=self.size, mode="bilinear", antialias=True, align_corners=False
+            )
+        return (x / 255.0 - self.mean) / self.std
+
+    def prepare(self, images: Any) -> Tensor:
+        """
+        Converts a single image or a list of PIL images, uint8 NumPy arrays
+        (H, W, 3) or tensors (3, H, W) into one normalised batch. Inputs of
+        the same size are resized together.
+        """
+        if isinstance(images, Tensor) and images.dim() == 4:
+            return self(images)
+        if isinstance(images, np.ndarray) and images.ndim == 4:
+            return self(torch.from_numpy(images).permute(0, 3, 1, 2))
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+
+        tensors = [to_chw_tensor(image) for image in images]
+
+        # Group the images by shape and dtype, so each group is one operation
+        groups: Dict[Tuple[Any, ...], List[int]] = {}
+        for i, tensor in enumerate(tensors):
+            groups.setdefault((tuple(tensor.shape), tensor.dtype), []).append(i)
+
+        if len(groups) == 1:
+            return self(torch.stack(tensors))
+
+        result = torch.empty(
+            (len(tensors), 3, *self.size), dtype=torch.float32, device=self.mean.device
+        )
+        for indices in groups.values():
+            result[indices] = self(torch.stack([tensors[i] for i in indices]))
+        return result
+
+
+def to_chw_tensor(image: Any) -> Tensor:
+    if isinstance(image, Image):
+        image = np.array(image.convert("RGB"))
+    if isinstance(image, np.ndarray):
+        if image.ndim == 2:
+            image = np.repeat(image[:, :, None], 3, axis=2)
+        return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+    if isinstance(image, Tensor):
+        return image
+    raise ValueError(f"invalid image type given: {type(image)}")
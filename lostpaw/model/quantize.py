@@ -0,0 +1,79 @@
+from typing import Iterable, Optional
+import copy
+import torch
+import torch.nn as nn
+from torch import Tensor
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    get_default_qconfig,
+    prepare,
+    quantize_dynamic,
+)
+
+from lostpaw.model.export import EmbeddingModule
+from lostpaw.model.heads import ProjectionHead
+from lostpaw.model.model import PetViTContrastiveModel
+
+QUANTIZATION_MODES = ["dynamic", "static"]
+
+
+def quantize_model(
+    model: PetViTContrastiveModel,
+    mode: str = "dynamic",
+    calibration: Optional[Iterable[Tensor]] = None,
+) -> EmbeddingModule:
+    """
+    Returns an int8 quantized copy of the model for CPU inference, to be
+    saved with lostpaw.model.export.export_model.
+
+    dynamic: The weights of all linear layers (ViT attention and MLP, and
+             the head) are stored as int8, activations are quantized on
+             the fly per batch.
+    static: As dynamic for the backbone, but the MLP of the head also gets
+            fixed activation scales, calibrated on the uint8 image batches
+            of calibration.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Quantization mode {mode} not supported")
+
+    preprocess = _cpu_copy(model.preprocess)
+    vit_model = quantize_dynamic(_cpu_copy(model.vit_model), {nn.Linear}, dtype=torch.qint8)
+
+    if mode == "dynamic":
+        head = quantize_dynamic(_cpu_copy(model.latent_space), {nn.Linear}, dtype=torch.qint8)
+        return EmbeddingModule(preprocess, vit_model, head).eval()
+
+    if calibration is None:
+        raise ValueError("Static quantization needs calibration images")
+
+    head = _with_quant_stubs(model.latent_space)
+    head.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    prepare(head, inplace=True)
+
+    module = EmbeddingModule(preprocess, vit_model, head).eval()
+    with torch.inference_mode():
+        for pixels in calibration:
+            module(pixels)
+    convert(head, inplace=True)
+    return module
+
+
+def _with_quant_stubs(head: ProjectionHead) -> ProjectionHead:
+    """
+    Copy of the head with quantization stubs around its MLP. The pooling in
+    front of the first linear layer stays in float.
+    """
+    head = _cpu_copy(head)
+    start = next(i for i, layer in enumerate(head) if isinstance(layer, nn.Linear))
+    for layer in list(head)[:start]:
+        layer.qconfig = None
+
+    head.insert(start, QuantStub())
+    head.append(DeQuantStub())
+    return head
+
+
+def _cpu_copy(module: nn.Module) -> nn.Module:
+    return copy.deepcopy(module).to("cpu").eval()
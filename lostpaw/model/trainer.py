@@ -1,15 +1,45 @@
-from typing import Any, Iterable, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
 from lostpaw.data.data_folder import PetImagesFolder
 from lostpaw.model import PetViTContrastiveModel, PetContrastiveLoss
+from lostpaw.model.checkpoint import (
+    CHECKPOINT_FORMATS,
+    KEEP_STRATEGIES,
+    AsyncCheckpointWriter,
+    keep_checkpoints,
+    load_optimizer,
+    optimizer_path,
+    save_state,
+    training_state_path,
+)
+from lostpaw.model.distributed import (
+    DISTRIBUTED_BACKENDS,
+    all_reduce_gradients,
+    all_reduce_mean,
+    barrier,
+    broadcast_object,
+    broadcast_parameters,
+    gather_embeddings,
+    get_rank,
+    init_distributed,
+    is_main_process,
+    local_device,
+)
+from lostpaw.model.evaluation import EvaluationReport, evaluate_embeddings
+from lostpaw.model.feature_cache import ViTFeatureCache
 from lostpaw.config import TrainConfig, OptimizerConfig
 from lostpaw.data import RandomPairDataset
+from lostpaw.data.image_cache import SharedImageCache
+from lostpaw.data.shards import ShardReader
 from dataclasses import asdict
+from itertools import islice
 from pathlib import Path
+from time import perf_counter
 from tqdm import tqdm
 import logging
-import wandb
+import random
 import torch
 from torch.optim import Adam, AdamW, SGD
+from torch.utils.data import DataLoader
 import numpy as np
 from PIL.Image import Image
 
@@ -21,8 +51,19 @@ class Trainer:
         seed: Optional[int] = None,
         device: Optional[torch.device] = None,
     ) -> None:
-        logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+        # Under torchrun only rank 0 reports progress
+        logging.basicConfig(
+            level=logging.INFO if get_rank() == 0 else logging.WARNING,
+            format="[%(levelname)s] %(message)s",
+        )
+
+        if config.distributed_backend not in DISTRIBUTED_BACKENDS:
+            raise ValueError(f"Distributed backend {config.distributed_backend} not supported")
+        # Every process of a torchrun run trains on its own share of the batches
+        self.rank, self.world_size = init_distributed(config.distributed_backend)
 
+        if device is None and self.world_size > 1:
+            device = local_device()
         self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.config = config
         self.batches_per_epoch = config.batches_per_epoch
@@ -34,18 +75,45 @@ class Trainer:
             k = 0 if data is None else data.current_fold
             self.run_name += f" kfold-{k}of{config.cross_validiton_k_fold}"
 
-        self.model_state_path = self.model_path / f"model_{self.run_name}.pt"
+        if config.checkpoint_format not in CHECKPOINT_FORMATS:
+            raise ValueError(f"Checkpoint format {config.checkpoint_format} not supported")
+        if config.keep_checkpoints_by not in KEEP_STRATEGIES:
+            raise ValueError(f"Keep strategy {config.keep_checkpoints_by} not supported")
+        self.model_state_path = checkpoint_path(
+            self.model_path, self.run_name, config.checkpoint_format
+        )
 
         # ViT model
         self.vit_model = PetViTContrastiveModel(
-            config.model_path, config.latent_space_size, device=self.device
+            config.model_path,
+            config.latent_space_size,
+            device=self.device,
+            head=config.head,
+            head_rank=config.head_rank,
+            precision=config.precision,
+            channels_last=config.channels_last,
         ).to(device)
-        self.load_model()
+        resumed = self.load_model()
+        logging.info(f"Projection head: {self.vit_model.latent_space.describe()}")
+
+        if config.feature_cache_path and config.unfreeze_last_n_blocks > 0:
+            raise ValueError("The feature cache requires a fully frozen backbone")
+        if config.freeze_backbone or config.feature_cache_path:
+            self.vit_model.freeze_backbone(config.unfreeze_last_n_blocks)
+        if config.accumulation_steps < 1:
+            raise ValueError("accumulation_steps must be at least 1")
+        if config.activation_checkpointing:
+            blocks = self.vit_model.enable_activation_checkpointing()
+            logging.info(f"Activation checkpointing of {blocks} ViT blocks")
 
         # Loss function
         self.contrastive_loss = PetContrastiveLoss(
-            config.contrastive_margin, config.contrastive_epsilon
+            config.contrastive_margin, config.contrastive_epsilon, config.loss_mining
         )
+        if config.pk_pets > 0 and config.loss_mining == "pairs":
+            raise ValueError("Batches of pets (pk_pets) require a loss_mining mode other than pairs")
+        if config.gather_embeddings and config.loss_mining == "pairs":
+            raise ValueError("Gathering embeddings requires a loss_mining mode other than pairs")
 
         # Dataset
         if data is None:
@@ -56,9 +124,26 @@ class Trainer:
                 config.similarity_probability,
                 config.cross_validiton_k_fold,
                 seed=seed,
+                shards=ShardReader(Path(config.shard_path)) if config.shard_path else None,
+                image_cache=self._create_image_cache(),
             )
         else:
             self.pet_data = data
+        # The ranks only draw disjoint batches from the same sequence
+        self.pet_data.seed = broadcast_object(self.pet_data.seed)
+        # Start all ranks from the same weights, e.g. of a randomly initialised head
+        broadcast_parameters(self.vit_model)
+
+        # Cache of the frozen ViT outputs, with it training only runs the head
+        self.feature_cache: Optional[ViTFeatureCache] = None
+        if config.feature_cache_path:
+            self.feature_cache = ViTFeatureCache(
+                Path(config.feature_cache_path),
+                self.vit_model.backbone_hash(),
+                pooling=self.vit_model.latent_space.pooling,
+                dtype=config.feature_cache_dtype,
+                content_hash=self.pet_data.content_hash,
+            )
 
         logging.info("Trainer initialized")
         logging.info(f"Using device: {self.device}")
@@ -68,10 +153,29 @@ class Trainer:
         opt_config = OptimizerConfig(**config.optimizer_params)
         self.optimizer: Union[Adam, AdamW, SGD]
         self.load_optimizer(config.optimizer, opt_config)
+        # fp16 gradients underflow without loss scaling, bf16 has the range of fp32
+        self.grad_scaler = torch.amp.GradScaler(
+            self.device.type, enabled=config.precision == "fp16"
+        )
+
+        # Progress of the run, restored when resuming a saved run
+        self.epoch = 0
+        self.bad_epochs = 0
+        self.best_accuracy = 0.0
+        # Number of batches taken from the train and test loaders so far
+        self.train_batches = 0
+        self.test_batches = 0
+        # Checkpoints are written in the background
+        self.writer = AsyncCheckpointWriter()
+        # Restored by train(), building a Trainer for its model only loads the weights
+        self.resume_pending = resumed
+
+        self.use_wandb = config.use_wandb and is_main_process()
+        self.use_tqdm = config.use_tqdm and is_main_process()
+        if self.use_wandb:
+            # wandb is slow to import and only needed for logged runs
+            import wandb
 
-        self.use_wandb = config.use_wandb
-        self.use_tqdm = config.use_tqdm
-        if config.use_wandb:
             wandb.init(
                 project="lostpaw",
                 entity="klotzandrei",
@@ -82,6 +186,9 @@ class Trainer:
             wandb.watch(self.vit_model)
 
     def train(self):
+        if self.resume_pending:
+            self.resume()
+
         epochs: int = self.config.epochs
         batch_size: int = self.config.batch_size
         test_batch_size: int = self.config.test_batch_size
@@ -90,22 +197,38 @@ class Trainer:
 
         progress_tqdm = None
 
-        data = self.pet_data.get_batches(batch_size)
+        # Continue with the batches after the ones of the saved run
+        data = iter(
+            self.get_loader(batch_size, start=self.train_batches, pet_count=self.config.pk_pets)
+        )
 
         if test_batch_size != 0 and test_batch_count != 0:
             if self.pet_data.fold_count is not None and self.pet_data.fold_count > 1:
-                test_data = self.pet_data.get_batches(test_batch_size, test=True)
+                test_data = iter(self.get_loader(test_batch_size, test=True, start=self.test_batches))
             else:
                 # For now just use the same data for testing, as long as the
                 # test_batch_size is small we should have old data generally. 
-                test_data = self.pet_data.get_batches(test_batch_size)
-
-        bad_epochs = 0
-        best_accuracy = 0
+                test_data = iter(self.get_loader(test_batch_size, start=self.test_batches))
+
+        if self.epoch > 0:
+            logging.info(f"Resuming at epoch {self.epoch}")
+        if self.bad_epochs > self.config.early_stopping_epochs:
+            logging.info("The run already stopped early")
+            return
+
+        steps = self.config.accumulation_steps
+        micro_batch_size = self.config.pk_pets * self.config.pk_images or batch_size
+        logging.info(
+            f"Effective batch size: {micro_batch_size * steps * self.world_size} "
+            f"({micro_batch_size} x {steps} accumulation steps x {self.world_size} ranks)"
+        )
 
-        for epoch in range(epochs):
-            # Get the batches
-            progress: Iterable[Any] = enumerate(data)
+        for epoch in range(self.epoch, epochs):
+            # Get the batches, every optimizer step takes the next `steps`
+            # batches of the loader as its micro-batches
+            progress: Iterable[Any] = enumerate(
+                islice(zip(*[data] * steps), self.batches_per_epoch)
+            )
             if self.use_tqdm:
                 progress = progress_tqdm = tqdm(
                     progress,
@@ -116,43 +239,34 @@ class Trainer:
             total_acc = 0.0
             total_metric = np.zeros([4])
 
-            for idx, (imgs1, imgs2, given_labels) in progress:
-                if idx >= self.batches_per_epoch:
-                    break
-
+            for idx, micro_batches in progress:
                 self.optimizer.zero_grad()
 
-                # Get the features
-                features1 = self.vit_model(imgs1)
-                features2 = self.vit_model(imgs2)
+                for batch in micro_batches:
+                    loss, backward_loss, labels, distance = self.batch_loss(batch)
 
-                # Merge the images for the contrastive loss
-                # fatures: [batch_size, 2, output_dim]
-                # labels: [batch_size]
-                features = torch.stack([features1, features2], dim=1).to(self.device)
-                labels = torch.tensor(given_labels, dtype=torch.float32).to(self.device)
-                distance = self.contrastive_loss.euclidean_distance(features)
+                    # Backpropagate, the gradients of the micro-batches add up
+                    # to those of the mean loss of the whole batch
+                    self.grad_scaler.scale(backward_loss / steps).backward()
 
-                # Compute the loss
-                loss: torch.Tensor = self.contrastive_loss(features, labels, distance)
+                    total_metric += self.compute_metrics(labels, distance, len(labels))
+                    total_loss += loss.item()
 
-                # Backpropagate
-                loss.backward()
+                # Once per step, not per micro-batch
+                all_reduce_gradients(self.vit_model.parameters())
 
                 # Update the weights
-                self.optimizer.step()
-
-                total_metric += self.compute_metrics(labels, distance, batch_size)
-
-                total_loss += loss.item()
+                self.grad_scaler.step(self.optimizer)
+                self.grad_scaler.update()
 
                 # Log the accuracy and loss
                 if progress_tqdm:
-                    (m_different, m_err1, m_err2, m_same) = total_metric / (idx + 1)
+                    done = (idx + 1) * steps
+                    (m_different, m_err1, m_err2, m_same) = total_metric / done
                     progress_tqdm.set_postfix(
                         {
                             "epoch": epoch,
-                            "loss": total_loss / (idx + 1),
+                            "loss": total_loss / done,
                             # "acc": total_acc / (idx + 1),
                             "diff": m_different,
                             "err1": m_err1,
@@ -161,8 +275,11 @@ class Trainer:
                         }
                     )
 
-            total_loss /= self.batches_per_epoch
-            total_metric /= self.batches_per_epoch
+            # Averaged over the micro-batches of all ranks
+            reduced = all_reduce_mean(
+                np.array([total_loss, *total_metric]) / (self.batches_per_epoch * steps)
+            )
+            total_loss, total_metric = float(reduced[0]), reduced[1:]
             metric_different, metric_err1, metric_err2, metric_same = total_metric
             total_acc = 1 - (metric_err1 + metric_err2)
 
@@ -176,10 +293,8 @@ class Trainer:
                     test_err2=0,
                 )
                 for _ in range(test_batch_count):
-                    test_imgs1, test_imgs2, test_labels = next(test_data)
-                    test_metric = self.test_batch(
-                        test_imgs1, test_imgs2, test_labels, test_batch_size
-                    )
+                    test_metric = self.test_batch(next(test_data), test_batch_size)
+                    self.test_batches += 1
 
                     tm_different, tm_err1, tm_err2, tm_same = test_metric
                     test_acc = 1 - (tm_err1 + tm_err2)
@@ -194,19 +309,42 @@ class Trainer:
                 test_dict["test_same"] /= test_batch_count
                 test_dict["test_err1"] /= test_batch_count
                 test_dict["test_err2"] /= test_batch_count
+                # All ranks make the same early stopping decisions
+                reduced = all_reduce_mean(np.array(list(test_dict.values())))
+                test_dict = dict(zip(test_dict.keys(), reduced.tolist()))
+
+                # test_data only exists with test batches to draw from
+                if self.vit_model.precision != "fp32" and test_batch_count != 0:
+                    drift = self.precision_drift(next(test_data), test_batch_size)
+                    drift = float(all_reduce_mean(np.array([drift]))[0])
+                    self.test_batches += 1
+                    test_dict["precision_drift"] = drift
+                    if drift > self.config.precision_drift_tolerance:
+                        logging.warning(
+                            f"Accuracy in {self.vit_model.precision} is {drift:.3f} below fp32, "
+                            "continuing in fp32"
+                        )
+                        self.vit_model.precision = "fp32"
+                        self.grad_scaler = torch.amp.GradScaler(self.device.type, enabled=False)
 
             if epoch > 50:
-                if test_dict["test_accuracy"] <= best_accuracy:
-                    bad_epochs += 1
+                if test_dict["test_accuracy"] <= self.best_accuracy:
+                    self.bad_epochs += 1
                 else:
-                    bad_epochs = 0
-                    best_accuracy = test_dict["test_accuracy"]
+                    self.bad_epochs = 0
+                    self.best_accuracy = test_dict["test_accuracy"]
 
 
             logging.info(
                 f"Epoch {epoch} - Avg. Loss: {total_loss:.3f} - Avg. Accuracy: {total_acc:.3f}"
             )
+            if self.feature_cache is not None:
+                self.feature_cache.log_stats()
+            if self.pet_data.image_cache is not None:
+                self.pet_data.image_cache.log_stats()
             if self.use_wandb:
+                import wandb
+
                 wandb.log(
                     dict(
                         loss=total_loss,
@@ -220,13 +358,65 @@ class Trainer:
                     step=epoch,
                 )
 
-            if (epoch % self.config.save_model_every == 0) or (epoch == epochs - 1) or (bad_epochs > self.config.early_stopping_epochs):
-                self.save_model()
+            self.epoch = epoch + 1
+            self.train_batches += self.batches_per_epoch * steps
 
-            if bad_epochs > self.config.early_stopping_epochs:
+            if (epoch % self.config.save_model_every == 0) or (epoch == epochs - 1) or (self.bad_epochs > self.config.early_stopping_epochs):
+                self.save_model(test_dict.get("test_accuracy"))
+
+            if self.bad_epochs > self.config.early_stopping_epochs:
                 logging.info("Early stopping!")
                 break
 
+        # The last checkpoint must be on disk before the run counts as done
+        self.writer.flush()
+        if self.writer.latencies:
+            logging.info(
+                f"Wrote {len(self.writer.latencies)} checkpoints, "
+                f"{np.mean(self.writer.latencies):.2f}s on average after saving"
+            )
+        # The other ranks wait for the checkpoints of rank 0
+        barrier()
+
+    def batch_loss(self, batch: Dict[str, Any]):
+        """
+        Computes the loss of a training batch, with the pairs of the batch
+        or mined from all of its images, depending on the mining mode.
+
+        Returns:
+            The loss, the loss to backpropagate, and the labels and
+            distances of the pairs for compute_metrics.
+        """
+        if self.contrastive_loss.mining == "pairs":
+            # Get the features of both images of the pairs
+            # fatures: [batch_size, 2, output_dim]
+            # labels: [batch_size]
+            features = self.embed_pairs(batch).to(self.device)
+            labels = batch["labels"].to(self.device)
+            distance = self.contrastive_loss.euclidean_distance(features)
+
+            # Compute the loss
+            loss: torch.Tensor = self.contrastive_loss(features, labels, distance)
+            return loss, loss, labels, distance
+
+        # Mine the pairs from all distinct images of the batch
+        # embeddings: [images, output_dim]
+        embeddings = self.embed_images(batch).to(self.device)
+        pet_ids = batch["pet_ids"]
+        if self.config.gather_embeddings:
+            # Mine from the images of the batches of all ranks
+            embeddings, pet_ids = gather_embeddings(embeddings, pet_ids)
+        distances = self.contrastive_loss.distance_matrix(embeddings)
+        loss = self.contrastive_loss.mined_loss(embeddings, pet_ids, distances)
+        labels, distance = self.all_pairs(pet_ids, distances)
+
+        backward_loss = loss
+        if self.config.gather_embeddings:
+            # Every rank has the loss of the global batch, but only
+            # the gradients of its own images, which get averaged
+            backward_loss = loss * self.world_size
+        return loss, backward_loss, labels, distance
+
     def compute_metrics(self, labels, distances, batch_size) -> np.array:
         labels_u8 = labels.to(dtype=torch.int8)
         values_u8 = (distances <= self.contrastive_loss.margin).to(dtype=torch.int8)
@@ -234,35 +424,310 @@ class Trainer:
         metrics = (2 * labels_u8 + values_u8).bincount(minlength=4) / batch_size
         return metrics.cpu().numpy()
 
-    def test_batch(self, imgs1, imgs2, labels, batch_size):
-        with torch.no_grad():
-            features1 = self.vit_model(imgs1)
-            features2 = self.vit_model(imgs2)
+    def all_pairs(self, pet_ids: torch.Tensor, distances: torch.Tensor):
+        """
+        Returns the labels and distances of all pairs of distinct images of
+        a batch, so the metrics of mined batches can be computed like those
+        of sampled pairs.
+        """
+        first, second = torch.triu_indices(len(pet_ids), len(pet_ids), offset=1)
+        pet_ids = pet_ids.to(distances.device)
+        labels = (pet_ids[first] == pet_ids[second]).to(distances.dtype)
+        return labels, distances.detach()[first, second]
+
+    def _create_image_cache(self) -> Optional[SharedImageCache]:
+        # Decoded images are only needed when the ViT outputs are not cached
+        if self.config.image_cache_mb <= 0 or self.config.feature_cache_path:
+            return None
+        height, width = self.vit_model.preprocess.size
+        return SharedImageCache(self.config.image_cache_mb << 20, (height, width, 3))
+
+    def get_loader(self, batch_size: int, test=False, start=0, pet_count=0) -> DataLoader:
+        """
+        Loader of pair batches, see PairBatchDataset, or with a pet_count of
+        batches of pets, see PetBatchDataset. With a feature cache only the
+        paths are loaded, images are then only decoded on a miss.
+        """
+        return self.pet_data.get_loader(
+            batch_size,
+            test=test,
+            start=start,
+            load_images=self.feature_cache is None,
+            image_size=self.vit_model.preprocess.size,
+            num_workers=self.config.num_workers,
+            prefetch_factor=self.config.prefetch_factor,
+            pin_memory=self.config.pin_memory and torch.cuda.is_available(),
+            pet_count=pet_count,
+            images_per_pet=self.config.pk_images,
+            rank=self.rank,
+            world_size=self.world_size,
+        )
 
-            features = torch.stack([features1, features2], dim=1).to(self.device)
-            labels = torch.tensor(labels, dtype=torch.float32).to(self.device)
+    def embed_pairs(self, batch: Dict[str, Any], inference: bool = False) -> torch.Tensor:
+        """
+        Embeds both sides of a batch of pairs in a single forward pass, where
+        an image that appears more than once is only embedded once.
+
+        Args:
+            batch: A batch of the loader, see PairBatchDataset.
+            inference: Use the batched inference path of the model.
+
+        Returns:
+            A tensor of shape (N, 2, output_dim).
+        """
+        features = self.embed_images(batch, inference)
+        features = features[batch["inverse"].to(features.device)]
+        return torch.stack(features.split(len(batch["labels"])), dim=1)
+
+    def embed_images(self, batch: Dict[str, Any], inference: bool = False) -> torch.Tensor:
+        """
+        Embeds the distinct images of a batch.
+
+        Returns:
+            A tensor of shape (len(batch["paths"]), output_dim).
+        """
+        if self.feature_cache is not None:
+            hidden = self.feature_cache.get(batch["paths"], self._encode_paths)
+            features = self.vit_model.project(hidden)
+        else:
+            pixels = batch["pixels"].to(self.device, non_blocking=True)
+            if inference:
+                features = self.vit_model.embed_batch(pixels)
+            else:
+                features = self.vit_model(pixels)
+        return features
+
+    def _load_images(self, items: List[Any]) -> List[Any]:
+        return [
+            self.pet_data.load_image(item) if isinstance(item, (str, Path)) else item
+            for item in items
+        ]
+
+    def _encode_paths(self, paths: List[str]) -> torch.Tensor:
+        return self.vit_model.encode(self._load_images(paths))
+
+    def test_batch(self, batch: Dict[str, Any], batch_size):
+        with torch.no_grad():
+            features = self.embed_pairs(batch, inference=True).to(self.device)
+            labels = batch["labels"].to(self.device)
             distance = self.contrastive_loss.euclidean_distance(features)
             return self.compute_metrics(labels, distance, batch_size)
 
-    def save_model(self):
+    def evaluate(
+        self,
+        top_k: Sequence[int] = (1, 5, 10),
+        thresholds: Iterable[float] = (),
+        max_images: int = 0,
+        chunk_size: int = 256,
+    ) -> EvaluationReport:
+        """
+        Embeds every distinct image of the pets of the test fold once and
+        evaluates all pairs of them, see evaluate_embeddings. Without
+        K-fold there are no test pets and all images are evaluated. The
+        rates at the contrastive margin are always counted exactly.
+
+        Args:
+            max_images: Only evaluate the first max_images images, if set.
+        """
+        test = self.pet_data.fold_count is not None and self.pet_data.fold_count > 1
+        if not test:
+            logging.warning(
+                "No test fold without cross_validiton_k_fold, evaluating all images, "
+                "including those of the pets trained on"
+            )
+        paths, pet_ids, photo_ids = self.pet_data.distinct_images(test)
+        if max_images > 0:
+            paths, pet_ids, photo_ids = paths[:max_images], pet_ids[:max_images], photo_ids[:max_images]
+
+        embeddings = self.embed_paths(list(paths), self.config.test_batch_size)
+        return evaluate_embeddings(
+            embeddings,
+            torch.from_numpy(pet_ids),
+            torch.from_numpy(photo_ids),
+            thresholds=[self.contrastive_loss.margin, *thresholds],
+            top_k=top_k,
+            same_probability=self.pet_data.same_probability,
+            chunk_size=chunk_size,
+        )
+
+    def embed_paths(self, paths: List[str], batch_size: int) -> torch.Tensor:
+        """
+        Embeds images by path in batches, through the feature cache when
+        there is one.
+
+        Returns:
+            A tensor of shape (len(paths), output_dim).
+        """
+        loader = self.pet_data.get_image_loader(
+            paths,
+            batch_size,
+            load_images=self.feature_cache is None,
+            image_size=self.vit_model.preprocess.size,
+            num_workers=self.config.num_workers,
+            prefetch_factor=self.config.prefetch_factor,
+            pin_memory=self.config.pin_memory and torch.cuda.is_available(),
+        )
+        batches: Iterable[Dict[str, Any]] = loader
+        if self.use_tqdm:
+            batches = tqdm(loader, desc="Embedding")
+
+        outputs = []
+        with torch.inference_mode():
+            for batch in batches:
+                outputs.append(self.embed_images(batch, inference=True).to(self.device))
+        if not outputs:
+            return torch.empty((0, self.vit_model.output_dim), device=self.device)
+        return torch.cat(outputs)
+
+    def precision_drift(self, batch: Dict[str, Any], batch_size) -> float:
+        """
+        Returns how much lower the accuracy on a test batch is in the reduced
+        precision of the model than in float32.
+        """
+        _, err1, err2, _ = self.test_batch(batch, batch_size)
+        with self.vit_model.full_precision():
+            _, fp32_err1, fp32_err2, _ = self.test_batch(batch, batch_size)
+        return float((err1 + err2) - (fp32_err1 + fp32_err2))
+
+    def save_model(self, score: Optional[float] = None):
+        """
+        Saves the weights, the optimizer and the training state. Training
+        only waits for them to be copied and for the previous checkpoint to
+        be written, they are written in the background (call
+        self.writer.flush() to wait for that). In
+        distributed training only rank 0 saves, the ranks have the same
+        weights.
+
+        Args:
+            score: Test accuracy of the checkpoint, for keep_checkpoints_by best.
+        """
+        if not is_main_process():
+            return
+
         logging.info("Saving model...")
-        self.vit_model.save_model(self.model_state_path)
+        start = perf_counter()
+        path = self.model_state_path
+        epoch = self.epoch
+
+        # The previous checkpoint has to be written first, its buffers are
+        # reused instead of copying the state again. Also raises its failure.
+        self.writer.flush()
+
+        # Copies, so training can go on while they are written
+        buffers: List[torch.Tensor] = []
+        weights = self.writer.snapshot(
+            self.vit_model.checkpoint_state(path, self.config.checkpoint_trainable_only), buffers
+        )
+        optimizer_state = self.writer.snapshot(self.optimizer.state_dict(), buffers)
+        training_state = self.writer.snapshot(self.training_state(), buffers)
+
+        def write():
+            self.vit_model.save_model(path, state=weights)
+            save_state(optimizer_state, optimizer_path(path))
+            save_state(training_state, training_state_path(path))
+            if self.config.keep_checkpoints > 0:
+                keep_checkpoints(
+                    path, epoch, score, self.config.keep_checkpoints, self.config.keep_checkpoints_by
+                )
+
+        self.writer.submit(f"checkpoint of epoch {epoch}", write, buffers)
+        logging.info(f"Saving blocked training for {perf_counter() - start:.2f}s")
+
+    def training_state(self) -> Dict[str, Any]:
+        """Everything besides the weights needed to resume the run exactly."""
+        numpy_state = np.random.get_state(legacy=False)
+        numpy_state["state"]["key"] = torch.from_numpy(numpy_state["state"]["key"].astype(np.int64))
+        return dict(
+            epoch=self.epoch,
+            bad_epochs=self.bad_epochs,
+            best_accuracy=float(self.best_accuracy),
+            train_batches=self.train_batches,
+            test_batches=self.test_batches,
+            data_seed=self.pet_data.seed,
+            world_size=self.world_size,
+            precision=self.vit_model.precision,
+            grad_scaler=self.grad_scaler.state_dict(),
+            torch_rng=torch.get_rng_state(),
+            cuda_rng=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            numpy_rng=numpy_state,
+            python_rng=random.getstate(),
+        )
+
+    def resume(self):
+        """Restores the optimizer and the progress of the saved run."""
+        self.load_optimizer_state()
+        self.load_training_state()
+        self.resume_pending = False
+
+    def load_training_state(self):
+        path = training_state_path(self.model_state_path)
+        if not path.exists():
+            return
+
+        state = torch.load(path, weights_only=True)
+        self.epoch = state["epoch"]
+        self.bad_epochs = state["bad_epochs"]
+        self.best_accuracy = state["best_accuracy"]
+        self.train_batches = state["train_batches"]
+        self.test_batches = state["test_batches"]
+        # The cursors only continue the same sequence of pairs with the same seed
+        self.pet_data.seed = state["data_seed"]
+        if state.get("world_size", 1) != self.world_size:
+            logging.warning(
+                f"The run was saved with {state.get('world_size', 1)} ranks, with "
+                f"{self.world_size} ranks it continues with other batches than it would have"
+            )
+
+        if state["precision"] == "fp32" and self.vit_model.precision != "fp32":
+            logging.warning("The run fell back to fp32 before, continuing in fp32")
+            self.vit_model.precision = "fp32"
+            self.grad_scaler = torch.amp.GradScaler(self.device.type, enabled=False)
+        elif state["grad_scaler"] and self.grad_scaler.is_enabled():
+            self.grad_scaler.load_state_dict(state["grad_scaler"])
+
+        torch.set_rng_state(state["torch_rng"])
+        if state["cuda_rng"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+        numpy_state = state["numpy_rng"]
+        numpy_state["state"]["key"] = numpy_state["state"]["key"].numpy().astype(np.uint32)
+        np.random.set_state(numpy_state)
+        random.setstate(state["python_rng"])
+        logging.info(f"Restored the training state of epoch {self.epoch} from {path}")
 
     def load_model(self):
-        if self.model_state_path.exists():
+        path = self.model_state_path
+        if not path.exists():
+            # The run may have been saved in the other format
+            path = find_checkpoint(self.model_path, self.run_name) or path
+
+        if path.exists():
             logging.info("Found previous model. Continuing training...")
-            self.vit_model.load_model(self.model_state_path)
+            self.vit_model.load_model(path)
             return True
         else:
             logging.info("No model to load. Training from scratch.")
             return False
 
+    def load_optimizer_state(self):
+        path = optimizer_path(self.model_state_path)
+        try:
+            if load_optimizer(self.optimizer, path, self.device):
+                logging.info(f"Restored the optimizer state from {path}")
+        except ValueError as e:
+            # E.g. the run now trains a different set of parameters
+            logging.warning(f"Cannot restore the optimizer state: {e}")
+
     def load_optimizer(self, optimizer: str, config: OptimizerConfig):
         logging.info("Optimizer config:")
         optimizer = optimizer.lower()
+        # Frozen backbone weights get no optimizer state at all
+        params = self.vit_model.parameter_groups(self.config.backbone_lr)
+        trainable = sum(p.numel() for group in params for p in group["params"])
+        logging.info(f"Trainable parameters: {trainable}")
+
         if optimizer == "adam":
             self.optimizer = Adam(
-                self.vit_model.parameters(),
+                params,
                 config.lr,
                 config.betas,
                 config.eps,
@@ -277,7 +742,7 @@ class Trainer:
                 config.weight_decay = 1e-2
 
             self.optimizer = AdamW(
-                self.vit_model.parameters(),
+                params,
                 config.lr,
                 config.betas,
                 config.eps,
@@ -286,7 +751,7 @@ class Trainer:
             )
         elif optimizer == "sgd":
             self.optimizer = SGD(
-                self.vit_model.parameters(),
+                params,
                 config.lr,
                 config.momentum,
                 config.dampening,
@@ -297,3 +762,17 @@ class Trainer:
             raise ValueError(f"Optimizer {optimizer} not supported")
 
         logging.info(f"{optimizer}: {config.get_dict(optimizer)}")
+
+
+def checkpoint_path(model_path: Path, run_name: str, checkpoint_format: str = "safetensors") -> Path:
+    suffix = "safetensors" if checkpoint_format == "safetensors" else "pt"
+    return Path(model_path) / f"model_{run_name}.{suffix}"
+
+
+def find_checkpoint(model_path: Path, run_name: str) -> Optional[Path]:
+    """The saved model of a run in any of the checkpoint formats."""
+    for checkpoint_format in CHECKPOINT_FORMATS:
+        path = checkpoint_path(model_path, run_name, checkpoint_format)
+        if path.exists():
+            return path
+    return None
@@ -0,0 +1,6 @@
+from .ivf import IVFIndex, exact_search
+
+__all__ = [
+    "IVFIndex",
+    "exact_search",
+]
@@ -0,0 +1,327 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from pathlib import Path
+import json
+import os
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+class IVFIndex:
+    """
+    Inverted file index over gallery embeddings for nearest neighbour
+    queries by euclidean distance, as used by the contrastive loss.
+
+    The embeddings are split into n_lists lists by their nearest k-means
+    centroid. A query only scans the n_probe lists with the nearest
+    centroids, which makes it approximate: a neighbour in a list that is
+    not probed is missed. With n_probe = n_lists the search is exact.
+
+    Until train is called all embeddings go into a single list, so a small
+    gallery can be filled incrementally and searched exactly, and trained
+    once it has grown. Embeddings can be added and removed at any time,
+    train can be called again to rebalance the lists.
+    """
+
+    def __init__(self, dim: int, n_lists: int = 64, n_probe: int = 8):
+        if n_lists < 1 or n_probe < 1:
+            raise ValueError("n_lists and n_probe must be at least 1")
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        # A single centroid until trained, every embedding is in list 0
+        self.centroids = np.zeros((1, dim), dtype=np.float32)
+        self._reset_lists(1)
+
+    def _reset_lists(self, count: int):
+        self._vectors = [np.empty((0, self.dim), dtype=np.float32) for _ in range(count)]
+        self._norms = [np.empty(0, dtype=np.float32) for _ in range(count)]
+        self._ids = [np.empty(0, dtype=np.int64) for _ in range(count)]
+        self._sizes = np.zeros(count, dtype=np.int64)
+        # id -> (list, position in the list)
+        self._where: Dict[int, Tuple[int, int]] = {}
+
+    @property
+    def is_trained(self) -> bool:
+        return len(self.centroids) > 1 or self.n_lists == 1
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, id: int) -> bool:
+        return int(id) in self._where
+
+    def ids(self) -> np.ndarray:
+        return np.concatenate([ids[:size] for ids, size in zip(self._ids, self._sizes)])
+
+    def vectors(self) -> np.ndarray:
+        return np.concatenate([v[:size] for v, size in zip(self._vectors, self._sizes)])
+
+    def train(
+        self,
+        vectors: Optional[np.ndarray] = None,
+        iterations: int = 20,
+        sample_per_list: int = 256,
+        seed: int = 0,
+    ):
+        """
+        Fits the centroids with k-means, on vectors or on the embeddings
+        already in the index, and moves the stored embeddings into their
+        new lists. At most sample_per_list x n_lists vectors are used for
+        fitting.
+        """
+        ids, stored = self.ids(), self.vectors()
+        if vectors is None:
+            vectors = stored
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) < self.n_lists:
+            raise ValueError(f"Training {self.n_lists} lists needs at least as many vectors")
+
+        rng = np.random.default_rng(seed)
+        if len(vectors) > sample_per_list * self.n_lists:
+            vectors = vectors[rng.choice(len(vectors), sample_per_list * self.n_lists, replace=False)]
+        self.centroids = _kmeans(vectors, self.n_lists, iterations, rng)
+
+        self._reset_lists(self.n_lists)
+        if len(ids):
+            self.add(ids, stored)
+
+    def add(self, ids: Union[Sequence[int], np.ndarray], vectors: np.ndarray):
+        """Adds embeddings (N, dim) under the given ids, replacing those that exist."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("Duplicate ids")
+        self.remove([id for id in ids.tolist() if id in self._where])
+
+        lists = _nearest(vectors, self.centroids)
+        for list_idx in np.unique(lists):
+            members = np.flatnonzero(lists == list_idx)
+            self._append(int(list_idx), ids[members], vectors[members])
+
+    def _append(self, list_idx: int, ids: np.ndarray, vectors: np.ndarray):
+        size = int(self._sizes[list_idx])
+        end = size + len(ids)
+        if end > len(self._ids[list_idx]):
+            # Grow geometrically, so adding one at a time stays amortised O(1)
+            capacity = max(end, 2 * len(self._ids[list_idx]), 16)
+            self._vectors[list_idx] = _resize(self._vectors[list_idx], capacity)
+            self._norms[list_idx] = _resize(self._norms[list_idx], capacity)
+            self._ids[list_idx] = _resize(self._ids[list_idx], capacity)
+
+        self._vectors[list_idx][size:end] = vectors
+        self._norms[list_idx][size:end] = np.einsum("ij,ij->i", vectors, vectors)
+        self._ids[list_idx][size:end] = ids
+        self._sizes[list_idx] = end
+        for position, id in enumerate(ids.tolist(), start=size):
+            self._where[id] = (list_idx, position)
+
+    def remove(self, ids: Iterable[int]) -> int:
+        """Removes embeddings by id, unknown ids are ignored. Returns the number removed."""
+        removed = 0
+        for id in ids:
+            location = self._where.pop(int(id), None)
+            if location is None:
+                continue
+            list_idx, position = location
+            # Move the last entry of the list into the gap
+            last = int(self._sizes[list_idx]) - 1
+            if position != last:
+                moved = int(self._ids[list_idx][last])
+                self._vectors[list_idx][position] = self._vectors[list_idx][last]
+                self._norms[list_idx][position] = self._norms[list_idx][last]
+                self._ids[list_idx][position] = moved
+                self._where[moved] = (list_idx, position)
+            self._sizes[list_idx] = last
+            removed += 1
+        return removed
+
+    def _probe(self, queries: np.ndarray, n_probe: Optional[int]) -> np.ndarray:
+        """The lists every query scans, (Q, n_probe)."""
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        distances = _squared_distances(queries, self.centroids)
+        return np.argpartition(distances, n_probe - 1, axis=1)[:, :n_probe]
+
+    def _scan(self, queries: np.ndarray, n_probe: Optional[int]):
+        """Yields the queries that probe a list and their squared distances to it."""
+        probes = self._probe(queries, n_probe)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        for list_idx in np.unique(probes):
+            size = int(self._sizes[list_idx])
+            if size == 0:
+                continue
+            members = np.flatnonzero((probes == list_idx).any(1))
+            vectors = self._vectors[list_idx][:size]
+            squared = (
+                query_norms[members, None]
+                - 2 * queries[members] @ vectors.T
+                + self._norms[list_idx][None, :size]
+            )
+            yield members, self._ids[list_idx][:size], np.maximum(squared, 0.0)
+
+    def search(
+        self, queries: np.ndarray, k: int, n_probe: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest embeddings of every query (Q, dim).
+
+        Returns:
+            The distances and ids (Q, k), nearest first. Rows with fewer
+            than k results are padded with inf and -1.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        best = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+        for members, ids, squared in self._scan(queries, n_probe):
+            # The k nearest of this list, merged with the best so far
+            if squared.shape[1] > k:
+                top = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(squared.shape[1]), squared.shape)
+            candidates = np.concatenate([best[members], np.take_along_axis(squared, top, 1)], 1)
+            candidate_ids = np.concatenate([best_ids[members], ids[top]], 1)
+            order = np.argsort(candidates, axis=1, kind="stable")[:, :k]
+            best[members] = np.take_along_axis(candidates, order, 1)
+            best_ids[members] = np.take_along_axis(candidate_ids, order, 1)
+
+        return np.sqrt(best), best_ids
+
+    def range_search(
+        self, queries: np.ndarray, radius: float, n_probe: Optional[int] = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        All embeddings within radius of every query (Q, dim). With the
+        contrastive margin as radius these are the embeddings the model
+        considers the same pet (distance <= margin, as in
+        Trainer.compute_metrics).
+
+        Returns:
+            For every query the distances and ids of its matches, nearest first.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        found: List[List[Tuple[np.ndarray, np.ndarray]]] = [[] for _ in range(len(queries))]
+        for members, ids, squared in self._scan(queries, n_probe):
+            rows, columns = np.nonzero(squared <= radius * radius)
+            for row in np.unique(rows):
+                hits = columns[rows == row]
+                found[members[row]].append((squared[row, hits], ids[hits]))
+
+        results = []
+        for parts in found:
+            if not parts:
+                results.append((np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)))
+                continue
+            squared = np.concatenate([p[0] for p in parts])
+            ids = np.concatenate([p[1] for p in parts])
+            order = np.argsort(squared, kind="stable")
+            results.append((np.sqrt(squared[order]), ids[order]))
+        return results
+
+    def save(self, path: Union[Path, str]):
+        """Writes the index as a .npz file, see load."""
+        path = Path(path)
+        lists = np.concatenate(
+            [np.full(size, i, dtype=np.int64) for i, size in enumerate(self._sizes)]
+        )
+        config = dict(
+            version=FORMAT_VERSION, dim=self.dim, n_lists=self.n_lists, n_probe=self.n_probe
+        )
+        # Readers never see a partially written index
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    config=np.array(json.dumps(config)),
+                    centroids=self.centroids,
+                    ids=self.ids(),
+                    vectors=self.vectors(),
+                    lists=lists,
+                )
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> "IVFIndex":
+        with np.load(path) as data:
+            config = json.loads(str(data["config"]))
+            if config["version"] != FORMAT_VERSION:
+                raise ValueError(f"Index format version {config['version']} not supported")
+            index = cls(config["dim"], config["n_lists"], config["n_probe"])
+            index.centroids = data["centroids"]
+            index._reset_lists(len(index.centroids))
+            ids, vectors, lists = data["ids"], data["vectors"], data["lists"]
+
+        # The stored assignment is kept, even if the centroids moved since
+        for list_idx in np.unique(lists):
+            members = np.flatnonzero(lists == list_idx)
+            index._append(int(list_idx), ids[members], vectors[members])
+        return index
+
+
+def exact_search(
+    vectors: np.ndarray, queries: np.ndarray, k: int, chunk_size: int = 1024
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The k nearest of vectors for every query by a full scan, as the
+    reference for IVFIndex.search.
+
+    Returns:
+        The distances and the indices into vectors (Q, k), nearest first.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(vectors))
+    distances = np.empty((len(queries), k), dtype=np.float32)
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        squared = _squared_distances(queries[start : start + chunk_size], vectors)
+        top = np.argpartition(squared, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(squared, top, 1), axis=1, kind="stable")
+        top = np.take_along_axis(top, order, 1)
+        indices[start : start + chunk_size] = top
+        distances[start : start + chunk_size] = np.sqrt(np.take_along_axis(squared, top, 1))
+    return distances, indices
+
+
+def _squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    squared = (
+        np.einsum("ij,ij->i", a, a)[:, None] - 2 * a @ b.T + np.einsum("ij,ij->i", b, b)[None, :]
+    )
+    return np.maximum(squared, 0.0)
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    return np.concatenate(
+        [
+            _squared_distances(vectors[start : start + chunk_size], centroids).argmin(1)
+            for start in range(0, len(vectors), chunk_size)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+def _kmeans(
+    vectors: np.ndarray, count: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), count, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=count)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty lists at random vectors, so no list stays unused
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _resize(array: np.ndarray, capacity: int) -> np.ndarray:
+    resized = np.empty((capacity, *array.shape[1:]), dtype=array.dtype)
+    resized[: len(array)] = array
+    return resized
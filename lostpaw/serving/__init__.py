@@ -0,0 +1,14 @@
+from .batcher import BatcherOverloaded, MicroBatcher
+from .embedding_cache import CachedEmbedding, EmbeddingCache, content_hash
+from .runtime import EmbeddingRuntime
+from .server import EmbeddingServer
+
+__all__ = [
+    "BatcherOverloaded",
+    "CachedEmbedding",
+    "EmbeddingCache",
+    "EmbeddingRuntime",
+    "EmbeddingServer",
+    "MicroBatcher",
+    "content_hash",
+]
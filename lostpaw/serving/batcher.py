@@ -0,0 +1,171 @@
+from typing import Callable, Generic, List, Optional, Sequence, TypeVar
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass, field
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic
+import logging
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BatcherOverloaded(RuntimeError):
+    """The queue of the batcher is full, the request was not accepted."""
+
+
+@dataclass
+class _Request(Generic[T, R]):
+    item: T
+    deadline: Optional[float]
+    future: "Future[R]" = field(default_factory=Future)
+
+
+@dataclass
+class BatcherStats:
+    batches: int = 0
+    items: int = 0
+    timeouts: int = 0
+    rejected: int = 0
+    failures: int = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects single requests from any number of threads into batches for
+    process, which maps a list of items to a list of results of the same
+    length. A batch is run as soon as it holds max_batch_size items or
+    max_wait_ms after its first item arrived, whichever comes first, and
+    every caller gets its own result back.
+
+    At most max_queue requests wait at a time, further ones are rejected
+    with BatcherOverloaded instead of queueing up without bound. Requests
+    whose timeout passes before their batch runs are dropped.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[T]], Sequence[R]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+        max_queue: int = 256,
+        name: str = "micro-batcher",
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.stats = BatcherStats()
+        self._requests: "Queue[Optional[_Request[T, R]]]" = Queue(max_queue)
+        self._lock = Lock()
+        self._closed = False
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: T, timeout: Optional[float] = None) -> "Future[R]":
+        """
+        Queues an item and returns the future of its result. Raises
+        BatcherOverloaded when the queue is full.
+        """
+        if self._closed:
+            raise RuntimeError("The batcher is closed")
+        deadline = None if timeout is None else monotonic() + timeout
+        request: _Request[T, R] = _Request(item, deadline)
+        try:
+            self._requests.put_nowait(request)
+        except Full:
+            with self._lock:
+                self.stats.rejected += 1
+            raise BatcherOverloaded(f"More than {self._requests.maxsize} requests are waiting") from None
+        return request.future
+
+    def __call__(self, item: T, timeout: Optional[float] = None) -> R:
+        """
+        Processes a single item as part of a batch and waits for its result.
+        Raises TimeoutError when it takes longer than timeout seconds.
+        """
+        future = self.submit(item, timeout)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # Not needed anymore, the worker skips it if it did not start yet
+            future.cancel()
+            raise
+
+    def _next_batch(self) -> Optional[List["_Request[T, R]"]]:
+        first = self._requests.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        batch_deadline = monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = batch_deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except Empty:
+                break
+            if request is None:
+                # Close after this batch
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            now = monotonic()
+            live: List[_Request[T, R]] = []
+            for request in batch:
+                if not request.future.set_running_or_notify_cancel():
+                    # Cancelled by a caller that stopped waiting
+                    with self._lock:
+                        self.stats.timeouts += 1
+                elif request.deadline is not None and now > request.deadline:
+                    request.future.set_exception(
+                        TimeoutError("The request timed out before it was processed")
+                    )
+                    with self._lock:
+                        self.stats.timeouts += 1
+                else:
+                    live.append(request)
+            if not live:
+                continue
+
+            try:
+                results = self.process([request.item for request in live])
+                if len(results) != len(live):
+                    raise RuntimeError(f"{len(results)} results for a batch of {len(live)} items")
+            except Exception as e:
+                logging.exception(f"Processing a batch of {len(live)} items failed")
+                with self._lock:
+                    self.stats.failures += 1
+                for request in live:
+                    request.future.set_exception(e)
+                continue
+
+            with self._lock:
+                self.stats.batches += 1
+                self.stats.items += len(live)
+            for request, result in zip(live, results):
+                request.future.set_result(result)
+
+    def close(self):
+        """Processes the queued requests, then stops the worker."""
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._thread.join()
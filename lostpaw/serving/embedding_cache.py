@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Dict, Optional, Union
+import hashlib
+import logging
+import sqlite3
+import numpy as np
+
+
+def content_hash(data: bytes) -> str:
+    """The key of an uploaded file, the SHA-256 of its bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class CachedEmbedding:
+    # (N, 4) float32 corners (x0, y0, x1, y1) of the pets found in the image
+    boxes: np.ndarray
+    # The embedding of the first pet, empty if there is none
+    embedding: np.ndarray
+    created: float
+    used: float
+
+
+class EmbeddingCache:
+    """
+    LRU cache of the detection boxes and embedding of uploaded images,
+    keyed by the content hash of the file. The entries belong to one
+    model_version, so a new model never gets the embeddings of the old one.
+
+    Holds at most capacity entries, entries older than ttl_seconds count
+    as misses. With a path the entries are also written to an SQLite
+    database there, and are loaded again on the next start.
+    """
+
+    def __init__(
+        self,
+        model_version: str,
+        capacity: int = 10_000,
+        ttl_seconds: Optional[float] = None,
+        path: Optional[Union[Path, str]] = None,
+    ):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.model_version = model_version
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, CachedEmbedding]" = OrderedDict()
+        self._lock = Lock()
+        self._counters = dict(hits=0, misses=0, expired=0, evictions=0)
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._open(Path(path))
+
+    def _open(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Used from the threads of the server, always under self._lock
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT NOT NULL, model_version TEXT NOT NULL, boxes BLOB NOT NULL, "
+            "embedding BLOB NOT NULL, created REAL NOT NULL, used REAL NOT NULL, "
+            "PRIMARY KEY (key, model_version))"
+        )
+        # Embeddings of other models can never be hit again
+        stale = self._db.execute(
+            "DELETE FROM embeddings WHERE model_version != ?", (self.model_version,)
+        ).rowcount
+        if self.ttl_seconds is not None:
+            stale += self._db.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time() - self.ttl_seconds,)
+            ).rowcount
+
+        rows = self._db.execute(
+            "SELECT key, boxes, embedding, created, used FROM embeddings "
+            "WHERE model_version = ? ORDER BY used DESC LIMIT ?",
+            (self.model_version, self.capacity),
+        ).fetchall()
+        # Least recently used first, like the insertion order of put
+        for key, boxes, embedding, created, used in reversed(rows):
+            self._entries[key] = CachedEmbedding(
+                np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4),
+                np.frombuffer(embedding, dtype=np.float32),
+                created,
+                used,
+            )
+        if rows:
+            # Entries beyond the capacity, e.g. after it was lowered
+            self._db.execute(
+                "DELETE FROM embeddings WHERE model_version = ? AND used < ?",
+                (self.model_version, rows[-1][4]),
+            )
+        logging.info(f"Loaded {len(rows)} cached embeddings from {path}, dropped {stale} stale ones")
+
+    def get(self, key: str) -> Optional[CachedEmbedding]:
+        """The entry of the content hash key, or None on a miss."""
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            if self.ttl_seconds is not None and now - entry.created > self.ttl_seconds:
+                self._counters["misses"] += 1
+                self._counters["expired"] += 1
+                self._remove(key)
+                return None
+
+            self._counters["hits"] += 1
+            self._entries.move_to_end(key)
+            entry.used = now
+            if self._db is not None:
+                self._db.execute(
+                    "UPDATE embeddings SET used = ? WHERE key = ? AND model_version = ?",
+                    (now, key, self.model_version),
+                )
+            return entry
+
+    def put(self, key: str, boxes: np.ndarray, embedding: np.ndarray):
+        """Stores an entry, evicting the least recently used one if full."""
+        now = time()
+        entry = CachedEmbedding(
+            np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4),
+            np.ascontiguousarray(embedding, dtype=np.float32).reshape(-1),
+            now,
+            now,
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, self.model_version, entry.boxes.tobytes(), entry.embedding.tobytes(), now, now),
+                )
+            while len(self._entries) > self.capacity:
+                self._counters["evictions"] += 1
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        if self._db is not None:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key = ? AND model_version = ?",
+                (key, self.model_version),
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return dict(
+                **self._counters,
+                hit_rate=self._counters["hits"] / lookups if lookups else 0.0,
+                size=len(self._entries),
+                capacity=self.capacity,
+            )
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(
+            f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), "
+            f"{stats['size']}/{stats['capacity']} entries, {stats['expired']} expired, {stats['evictions']} evictions"
+        )
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,85 @@
+from typing import Any, Dict, List, Optional, Sequence, Union
+from pathlib import Path
+import json
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageT
+
+# Must match lostpaw.model.export, which is not imported here so that
+# serving does not pull in transformers
+METADATA_KEY = "lostpaw.json"
+
+
+class EmbeddingRuntime:
+    """
+    Loads a model exported by lostpaw.model.export (TorchScript .pt or ONNX
+    .onnx) and embeds images with it. Only needs torch or onnxruntime, not
+    the model code or transformers.
+    """
+
+    def __init__(self, path: Union[Path, str], num_threads: Optional[int] = None):
+        self.path = Path(path)
+        if self.path.suffix == ".onnx":
+            self._load_onnx(num_threads)
+        else:
+            self._load_torchscript(num_threads)
+
+        self.image_size = tuple(self.metadata["image_size"])
+        self.output_dim: int = self.metadata["output_dim"]
+
+    def _load_torchscript(self, num_threads: Optional[int]):
+        import torch
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        extra_files = {METADATA_KEY: ""}
+        self._module = torch.jit.load(str(self.path), map_location="cpu", _extra_files=extra_files)
+        self._module.eval()
+        self.metadata: Dict[str, Any] = json.loads(extra_files[METADATA_KEY])
+        self.format = "torchscript"
+
+    def _load_onnx(self, num_threads: Optional[int]):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self._session = onnxruntime.InferenceSession(
+            str(self.path), options, providers=["CPUExecutionProvider"]
+        )
+        custom = self._session.get_modelmeta().custom_metadata_map
+        self.metadata = json.loads(custom[METADATA_KEY])
+        self.format = "onnx"
+
+    def prepare(self, images: Sequence[Union[ImageT, np.ndarray]]) -> np.ndarray:
+        """
+        Brings images into the input layout of the export: RGB, resized to
+        image_size with the same bilinear resize as the training loader,
+        as one uint8 (N, 3, H, W) array.
+        """
+        height, width = self.image_size
+        batch = np.empty((len(images), height, width, 3), dtype=np.uint8)
+        for i, image in enumerate(images):
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            image = image.convert("RGB")
+            if image.size != (width, height):
+                image = image.resize((width, height), Image.BILINEAR)
+            batch[i] = np.asarray(image)
+        return batch.transpose(0, 3, 1, 2)
+
+    def run(self, pixels: np.ndarray) -> np.ndarray:
+        """Embeds a uint8 (N, 3, H, W) batch, returns float32 (N, output_dim)."""
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        if self.format == "onnx":
+            return self._session.run(None, {"pixels": pixels})[0]
+
+        import torch
+
+        with torch.inference_mode():
+            return self._module(torch.from_numpy(pixels)).numpy()
+
+    def embed(self, images: List[Union[ImageT, np.ndarray]]) -> np.ndarray:
+        if len(images) == 0:
+            return np.empty((0, self.output_dim), dtype=np.float32)
+        return self.run(self.prepare(images))
@@ -0,0 +1,233 @@
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from io import BytesIO
+from time import perf_counter
+import asyncio
+import json
+import logging
+import numpy as np
+from PIL import Image
+
+from .batcher import BatcherOverloaded, MicroBatcher
+from .runtime import EmbeddingRuntime
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+IMAGE_TYPES = ["image/jpeg", "image/png"]
+BINARY_TYPE = "application/octet-stream"
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class EmbeddingServer:
+    """
+    ASGI app that embeds uploaded images with an EmbeddingRuntime.
+
+        POST /embed        One image, as the raw JPEG/PNG body or as a
+                           multipart/form-data upload.
+        POST /embed/batch  Any number of images as multipart/form-data.
+        GET  /health       Batching statistics.
+
+    Images are decoded and resized in a thread pool, the model runs on
+    batches collected across all concurrent requests, see MicroBatcher.
+    Embeddings are returned as JSON, or with "Accept:
+    application/octet-stream" as little-endian float32 (N, output_dim)
+    with the shape in the X-Embedding-Count and X-Embedding-Dim headers.
+    """
+
+    def __init__(
+        self,
+        runtime: EmbeddingRuntime,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        max_queue: int = 256,
+        decode_threads: int = 4,
+        timeout: float = 30.0,
+        max_body_bytes: int = 64 << 20,
+    ):
+        self.runtime = runtime
+        self.timeout = timeout
+        self.max_body_bytes = max_body_bytes
+        self.decoder = ThreadPoolExecutor(decode_threads, thread_name_prefix="decode")
+        self.batcher: MicroBatcher[np.ndarray, np.ndarray] = MicroBatcher(
+            self._embed, max_batch_size, max_wait_ms, max_queue, name="embed"
+        )
+        self.requests = 0
+
+    def _embed(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        return list(self.runtime.run(np.stack(images)))
+
+    def _decode(self, data: bytes) -> np.ndarray:
+        """JPEG/PNG bytes to a uint8 (3, H, W) array of the input size of the model."""
+        try:
+            image = Image.open(BytesIO(data), formats=["JPEG", "PNG"])
+            image.load()
+        except Exception as e:
+            raise HTTPError(400, f"Not a JPEG or PNG image: {e}")
+        return self.runtime.prepare([image])[0]
+
+    async def embed(self, images: List[bytes]) -> np.ndarray:
+        if 0 < self.batcher.max_queue < len(images):
+            # Could never be queued at once, not even on an idle server
+            raise HTTPError(
+                413, f"At most {self.batcher.max_queue} images per request, got {len(images)}"
+            )
+        loop = asyncio.get_running_loop()
+        decoded = await asyncio.gather(
+            *[loop.run_in_executor(self.decoder, self._decode, data) for data in images]
+        )
+        # Every image is its own request, so a large upload is spread
+        # over batches together with the images of other requests
+        futures: List["Future[np.ndarray]"] = []
+        try:
+            for pixels in decoded:
+                futures.append(self.batcher.submit(pixels, self.timeout))
+        except BatcherOverloaded as e:
+            # The request fails as a whole, do not embed the queued images anyway
+            for future in futures:
+                future.cancel()
+            raise HTTPError(503, str(e))
+        try:
+            embeddings = await asyncio.wait_for(
+                asyncio.gather(*[asyncio.wrap_future(f) for f in futures]), self.timeout
+            )
+        except (asyncio.TimeoutError, TimeoutError):
+            for future in futures:
+                future.cancel()
+            raise HTTPError(504, "Embedding the images timed out")
+        if not embeddings:
+            return np.empty((0, self.runtime.output_dim), dtype=np.float32)
+        return np.stack(embeddings)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        start = perf_counter()
+        self.requests += 1
+        try:
+            status, headers, body = await self._handle(scope, receive)
+        except HTTPError as e:
+            status, headers, body = _json(e.status, dict(error=e.message))
+        except Exception as e:
+            logging.exception("Request failed")
+            status, headers, body = _json(500, dict(error=str(e)))
+
+        headers.append((b"x-process-time", f"{perf_counter() - start:.4f}".encode()))
+        await send(dict(type="http.response.start", status=status, headers=headers))
+        await send(dict(type="http.response.body", body=body))
+
+    async def _handle(self, scope: Scope, receive: Receive) -> Tuple[int, List, bytes]:
+        method, path = scope["method"], scope["path"].rstrip("/")
+        headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
+
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405, "Use GET")
+            stats = self.batcher.stats
+            return _json(
+                200,
+                dict(
+                    format=self.runtime.format,
+                    output_dim=self.runtime.output_dim,
+                    requests=self.requests,
+                    batches=stats.batches,
+                    images=stats.items,
+                    mean_batch_size=stats.mean_batch_size,
+                    timeouts=stats.timeouts,
+                    rejected=stats.rejected,
+                ),
+            )
+        if path not in ["/embed", "/embed/batch"]:
+            raise HTTPError(404, f"No route {path}")
+        if method != "POST":
+            raise HTTPError(405, "Use POST")
+
+        body = await self._read_body(receive, headers)
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type == "multipart/form-data":
+            images = _multipart_files(headers["content-type"], body)
+        elif path == "/embed" and content_type in IMAGE_TYPES:
+            images = [body]
+        else:
+            raise HTTPError(415, f"Expected {' or '.join(IMAGE_TYPES)} or multipart/form-data")
+        if path == "/embed" and len(images) != 1:
+            raise HTTPError(400, f"Expected one image, got {len(images)}, see /embed/batch")
+
+        embeddings = await self.embed(images)
+        if BINARY_TYPE in headers.get("accept", ""):
+            return (
+                200,
+                [
+                    (b"content-type", BINARY_TYPE.encode()),
+                    (b"x-embedding-count", str(len(embeddings)).encode()),
+                    (b"x-embedding-dim", str(self.runtime.output_dim).encode()),
+                ],
+                np.ascontiguousarray(embeddings, dtype="<f4").tobytes(),
+            )
+        if path == "/embed":
+            return _json(200, dict(embedding=embeddings[0].tolist()))
+        return _json(200, dict(embeddings=embeddings.tolist()))
+
+    async def _read_body(self, receive: Receive, headers: Dict[str, str]) -> bytes:
+        if int(headers.get("content-length", 0)) > self.max_body_bytes:
+            raise HTTPError(413, f"The body is larger than {self.max_body_bytes} bytes")
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise HTTPError(400, "The client disconnected")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                raise HTTPError(413, f"The body is larger than {self.max_body_bytes} bytes")
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send(dict(type="lifespan.startup.complete"))
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send(dict(type="lifespan.shutdown.complete"))
+                return
+
+    def close(self):
+        self.batcher.close()
+        self.decoder.shutdown()
+
+
+def _json(status: int, value: Any) -> Tuple[int, List, bytes]:
+    return status, [(b"content-type", b"application/json")], json.dumps(value).encode()
+
+
+def _multipart_files(content_type: str, body: bytes) -> List[bytes]:
+    """The contents of the file fields of a multipart/form-data body, in order."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    if not message.is_multipart():
+        raise HTTPError(400, "Malformed multipart/form-data body")
+    files = []
+    for part in message.iter_parts():
+        if part.get_filename() is None and part.get_content_maintype() != "image":
+            # A plain form field
+            continue
+        files.append(part.get_payload(decode=True) or b"")
+    return files
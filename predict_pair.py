@@ -13,11 +13,14 @@ def preprocess_image(img_path):
     return img  # PILのまま渡す
 
 
-def load_model(model_weights_path, model_dir, latent_dim=128):
+def load_model(model_weights_path, model_dir, latent_dim=128, head="flatten", precision="fp32"):
     model = PetViTContrastiveModel(
         model_path=Path(model_dir),  # ViTのconfigとencoder保存場所
         output_dim=latent_dim,
-        device="cpu"
+        device="cpu",
+        head=head,
+        precision=precision,
+        pretrained=False,  # すぐに重みを読み込むため
     )
     model.load_model(model_weights_path)
     model.eval()
@@ -28,9 +31,7 @@ def compare_images(img1_path, img2_path, model, threshold=0.85):
     img1 = preprocess_image(img1_path)
     img2 = preprocess_image(img2_path)
 
-    with torch.no_grad():
-        z1 = model(img1)
-        z2 = model(img2)
+    z1, z2 = model.embed_batch([img1, img2]).split(1)
 
     print("z1:", z1.numpy())
     print("z2:", z2.numpy())
@@ -52,6 +53,8 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default="output/models/model_2025_05_15_183913.pt", help="Path to model weights")
     parser.add_argument("--model_dir", type=str, default="output/models", help="Path to directory containing encoder and model subfolders")
     parser.add_argument("--latent_dim", type=int, default=128, help="Latent space size")
+    parser.add_argument("--head", type=str, default="flatten", help="Projection head of the model")
+    parser.add_argument("--precision", type=str, default="fp32", help="fp32, or bf16 for faster inference on recent CPUs")
     parser.add_argument("--threshold", type=float, default=0.85, help="Cosine similarity threshold for match")
 
     args = parser.parse_args()
@@ -60,5 +63,5 @@ if __name__ == "__main__":
         raise FileNotFoundError(f"Model file not found: {args.model}")
 
     print(f"\n🔍 Comparing:\n- {args.img1}\n- {args.img2}")
-    model = load_model(args.model, args.model_dir, latent_dim=args.latent_dim)
+    model = load_model(args.model, args.model_dir, latent_dim=args.latent_dim, head=args.head, precision=args.precision)
     compare_images(args.img1, args.img2, model, threshold=args.threshold)
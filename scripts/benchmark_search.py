@@ -0,0 +1,87 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Tuple
+import json
+import numpy as np
+
+from lostpaw.search import IVFIndex, exact_search
+
+
+def synthetic_gallery(count: int, dim: int, pets: int, margin: float, seed: int) -> np.ndarray:
+    """
+    Embeddings clustered by pet, a stand-in when no real gallery is given.
+    Two embeddings of the same pet are about 0.7 x margin apart.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(pets, dim)).astype(np.float32)
+    spread = margin / (2 * np.sqrt(dim))
+    return centers[rng.integers(0, pets, count)] + spread * rng.normal(size=(count, dim)).astype(np.float32)
+
+
+def split(vectors: np.ndarray, queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.random.default_rng(seed).permutation(len(vectors))
+    return vectors[order[queries:]], vectors[order[:queries]]
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    hits = [len(set(f[f >= 0].tolist()) & set(e.tolist())) for f, e in zip(found, expected)]
+    return float(np.sum(hits) / expected.size)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Recall and latency of the IVF gallery index against exact search")
+    parser.add_argument("--embeddings", type=Path, default=None, help="A .npy file (N, D) of gallery embeddings")
+    parser.add_argument("--count", type=int, default=100_000, help="Size of the synthetic gallery")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--pets", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--margin", type=float, default=1.25, help="Radius of the range queries, the contrastive margin")
+    parser.add_argument("--n_lists", type=int, default=256)
+    parser.add_argument("--n_probe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        vectors = np.load(args.embeddings).astype(np.float32)
+    else:
+        vectors = synthetic_gallery(args.count, args.dim, args.pets, args.margin, args.seed)
+    gallery, queries = split(vectors, args.queries, args.seed)
+
+    start = perf_counter()
+    index = IVFIndex(gallery.shape[1], args.n_lists)
+    index.train(gallery, seed=args.seed)
+    index.add(np.arange(len(gallery)), gallery)
+    build_seconds = perf_counter() - start
+
+    start = perf_counter()
+    _, expected = exact_search(gallery, queries, args.k)
+    exact_ms = 1000 * (perf_counter() - start) / len(queries)
+    in_range = [np.flatnonzero(np.linalg.norm(gallery - q, axis=1) <= args.margin) for q in queries]
+    range_total = sum(len(r) for r in in_range)
+
+    results: Dict[str, Dict] = dict(exact=dict(ms_per_query=exact_ms, recall=1.0, range_recall=1.0))
+    print(f"{len(gallery)} gallery embeddings, {len(queries)} queries, built in {build_seconds:.1f}s")
+    print(f"{'search':<12} {'ms/query':>9} {f'recall@{args.k}':>10} {'range recall':>13}")
+    print(f"{'exact':<12} {exact_ms:>9.3f} {1.0:>10.3f} {1.0:>13.3f}")
+
+    for n_probe in args.n_probe:
+        start = perf_counter()
+        _, found = index.search(queries, args.k, n_probe=n_probe)
+        ms = 1000 * (perf_counter() - start) / len(queries)
+
+        matches = index.range_search(queries, args.margin, n_probe=n_probe)
+        range_hits = sum(
+            len(np.intersect1d(ids, expected_ids)) for (_, ids), expected_ids in zip(matches, in_range)
+        )
+        range_recall = range_hits / range_total if range_total else float("nan")
+
+        name = f"n_probe={n_probe}"
+        results[name] = dict(ms_per_query=ms, recall=recall(found, expected), range_recall=range_recall)
+        print(f"{name:<12} {ms:>9.3f} {results[name]['recall']:>10.3f} {range_recall:>13.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(build_seconds=build_seconds, **results), f, indent=2)
@@ -0,0 +1,81 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional
+import json
+import subprocess
+import sys
+import numpy as np
+
+HEAVY_MODULES = ["transformers", "pandas", "wandb", "torchvision", "timm"]
+
+# Every case runs in a fresh interpreter and prints the time it took after
+# the interpreter started, plus the heavy modules that ended up imported
+_TEMPLATE = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, modules=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+
+def cases(args) -> Dict[str, str]:
+    result = {
+        "import lostpaw.model": "import lostpaw.model",
+        "import lostpaw.data": "import lostpaw.data",
+        "import lostpaw.serving": "import lostpaw.serving",
+        "import heads": "from lostpaw.model import build_head",
+    }
+    if args.model_dir and args.weights:
+        model = (
+            "from lostpaw.model import PetViTContrastiveModel\n"
+            f"model = PetViTContrastiveModel({str(args.model_dir)!r}, {args.latent_dim}, "
+            f"head={args.head!r}, pretrained={{pretrained}})\n"
+            f"model.load_model({str(args.weights)!r})"
+        )
+        result["load model (pretrained init)"] = model.format(pretrained=True)
+        result["load model (mmap only)"] = model.format(pretrained=False)
+    if args.export:
+        result["load export"] = (
+            "from lostpaw.serving import EmbeddingRuntime\n"
+            f"runtime = EmbeddingRuntime({str(args.export)!r})"
+        )
+    return result
+
+
+def run(code: str) -> Dict:
+    program = _TEMPLATE.format(code=code, heavy=HEAVY_MODULES)
+    start = perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", program], check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measure the cold start times of the CLI and serving paths")
+    parser.add_argument("--model_dir", type=Path, default=None, help="Folder with the ViT model and encoder")
+    parser.add_argument("--weights", type=Path, default=None, help="A model_*.pt checkpoint")
+    parser.add_argument("--latent_dim", type=int, default=128)
+    parser.add_argument("--head", type=str, default="flatten")
+    parser.add_argument("--export", type=Path, default=None, help="An exported model, see export_model.py")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", type=Path, default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results: Dict[str, Dict] = {}
+    print(f"{'case':<32} {'median s':>9} {'process s':>10}  heavy modules")
+    for name, code in cases(args).items():
+        runs: List[Dict] = [run(code) for _ in range(args.repeat)]
+        seconds = float(np.median([r["seconds"] for r in runs]))
+        process_seconds = float(np.median([r["process_seconds"] for r in runs]))
+        modules: Optional[List[str]] = runs[-1]["modules"]
+        results[name] = dict(seconds=seconds, process_seconds=process_seconds, modules=modules)
+        print(f"{name:<32} {seconds:>9.3f} {process_seconds:>10.3f}  {', '.join(modules) or '-'}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
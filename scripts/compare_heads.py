@@ -0,0 +1,32 @@
+from argparse import ArgumentParser
+import torch
+
+from lostpaw.model.heads import HEADS, build_head
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Print the parameter count and FLOPs of every projection head"
+    )
+    # Defaults of ViT-B/16 at 384x384: 577 = 384 / 16 * 384 / 16 + 1 (cls token)
+    parser.add_argument("--hidden_size", type=int, default=768)
+    parser.add_argument("--tokens", type=int, default=577)
+    parser.add_argument("--latent_space_size", type=int, default=512)
+    parser.add_argument("--head_rank", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'head':<10} {'pooling':<8} {'parameters':>14} {'MFLOPs/image':>14} {'fp32 MB':>10}")
+    for name in HEADS:
+        # Build on the meta device, the flatten head alone is ~1.8 GB of weights
+        with torch.device("meta"):
+            head = build_head(
+                name,
+                args.hidden_size,
+                args.tokens,
+                args.latent_space_size,
+                args.head_rank,
+            )
+        info = head.describe()
+        print(
+            f"{name:<10} {info['pooling']:<8} {info['parameters']:>14,} "
+            f"{info['flops'] / 1e6:>14.2f} {info['parameters'] * 4 / 2**20:>10.1f}"
+        )
@@ -0,0 +1,51 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import numpy as np
+import torch
+import yaml
+
+from lostpaw.model.export import EXPORT_FORMATS, EmbeddingModule, export_metadata, export_model
+from lostpaw.model.model import PetViTContrastiveModel
+from lostpaw.config import TrainConfig
+from lostpaw.model.trainer import find_checkpoint
+from lostpaw.serving import EmbeddingRuntime
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Export preprocessing, ViT and head as one TorchScript or ONNX graph"
+    )
+    parser.add_argument("-c", "--config", type=Path, required=True, help="Training config of the model")
+    parser.add_argument("output", type=Path, help="Path of the exported model (.pt or .onnx)")
+    parser.add_argument("--format", type=str, default=None, choices=EXPORT_FORMATS,
+                        help="Defaults to onnx for .onnx files, torchscript otherwise")
+    parser.add_argument("--weights", type=Path, default=None, help="Model weights, defaults to the saved model of the run")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = TrainConfig(**yaml.safe_load(f))
+    export_format = args.format or ("onnx" if args.output.suffix == ".onnx" else "torchscript")
+
+    model = PetViTContrastiveModel(
+        config.model_path,
+        config.latent_space_size,
+        head=config.head,
+        head_rank=config.head_rank,
+        pretrained=False,
+    )
+    weights = args.weights or find_checkpoint(Path(config.model_path), config.run_name)
+    if weights is None:
+        raise FileNotFoundError(f"No saved model of run {config.run_name} in {config.model_path}")
+    model.load_model(weights)
+    model.eval()
+
+    metadata = export_metadata(model, weights=str(weights))
+    export_model(EmbeddingModule.from_model(model), args.output, metadata, export_format)
+
+    # Check that the export gives the same embeddings as the model
+    height, width = model.preprocess.size
+    pixels = torch.randint(0, 256, (3, 3, height, width), dtype=torch.uint8)
+    expected = model.embed_batch(pixels).numpy()
+    actual = EmbeddingRuntime(args.output).run(pixels.numpy())
+    error = np.abs(actual - expected).max()
+    print(f"Exported {weights} to {args.output} ({export_format}), max. difference {error:.2e}")
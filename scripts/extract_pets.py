@@ -2,71 +2,148 @@ from argparse import ArgumentParser, Namespace
 import multiprocessing
 multiprocessing.set_start_method("spawn", force=True)
 
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import json
 import logging
+import os
 from pathlib import Path
-from typing import Any, List, Set, Tuple
-from multiprocessing import Process
+from threading import Lock
+from typing import Any, Dict, List, Optional, Set, Tuple
 import torch
 from PIL.Image import Image
 
-from lostpaw.data import PetImageDataset, DetrPetExtractor
+from lostpaw.data import PetImageDataset, DetrPetExtractor, Pipeline, ShardReader, Stage
 from lostpaw.data.auto_augment import DataAugmenter
 from lostpaw.data.extract_pets import lookup_next_image_name
 
+# A source image: its path in the info file, its pet id and its pets
+Extracted = Tuple[str, str, List[Image]]
+
+# One per process of the augmentation pool
+_augmenter: Optional[DataAugmenter] = None
+
+
+def _init_augmenter():
+    global _augmenter
+    _augmenter = DataAugmenter()
+    # The pool already runs a process per core
+    torch.set_num_threads(1)
+
+
+def augment(crops: List[Image], count: int) -> List[List[Image]]:
+    """Every crop followed by its augmentations."""
+    return [[crop, *_augmenter.get_transforms(crop, count)] for crop in crops]
+
+
+class OutputWriter:
+    """
+    Saves the crops into a folder per pet and appends a line per crop to
+    train.data. A source image goes into processed.txt once all its crops
+    are saved, so an interrupted run skips it when started again.
+    """
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self._next_index: Dict[Path, int] = {}
+        self._names = Lock()
+        self._files = Lock()
+        self.processed_file = open(output_dir / "processed.txt", "at")
+        self.resulting_file = open(output_dir / "train.data", "at")
+
+    def image_path(self, label: str) -> Path:
+        folder_path = Path(self.output_dir, str(label))
+        with self._names:
+            if folder_path not in self._next_index:
+                folder_path.mkdir(parents=True, exist_ok=True)
+                self._next_index[folder_path] = int(lookup_next_image_name(folder_path).stem)
+            index = self._next_index[folder_path]
+            self._next_index[folder_path] = index + 1
+        return folder_path / f"{index}.jpg"
+
+    def write(self, item: Tuple[str, str, List[List[Image]]]) -> List[Any]:
+        source_path, label, groups = item
+        lines = []
+        for images in groups:
+            paths = []
+            for image in images:
+                path = self.image_path(label)
+                image.save(path)
+                paths.append(str(path.resolve()))
+            lines.append(json.dumps({
+                "pet_id": label,
+                "source_path": paths[0],  # 元画像
+                "paths": paths[1:]        # augmented画像のみ
+            }, ensure_ascii=False) + "\n")
+
+        with self._files:
+            self.resulting_file.writelines(lines)
+            self.processed_file.write(f"{source_path}\n")
+            self.resulting_file.flush()
+            self.processed_file.flush()
+        return []
+
+    def close(self):
+        self.processed_file.close()
+        self.resulting_file.close()
+
 
 def extract_images(
     data: PetImageDataset,
     output_dir: Path,
     model_path: Path,
     batch_size: int = 4,
-    device: str = "cpu"
+    device: str = "cpu",
+    decode_threads: int = 4,
+    augment_workers: int = 4,
+    writer_threads: int = 2,
+    augmentations: int = 2,
+    queue_size: int = 64,
+    report_seconds: float = 10.0,
 ):
-    logging.basicConfig(format="[%(levelname)s] %(message)s", level=logging.INFO)
-
+    """
+    Decodes the images in a thread pool, finds the pets in batches with
+    one shared DETR model, augments the crops in a process pool and saves
+    them with writer threads. The stages are connected by bounded queues.
+    """
     pet_extractor = DetrPetExtractor(model_path, device=device)
-    pet_augment = DataAugmenter()
-
-    with open(output_dir / "processed.txt", "at") as processed_file:
-        with open(output_dir / "train.data", "at") as resulting_file:
-            for batch in data.get_batches(batch_size=batch_size):
-                input_images = batch["images"]
-                input_labels = [str(l) for l in batch["labels"]]
-                input_paths = batch["paths"]
-                labels = zip(input_labels, input_paths)
-
-                cropped: List[Tuple[Image, Tuple[str, Any]]] = pet_extractor.extract(
-                    input_images, labels, output_size=(224, 224)
-                )
-                for image, (label, path) in cropped:
-                    augmented = pet_augment.get_transforms(image, 2)
-                    augmented.insert(0, image)  # 元画像を先頭に
-
-                    paths = [save_image(image, label, output_dir) for image in augmented]
-
-                    processed_file.write(f"{paths[0]}\n")  # 元画像
-
-                    # ✅ 正しい形式で1行出力（JSONL）
-                    resulting_file.write(json.dumps({
-                        "pet_id": label,
-                        "source_path": paths[0],  # 元画像
-                        "paths": paths[1:]        # augmented画像のみ
-                    }, ensure_ascii=False))
-                    resulting_file.write("\n")
-
-                processed_file.flush()
-                resulting_file.flush()
-
-
-def save_image(image, label, output_dir):
-    folder_path = Path(output_dir, str(label))
-    if not folder_path.exists():
-        folder_path.mkdir(parents=True, exist_ok=True)
-
-    path = lookup_next_image_name(folder_path)
-    image.save(path)
-    return str(path.resolve())
+    writer = OutputWriter(output_dir)
+
+    def decode(idx: int) -> List[Tuple[Image, str, str]]:
+        try:
+            image, label = data[idx]
+        except Exception as e:
+            logging.warning(f"Skipping {data.image_paths[idx]}: {e}")
+            return []
+        return [(image, str(label), data.image_paths[idx])]
+
+    def detect(batch: List[Tuple[Image, str, str]]) -> List[Extracted]:
+        images = [image for image, _, _ in batch]
+        crops: List[List[Image]] = [[] for _ in batch]
+        for crop, idx in pet_extractor.extract(images, range(len(batch)), output_size=(224, 224)):
+            crops[idx].append(crop)
+        # Also the images without pets, so they are marked as processed
+        return [(path, label, pets) for (_, label, path), pets in zip(batch, crops)]
+
+    with ProcessPoolExecutor(augment_workers, initializer=_init_augmenter) as pool:
+
+        def augment_crops(item: Extracted):
+            source_path, label, crops = item
+            groups = pool.submit(augment, crops, augmentations).result() if crops else []
+            return [(source_path, label, groups)]
+
+        pipeline = Pipeline(
+            [
+                Stage("decode", decode, decode_threads, queue_size),
+                Stage("detect", detect, 1, queue_size, batch_size=batch_size),
+                # The threads only wait for the pool, one per process keeps all busy
+                Stage("augment", augment_crops, augment_workers, queue_size),
+                Stage("write", writer.write, writer_threads, queue_size),
+            ],
+            report_seconds,
+        )
+        pipeline.run(range(len(data)))
+    writer.close()
 
 
 def main(args: Namespace):
@@ -78,24 +155,25 @@ def main(args: Namespace):
         with open(processed_file_path, "rt") as processed_file:
             ignore.update(l.strip() for l in processed_file.readlines())
 
-    pet_data = PetImageDataset.load_from_file(Path(args.info_file), ignore=ignore)
+    shards = ShardReader(Path(args.shard_path)) if args.shard_path else None
+    pet_data = PetImageDataset.load_from_file(Path(args.info_file), ignore=ignore, shards=shards)
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"[INFO] Using device: {device}")
 
-    processes: List[Process] = []
-    for i, data_subset in enumerate(pet_data.split(args.threads)):
-        sub_out_path = output_dir / f"thread_{i}"
-        sub_out_path.mkdir(exist_ok=True)
-        process = Process(
-            target=extract_images,
-            args=[data_subset, sub_out_path, args.model_path, args.batch_size, device]
-        )
-        process.start()
-        processes.append(process)
-
-    for process in processes:
-        process.join()
+    extract_images(
+        pet_data,
+        output_dir,
+        args.model_path,
+        batch_size=args.batch_size,
+        device=device,
+        decode_threads=args.decode_threads,
+        augment_workers=args.augment_workers,
+        writer_threads=args.writer_threads,
+        augmentations=args.augmentations,
+        queue_size=args.queue_size,
+        report_seconds=args.report_seconds,
+    )
 
 
 if __name__ == "__main__":
@@ -104,8 +182,18 @@ if __name__ == "__main__":
     parser.add_argument("--info_file", type=str, required=True)
     parser.add_argument("--model_path", type=str, required=True)
     parser.add_argument("--output_dir", type=str, required=True)
-    parser.add_argument("--threads", type=int, default=4)
-    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--shard_path", type=str, default=None,
+                        help="Folder with the images packed by scripts/pack_shards.py, read instead of the image files")
+    parser.add_argument("--decode_threads", "--threads", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=4, help="Images per DETR call")
+    parser.add_argument("--augment_workers", type=int, default=max(1, (os.cpu_count() or 2) - 2),
+                        help="Processes augmenting the crops")
+    parser.add_argument("--writer_threads", type=int, default=2)
+    parser.add_argument("--augmentations", type=int, default=2,
+                        help="Rounds of the augmentation policies per crop")
+    parser.add_argument("--queue_size", type=int, default=64, help="Items waiting in front of every stage")
+    parser.add_argument("--report_seconds", type=float, default=10.0,
+                        help="How often the throughput of the stages is logged")
 
     args = parser.parse_args()
 
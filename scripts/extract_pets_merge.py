@@ -20,6 +20,8 @@ if __name__ == "__main__":
     # ✅ ペア形式 train.data とは別ファイルに info を保存するようにする
     target_folder = PetImagesFolder(target_path, info_file_name="images.info.json")
     petid_to_all_images = defaultdict(list)
+    # The crop every image comes from, augmentations of a crop show the same photo
+    petid_to_photos = defaultdict(dict)
 
     for source in args.src:
         source_folder = PetImagesFolder(source)
@@ -42,6 +44,7 @@ if __name__ == "__main__":
 
                 if "source_path" in record:
                     all_paths = [record["source_path"]] + record["paths"]
+                    petid_to_photos[pet_id].update((path, record["source_path"]) for path in all_paths)
                 else:
                     all_paths = record["paths"]
 
@@ -63,7 +66,10 @@ if __name__ == "__main__":
                 continue
             anchor = paths[0]
             pairs = [[anchor, p] for p in paths[1:]]
-            json.dump({"pet_id": pet_id, "paths": pairs}, f, ensure_ascii=False, separators=(",", ":"))
+            line = {"pet_id": pet_id, "paths": pairs}
+            if petid_to_photos[pet_id]:
+                line["photos"] = petid_to_photos[pet_id]
+            json.dump(line, f, ensure_ascii=False, separators=(",", ":"))
             f.write("\n")
 
     print(f"✅ Merged pair-form train.data written to: {output_data_file}")
@@ -1,32 +1,36 @@
-from flask import Flask, request, jsonify
-from PIL import Image
-from numpy import array
-import argparse
-from lostpaw.model import PetViTContrastiveModel
-
-app = Flask(__name__)
-model = PetViTContrastiveModel()
-
-@app.route('/predict', methods=['POST'])
-def predict():
-    data = request.get_json(force=True)
-
-    # Convert data to numpy array
-    data = array(data['data'])
+"""
+Serves an exported model (see scripts/export_model.py) over HTTP:
 
-    # Convert data to PIL image
-    image = Image.fromarray(data)
+    curl --data-binary @pet.jpg -H "Content-Type: image/jpeg" localhost:5000/embed
+    curl -F a=@pet1.jpg -F b=@pet2.png localhost:5000/embed/batch
+    curl -F a=@pet1.jpg -H "Accept: application/octet-stream" localhost:5000/embed/batch
 
-    latent_space = model(image)
-
-    output = {'latent_space': latent_space.tolist()}
-    return jsonify(output)
+The app is plain ASGI, any ASGI server can run lostpaw.serving.EmbeddingServer.
+"""
+import argparse
+from lostpaw.serving import EmbeddingRuntime, EmbeddingServer
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--model', type=str, required=True)
+    parser.add_argument('--model', type=str, required=True, help='Exported model (.pt or .onnx)')
+    parser.add_argument('--threads', type=int, default=None, help='Threads of the model runtime')
+    parser.add_argument('--decode_threads', type=int, default=4, help='Threads decoding uploaded images')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='How long a batch waits to fill up')
+    parser.add_argument('--max_queue', type=int, default=256, help='Images waiting beyond this are rejected with 503')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds until a request fails with 504')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
     args = parser.parse_args()
 
-    model.load_model(args.model)
-
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    import uvicorn
+
+    app = EmbeddingServer(
+        EmbeddingRuntime(args.model, args.threads),
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_queue=args.max_queue,
+        decode_threads=args.decode_threads,
+        timeout=args.timeout,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, lifespan='on')
@@ -0,0 +1,58 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Tuple
+import pandas as pd
+from tqdm import tqdm
+
+from lostpaw.data.shards import ENCODINGS, ShardWriter
+
+
+def collect_paths(info_file: Path) -> List[Tuple[str, Path]]:
+    """
+    Returns the image paths of an info file, either of the train.data format
+    read by RandomPairDataset or of the format read by PetImageDataset, as
+    the path written in the file (the key) and the path of the image file.
+    """
+    df = pd.read_json(info_file, lines=True)
+    if "savedPath" in df.columns:
+        # PetImageDataset reads paths relative to the info file
+        return [(str(p), info_file.parent / p) for p in df["savedPath"]]
+
+    paths = []
+    for groups in df["paths"]:
+        for group in groups:
+            group = [group] if isinstance(group, str) else group
+            paths.extend(str(p) for p in group)
+    # Keep the order of the info file, but store every image only once
+    return [(p, Path(p)) for p in dict.fromkeys(paths)]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Pack the images of an info file into shard files"
+    )
+    parser.add_argument("info_file", type=Path)
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--encoding", type=str, default="raw", choices=ENCODINGS)
+    parser.add_argument(
+        "--image_size",
+        type=int,
+        default=384,
+        help="Images are resized to image_size x image_size, 0 keeps the size (jpeg only)",
+    )
+    parser.add_argument("--shard_size_mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    paths = collect_paths(args.info_file)
+    image_size = (args.image_size, args.image_size) if args.image_size else None
+
+    with ShardWriter(
+        args.output_dir,
+        image_size=image_size,
+        encoding=args.encoding,
+        shard_size=args.shard_size_mb << 20,
+    ) as writer:
+        for key, file_path in tqdm(paths):
+            writer.add(key, file_path)
+
+    print(f"Packed {len(paths)} images into {args.output_dir}")
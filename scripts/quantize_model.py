@@ -0,0 +1,103 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from pprint import pprint
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List
+import numpy as np
+import torch
+import yaml
+from tqdm import tqdm
+
+from lostpaw.model.export import export_metadata, export_model
+from lostpaw.model.quantize import QUANTIZATION_MODES, quantize_model
+from lostpaw.model.trainer import Trainer, TrainConfig
+from lostpaw.serving import EmbeddingRuntime
+
+
+def pixel_batches(trainer: Trainer, batch_size: int, count: int, start=0) -> Iterator[torch.Tensor]:
+    loader = iter(trainer.get_loader(batch_size, start=start))
+    for _ in range(count):
+        yield next(loader)["pixels"]
+
+
+def evaluate(
+    trainer: Trainer,
+    embed: Callable[[torch.Tensor], torch.Tensor],
+    batches: List[Dict],
+) -> Dict[str, float]:
+    """err1/err2 of Trainer.compute_metrics and the latency per image of embed."""
+    metrics = np.zeros(4)
+    seconds = 0.0
+    images = 0
+    for batch in tqdm(batches):
+        with torch.inference_mode():
+            start = perf_counter()
+            features = embed(batch["pixels"])
+            seconds += perf_counter() - start
+            images += len(batch["pixels"])
+
+            features = features[batch["inverse"]]
+            features = torch.stack(features.split(len(batch["labels"])), dim=1)
+            distance = trainer.contrastive_loss.euclidean_distance(features)
+            metrics += trainer.compute_metrics(batch["labels"], distance, len(batch["labels"]))
+
+    m_diff, m_err1, m_err2, m_same = metrics / len(batches)
+    return dict(
+        diff=float(m_diff),
+        err1=float(m_err1),
+        err2=float(m_err2),
+        same=float(m_same),
+        ms_per_image=1000 * seconds / max(images, 1),
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Export an int8 quantized embedding model for CPU serving"
+    )
+    parser.add_argument("-c", "--config", type=Path, required=True, help="Training config of the model")
+    parser.add_argument("output", type=Path, help="Path of the TorchScript artefact")
+    parser.add_argument("--mode", type=str, default="dynamic", choices=QUANTIZATION_MODES)
+    parser.add_argument("--weights", type=Path, default=None, help="Model weights, defaults to the saved model of the run")
+    parser.add_argument("--calibration_batches", type=int, default=16)
+    parser.add_argument("--eval_batches", type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = TrainConfig(**yaml.safe_load(f))
+    config.use_wandb = False
+    # The quantized model is evaluated on images, not on cached ViT outputs
+    config.feature_cache_path = None
+    config.precision = "fp32"
+
+    trainer = Trainer(config, device=torch.device("cpu"))
+    if args.weights is not None:
+        trainer.vit_model.load_model(args.weights)
+    model = trainer.vit_model.eval()
+
+    calibration = None
+    if args.mode == "static":
+        # Calibrate on training batches, evaluate on the test batches
+        calibration = pixel_batches(trainer, config.batch_size, args.calibration_batches)
+    quantized = quantize_model(model, args.mode, calibration)
+
+    export_model(
+        quantized,
+        args.output,
+        export_metadata(model, quantization=args.mode),
+    )
+    print(f"Saved {args.mode} int8 model to {args.output}")
+
+    # Without folds, skip the batches used for calibration
+    test = trainer.pet_data.fold_count is not None and trainer.pet_data.fold_count > 1
+    start = 0 if test else args.calibration_batches
+    loader = iter(trainer.get_loader(config.test_batch_size, test=test, start=start))
+    batches = [next(loader) for _ in range(args.eval_batches)]
+
+    # Evaluate the saved artefact, not the module it was traced from
+    artefact = EmbeddingRuntime(args.output)
+    report = dict(
+        fp32=evaluate(trainer, model, batches),
+        int8=evaluate(trainer, lambda pixels: torch.from_numpy(artefact.run(pixels.numpy())), batches),
+    )
+    pprint(report)
@@ -1,32 +1,55 @@
+from argparse import ArgumentParser
 from pathlib import Path
 from pprint import pprint
 from lostpaw.config.args import get_args
-from lostpaw.data.data_folder import PetImagesFolder
 from lostpaw.model.trainer import Trainer, TrainConfig
-from tqdm import tqdm
 
-import numpy as np
+import json
+
+EVALUATION_ARGS = ["weights", "top_k", "thresholds", "max_images", "chunk_size", "curve", "json"]
+
+
+def add_evaluation_args(parser: ArgumentParser):
+    parser.add_argument("--weights", type=Path, default=None, help="Model weights, defaults to the saved model of the run")
+    parser.add_argument("--top_k", type=int, nargs="+", default=[1, 5, 10], help="k of the top-k retrieval accuracies")
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[], help="Distances to report the metrics at, besides the margin")
+    parser.add_argument("--max_images", type=int, default=0, help="Only evaluate the first images of the dataset")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Rows of the distance matrix computed at once")
+    parser.add_argument("--curve", type=Path, default=None, help="Write the ROC/DET curve to this CSV file")
+    parser.add_argument("--json", type=Path, default=None, help="Also write the metrics to this file")
+
 
 def main(args):
+    options = {name: vars(args).pop(name) for name in EVALUATION_ARGS}
     config = TrainConfig(**vars(args))
     config.use_wandb = False
 
     trainer = Trainer(config)
-    pet_data = trainer.pet_data
-    batch_size = config.test_batch_size
-    test_batches = pet_data.get_batches(batch_size=batch_size)
-
-    metrics = np.zeros(4)
-    for _ in tqdm(range(config.test_batch_count)):
-        imgs1, imgs2, labels = next(test_batches)
-        metrics += trainer.test_batch(imgs1, imgs2, labels, batch_size)
-
-    m_diff, m_err1, m_err2, m_same = metrics / config.test_batch_count
-
-    pprint(dict(m_diff=m_diff, m_err1=m_err1, m_err2=m_err2, m_same=m_same))
+    if options["weights"] is not None:
+        trainer.vit_model.load_model(options["weights"])
+    trainer.vit_model.eval()
+
+    # Every image of the dataset is embedded once, and all pairs are evaluated
+    report = trainer.evaluate(
+        top_k=options["top_k"],
+        thresholds=options["thresholds"],
+        max_images=options["max_images"],
+        chunk_size=options["chunk_size"],
+    )
+
+    results = dict(margin=report.summary(config.contrastive_margin))
+    for threshold in options["thresholds"]:
+        results[f"threshold={threshold}"] = report.metrics(threshold)
+    pprint(results)
+
+    if options["curve"]:
+        report.save_curve(options["curve"])
+    if options["json"]:
+        with open(options["json"], "w") as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == "__main__":
-    args = get_args()
+    args = get_args(add_evaluation_args)
 
     main(args)
@@ -1,4 +1,5 @@
 from lostpaw.config.args import get_args
+from lostpaw.model.distributed import cleanup_distributed
 from lostpaw.model.trainer import Trainer, TrainConfig
 
 def main(args):
@@ -15,6 +16,8 @@ def main(args):
         
         pet_data.next_fold()
 
+    cleanup_distributed()
+
 if __name__ == "__main__":
     args = get_args()
 
@@ -1,13 +1,30 @@
 from io import BytesIO
+from pathlib import Path
+from typing import List, Tuple
 from lostpaw.config.config import TrainConfig
 from lostpaw.data.extract_pets import DetrPetExtractor
 from lostpaw.model import PetViTContrastiveModel
+from lostpaw.serving import EmbeddingCache, MicroBatcher, content_hash
 from PIL import Image
+from PIL.Image import Image as ImageT
 from torch import Tensor
 import yaml
 import numpy as np
 
-from lostpaw.model.trainer import Trainer
+from lostpaw.model.trainer import Trainer, find_checkpoint
+
+# Concurrent uploads are embedded together, in batches of up to
+# MAX_BATCH_SIZE images collected for at most MAX_WAIT_MS
+MAX_BATCH_SIZE = 16
+MAX_WAIT_MS = 20
+# Uploads beyond MAX_QUEUE waiting ones are rejected instead of queued
+MAX_QUEUE = 64
+REQUEST_TIMEOUT = 30.0
+# Uploads of the same file again (an edited report, a post in another
+# region) reuse the boxes and embedding of the last time
+CACHE_CAPACITY = 50_000
+CACHE_TTL_SECONDS = 30 * 24 * 3600
+CACHE_FILE = "embedding_cache.sqlite3"
 
 with open("lostpaw/configs/container.yaml", "r") as f:
     config = TrainConfig(**yaml.safe_load(f))
@@ -19,8 +36,61 @@ model.train(False)
 
 extractor = DetrPetExtractor(config.model_path)
 
+# Changes whenever other weights are deployed, which invalidates the cache
+checkpoint = find_checkpoint(Path(config.model_path), config.run_name)
+model_version = f"{config.run_name}:{config.latent_space_size}"
+if checkpoint is not None:
+    stat = checkpoint.stat()
+    model_version += f":{checkpoint.name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+cache = EmbeddingCache(
+    model_version,
+    CACHE_CAPACITY,
+    CACHE_TTL_SECONDS,
+    Path(config.model_path) / CACHE_FILE,
+)
+
+
+def embed_images(images: List[ImageT]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Runs DETR and the ViT once for a batch of uploads, and returns the
+    boxes of the pets found in every image and the embedding of the first
+    one (empty if none).
+    """
+    extracted_pets = extractor.extract_with_boxes(images, range(len(images)), output_size=(384, 384))
+
+    # The first pet of every image, in the order of the images
+    first_pets = {}
+    boxes = [[] for _ in images]
+    for pet, image_idx, box in extracted_pets:
+        first_pets.setdefault(image_idx, pet)
+        boxes[image_idx].append(box)
+    found = sorted(first_pets)
+
+    embeddings = [np.array([], dtype=np.float32) for _ in images]
+    if found:
+        features: Tensor = model.embed_batch([first_pets[idx] for idx in found])
+        features_np = features.detach().to(device="cpu").numpy()
+        for idx, feature in zip(found, features_np):
+            embeddings[idx] = np.reshape(feature, -1)
+    return [
+        (np.array(image_boxes, dtype=np.float32).reshape(-1, 4), embedding)
+        for image_boxes, embedding in zip(boxes, embeddings)
+    ]
+
+
+batcher = MicroBatcher(embed_images, MAX_BATCH_SIZE, MAX_WAIT_MS, MAX_QUEUE, name="create-latent-space")
+
 
 def create_latent_space(buffer):
+    key = content_hash(buffer)
+    cached = cache.get(key)
+    stats = cache.stats()
+    if (stats["hits"] + stats["misses"]) % 100 == 0:
+        cache.log_stats()
+    if cached is not None:
+        return cached.embedding.copy()
+
     bytes = BytesIO(buffer)
     # print(len(bytes))
     bytes.seek(0)
@@ -28,8 +98,7 @@ def create_latent_space(buffer):
     image.load()
     image = image.convert("RGB")
     print(np.array(image).shape)
-    extracted_pets = extractor.extract([image], [0], output_size=(384, 384))
-    if len(extracted_pets) == 0:
-        return np.array([], dtype=np.float32)
-    feature_tensor: Tensor = model(extracted_pets[0][0])
-    return np.reshape(feature_tensor.detach().to(device="cpu").numpy(), -1)
\ No newline at end of file
+    # Waits for the batch of the image, other callers can run meanwhile
+    boxes, embedding = batcher(image, timeout=REQUEST_TIMEOUT)
+    cache.put(key, boxes, embedding)
+    return embedding
@@ -1,6 +1,8 @@
+use std::sync::Arc;
+
 use pyo3::{
     types::{PyByteArray, PyModule},
-    Python,
+    PyObject, Python,
 };
 use tokio::{
     sync::{mpsc, oneshot},
@@ -15,28 +17,29 @@ impl ImageFeatureExtractor {
     pub fn launch() -> ImageFeatureExtractor {
         let (sender, mut receiver) = mpsc::channel::<(Vec<u8>, oneshot::Sender<Option<Vec<f32>>>)>(20);
         spawn_blocking(move || {
-            Python::with_gil(move |py| {
-                // Load the module from file
+            // Load the module from file
+            let func: Arc<PyObject> = Python::with_gil(|py| {
                 let module = PyModule::from_code(py, include_str!("ml.py"), "ml.py", "ml")
                     .map_err(|e| format!("{:?} {}", &e, e.traceback(py).unwrap().format().unwrap()))
                     .unwrap();
 
-                // Call a function in the module
-                let func = module.getattr("create_latent_space").unwrap();
-
-                while let Some((image_bytes, answer)) = receiver.blocking_recv() {
-                    let bytes = PyByteArray::new(py, &image_bytes);
-                    if let Ok(result) = func.call((bytes,), None) {
-                        let features: &numpy::PyArray1<f32> = result.downcast().unwrap();
-                        let features = features.to_vec().unwrap();
-                        if features.len() == 512 {
-                            let _ = answer.send(Some(features));
-                        } else {
-                            let _ = answer.send(None);
-                        }
-                    };
-                }
+                Arc::new(module.getattr("create_latent_space").unwrap().into())
             });
+
+            // Every request waits for its result in its own thread, without
+            // holding the GIL, so ml.py can embed concurrent requests together
+            while let Some((image_bytes, answer)) = receiver.blocking_recv() {
+                let func = Arc::clone(&func);
+                spawn_blocking(move || {
+                    let features = Python::with_gil(|py| -> Option<Vec<f32>> {
+                        let bytes = PyByteArray::new(py, &image_bytes);
+                        let result = func.call1(py, (bytes,)).ok()?;
+                        let features: &numpy::PyArray1<f32> = result.as_ref(py).downcast().ok()?;
+                        features.to_vec().ok()
+                    });
+                    let _ = answer.send(features.filter(|features| features.len() == 512));
+                });
+            }
         });
 
         ImageFeatureExtractor { sender }